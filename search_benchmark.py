@@ -0,0 +1,88 @@
+"""search_benchmark.py
+
+Measures what the full-text search index costs at import time and what it saves at query time, using the mbox file
+specified in the settings.cfg file:
+ 1) Imports the mbox file twice, in to temporary databases, without and with the `search_index` setting, and reports
+    the import times and database sizes.
+ 2) Times searches for each word given on the command line (or a few common subject words) with the index and with a
+    `LIKE` scan of message subjects.
+
+Usage: python search_benchmark.py [word ...]
+"""
+import ConfigParser
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from takeout_inspector import mail, search
+
+RUNS = 5  # Number of times each query is run (the fastest time is reported).
+
+
+def import_mbox(temp_dir, search_index):
+    """Imports the configured mbox file in to a new database in `temp_dir` and returns (settings file, seconds taken).
+    """
+    config = ConfigParser.ConfigParser()
+    config.readfp(open('settings.defaults.cfg'))
+    config.read(['settings.cfg'])
+    config.set('mail', 'db_file', os.path.join(temp_dir, 'search.db' if search_index else 'plain.db'))
+    config.set('mail', 'search_index', str(search_index))
+    config.set('mail', 'stats_file', '')
+    settings_file = os.path.join(temp_dir, 'search.cfg' if search_index else 'plain.cfg')
+    with open(settings_file, 'w') as f:
+        config.write(f)
+
+    started = time.time()
+    mail.Import(settings_file=settings_file).import_messages()
+    return settings_file, time.time() - started
+
+
+def best_time(function, *args):
+    """Returns the fastest of RUNS calls of `function` (in milliseconds) and its result.
+    """
+    times = []
+    for run in range(RUNS):
+        started = time.time()
+        result = function(*args)
+        times.append(time.time() - started)
+    return min(times) * 1000, result
+
+
+def main(words):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        plain_settings, plain_seconds = import_mbox(temp_dir, False)
+        search_settings, search_seconds = import_mbox(temp_dir, True)
+        plain_size = os.path.getsize(os.path.join(temp_dir, 'plain.db'))
+        search_size = os.path.getsize(os.path.join(temp_dir, 'search.db'))
+        print 'Import without index: %8.1fs %10.1f MB' % (plain_seconds, plain_size / 1048576.0)
+        print 'Import with index:    %8.1fs %10.1f MB' % (search_seconds, search_size / 1048576.0)
+        print 'Index cost:           %+8.1fs %+10.1f MB' % (search_seconds - plain_seconds,
+                                                           (search_size - plain_size) / 1048576.0)
+
+        s = search.Search(search_settings)
+        if not words:
+            rows = s.conn.execute('''SELECT subject FROM messages WHERE subject != '' LIMIT 1000;''').fetchall()
+            counts = {}
+            for row in rows:
+                for word in row[0].lower().split():
+                    if word.isalpha():
+                        counts[word] = counts.get(word, 0) + 1
+            words = sorted(counts, key=counts.get, reverse=True)[:5]
+
+        print
+        print '%-20s %10s %12s %12s %12s' % ('Query', 'Matches', 'Top 20 (ms)', 'Count (ms)', 'LIKE (ms)')
+        for word in words:
+            search_ms, results = best_time(s.search, word)
+            count_ms, count = best_time(s.count, word)
+            like_ms, like = best_time(lambda: s.conn.execute('''SELECT message_key FROM messages
+                WHERE subject LIKE ?;''', ('%' + word + '%',)).fetchall())
+            print '%-20s %10d %12.2f %12.2f %12.2f' % (word, count, search_ms, count_ms, like_ms)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -24,7 +24,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
 """
-from takeout_inspector import mail, report, talk
+from takeout_inspector import mail, report, search, talk
 
 __author__ = 'Christopher Charbonneau Wells'
 __copyright__ = 'Copyright (c) 2016 Christopher Charbonneau Wells'
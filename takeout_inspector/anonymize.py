@@ -0,0 +1,271 @@
+"""takeout_inspector/anonymize.py
+
+Defines a deterministic anonymizer for email addresses and names.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import hashlib
+import hmac
+import names
+import os
+import sqlite3
+import struct
+
+from bisect import bisect_right
+
+__all__ = ['Anonymizer', 'anonymize_database', 'database_secret']
+
+# Headers kept (as-is) by anonymize_database(). From, To and CC are rewritten and all other headers are removed.
+KEPT_HEADERS = ['content-transfer-encoding', 'content-type', 'date', 'mime-version', 'subject', 'x-gm-thrid',
+                'x-gmail-labels']
+
+# Name lists (names, cumulative frequencies) loaded from the `names` package data files by _name_pools().
+_pools = {}
+
+
+class Anonymizer:
+    """Replaces email addresses and names with fake ones derived from a keyed hash (HMAC-SHA256) of the real address.
+    The same secret always produces the same fake name and address for a given real address, regardless of the order in
+    which addresses are seen or which process anonymizes them. Names are drawn from the `names` package lists, weighted
+    by frequency like names.get_full_name(), but the lists are only loaded once.
+
+    Different real addresses can hash to the same fake address. The second (and later) addresses seen get a numbered
+    local part (e.g. "jane-doe-2@..."), so only colliding addresses depend on the order they are seen in.
+
+    Keyword arguments:
+        secret -- Key for the hash. Anyone with the secret can check whether a given address appears in anonymized data.
+                  If empty, a random secret is used (so fake addresses are only consistent within one Anonymizer).
+    """
+    def __init__(self, secret=''):
+        self.secret = secret or os.urandom(32)
+        self.domains = {}  # Real domain -> fake domain.
+        self.domain_owners = {}  # Fake domain -> real domain.
+        self.address_owners = {}  # Fake address -> real address.
+
+    def anonymize(self, address):
+        """Returns a fake (address, name) tuple for real address `address`.
+        """
+        digest = self._hash('address', address)
+        gender, first, last = struct.unpack('>QQQ', digest[:24])
+        first_names = 'first:male' if gender % 2 else 'first:female'
+        name = _pick(first_names, first).capitalize() + ' ' + _pick('last', last).capitalize()
+
+        domain = self._anonymize_domain(address.partition('@')[2])
+        local_part = name.replace(' ', '-').lower()
+        anon_address = local_part + '@' + domain
+        number = 1
+        while self.address_owners.get(anon_address, address) != address:
+            number += 1
+            anon_address = local_part + '-' + str(number) + '@' + domain
+        self.address_owners[anon_address] = address
+
+        return anon_address, name
+
+    def anonymize_message_id(self, message_id):
+        """Returns a fake Message-ID (32 hex digits) for real Message-ID `message_id`, which usually includes a domain.
+        """
+        return self._hash('message_id', message_id.encode('utf-8')).encode('hex')[:32]
+
+    def restore(self, address, anon_address):
+        """Records that real address `address` was anonymized as `anon_address` (e.g. by an earlier import) so later
+        addresses do not collide with it.
+        """
+        self.address_owners[anon_address] = address
+        domain, anon_domain = address.partition('@')[2], anon_address.partition('@')[2]
+        self.domains[domain] = anon_domain
+        self.domain_owners[anon_domain] = domain
+
+    def _anonymize_domain(self, domain):
+        """Returns the fake domain for real domain `domain`.
+        """
+        if domain not in self.domains:
+            number = 0
+            anon_domain = 'domain-' + self._hash('domain', domain).encode('hex')[:10] + '.tld'
+            while anon_domain in self.domain_owners:
+                number += 1
+                anon_domain = 'domain-' + self._hash('domain', domain + '#' + str(number)).encode('hex')[:10] + '.tld'
+            self.domains[domain] = anon_domain
+            self.domain_owners[anon_domain] = domain
+        return self.domains[domain]
+
+    def _hash(self, kind, value):
+        return hmac.new(self.secret, kind + ':' + value, hashlib.sha256).digest()
+
+
+def database_secret(conn):
+    """Returns the anonymization secret stored in the `metadata` table of database connection `conn`. A random secret
+    is generated (and committed) the first time, so anonymizing data in the same database without a configured secret
+    always gives the same results.
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS metadata(
+        name TEXT PRIMARY KEY,
+        value TEXT
+        );''')
+    c.execute('''SELECT value FROM metadata WHERE name = 'anonymize_secret';''')
+    row = c.fetchone()
+    if row is not None:
+        return str(row[0])
+
+    secret = os.urandom(32).encode('hex')
+    c.execute('''INSERT INTO metadata VALUES('anonymize_secret', ?);''', (secret,))
+    conn.commit()
+    return secret
+
+
+def anonymize_database(db_file, secret=''):
+    """Anonymizes the addresses and names in an already imported database, in place. Fake addresses are the same as
+    those an import with `anonymize` enabled (and the same `secret`) would produce (see Anonymizer). If `secret` is
+    empty, the secret stored in the database is used (see database_secret()).
+
+    Only one fake value per distinct address, attachment filename and Message-ID is derived in Python, in to temporary
+    mapping tables. Everything else is done with set-based SQL:
+      - `addresses` and `domains` are replaced with the fake addresses and domains.
+      - `address_key` keeps real addresses and names (so the owner can still be found) and gets the fake ones.
+      - messages.from and messages.to are rebuilt from from_id and the `recipients` To rows. Only the first sender of
+        messages with more than one From address is kept.
+      - The From, To and CC headers are rebuilt the same way (keeping Talk resourceparts, e.g. "/Adium4A1B2C3D") and
+        all other headers, except those in KEPT_HEADERS, are removed, as are raw headers of quarantined messages.
+      - Message bodies are removed from the full-text search index (if there is one), leaving only subjects.
+      - Attachment filenames are replaced with "attachment" and the original extension (e.g. "attachment.pdf").
+      - messages.message_id is replaced with the fake Message-ID an import with `anonymize` enabled would store, so
+        later imports (with the same secret) still skip messages already imported.
+
+    The database is vacuumed afterwards so no real data remains in free pages.
+    """
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+
+    anonymizer = Anonymizer(secret or database_secret(conn))
+    c.execute('''SELECT address_id, real_address FROM address_key ORDER BY address_id;''')
+    anonymized = [(address_id,) + anonymizer.anonymize(real_address.encode('utf-8'))
+                  for address_id, real_address in c.fetchall()]
+
+    c.execute('''CREATE TEMP TABLE anon_map(
+        address_id INTEGER PRIMARY KEY,
+        address TEXT,
+        name TEXT,
+        formatted TEXT
+        );''')
+    c.executemany('''INSERT INTO anon_map(address_id, address, name) VALUES(?, ?, ?);''', anonymized)
+    c.execute('''UPDATE anon_map SET formatted = name || ' <' || address || '>';''')
+
+    c.execute('''UPDATE address_key SET
+        anon_address = (SELECT address FROM anon_map WHERE address_id = address_key.address_id),
+        anon_name = (SELECT name FROM anon_map WHERE address_id = address_key.address_id);''')
+
+    c.execute('''DELETE FROM domains;''')
+    c.execute('''INSERT INTO domains(domain) SELECT DISTINCT substr(address, instr(address, '@') + 1) FROM anon_map;''')
+    c.execute('''UPDATE addresses SET
+        address = (SELECT address FROM anon_map WHERE address_id = addresses.address_id),
+        name = (SELECT name FROM anon_map WHERE address_id = addresses.address_id);''')
+    c.execute('''UPDATE addresses SET
+        domain_id = (SELECT domain_id FROM domains WHERE domain = substr(address, instr(address, '@') + 1));''')
+
+    for header in ['To', 'CC']:
+        c.execute('''CREATE TEMP TABLE ''' + header.lower() + '''_lists AS
+            SELECT message_key, group_concat(formatted, ',') AS formatted, MIN(address) AS address
+            FROM (SELECT r.message_key, a.formatted, a.address
+                FROM recipients AS r
+                JOIN anon_map AS a ON(a.address_id = r.address_id)
+                WHERE r.header = ?
+                ORDER BY r.message_key, r.rowid)
+            GROUP BY message_key;''', (header,))
+        c.execute('''CREATE UNIQUE INDEX temp.''' + header.lower() + '''_lists_message_key
+            ON ''' + header.lower() + '''_lists (message_key);''')
+
+    c.execute('''UPDATE messages SET
+        `from` = COALESCE((SELECT formatted FROM anon_map WHERE address_id = messages.from_id), ''),
+        `to` = COALESCE((SELECT formatted FROM to_lists WHERE message_key = messages.message_key), '');''')
+
+    c.execute('''CREATE TEMP TABLE header_ids AS SELECT header_id, lower(header) AS header FROM header_names;''')
+    c.execute('''DELETE FROM headers WHERE header_id NOT IN (SELECT header_id FROM header_ids
+        WHERE header IN (''' + ', '.join(['?'] * len(KEPT_HEADERS)) + ''', 'from', 'to', 'cc'));''', KEPT_HEADERS)
+    c.execute('''UPDATE headers SET value = (SELECT `from` FROM messages WHERE message_key = headers.message_key)
+        WHERE header_id IN (SELECT header_id FROM header_ids WHERE header = 'from');''')
+    c.execute('''UPDATE headers SET value = CASE
+            WHEN value NOT LIKE '%,%' AND instr(value, '/') > instr(value, '@') AND instr(value, '@') > 0
+            THEN COALESCE((SELECT address FROM to_lists WHERE message_key = headers.message_key), '')
+                || rtrim(substr(value, instr(value, '/')), '>')
+            ELSE COALESCE((SELECT formatted FROM to_lists WHERE message_key = headers.message_key), '')
+        END
+        WHERE header_id IN (SELECT header_id FROM header_ids WHERE header = 'to');''')
+    c.execute('''UPDATE headers SET value = COALESCE((SELECT formatted FROM cc_lists
+            WHERE message_key = headers.message_key), '')
+        WHERE header_id IN (SELECT header_id FROM header_ids WHERE header = 'cc');''')
+    c.execute('''DELETE FROM header_names WHERE header_id NOT IN (SELECT DISTINCT header_id FROM headers);''')
+
+    c.execute('''UPDATE quarantine SET headers = NULL;''')
+
+    c.execute('''SELECT DISTINCT filename FROM parts WHERE filename IS NOT NULL;''')
+    filenames = [(filename, _anonymize_filename(filename)) for filename, in c.fetchall()]
+    c.execute('''CREATE TEMP TABLE filename_map(filename TEXT PRIMARY KEY, anon_filename TEXT);''')
+    c.executemany('''INSERT INTO filename_map VALUES(?, ?);''', filenames)
+    c.execute('''UPDATE parts SET filename = (SELECT anon_filename FROM filename_map WHERE filename = parts.filename)
+        WHERE filename IS NOT NULL;''')
+
+    # Fake Message-IDs (see Anonymizer.anonymize_message_id()) are hex digits, so they are not anonymized again.
+    c.execute('''SELECT DISTINCT message_id FROM messages WHERE message_id GLOB '*[^0-9a-f]*';''')
+    message_ids = [(message_id, anonymizer.anonymize_message_id(message_id)) for message_id, in c.fetchall()]
+    c.execute('''CREATE TEMP TABLE message_id_map(message_id TEXT PRIMARY KEY, anon_message_id TEXT);''')
+    c.executemany('''INSERT INTO message_id_map VALUES(?, ?);''', message_ids)
+    c.execute('''UPDATE messages SET message_id = (SELECT anon_message_id FROM message_id_map
+            WHERE message_id = messages.message_id)
+        WHERE message_id IN (SELECT message_id FROM message_id_map);''')
+
+    c.execute('''SELECT COUNT(*) FROM sqlite_master WHERE name = 'message_text';''')
+    if c.fetchone()[0]:
+        c.execute('''DELETE FROM message_text;''')
+        c.execute('''INSERT INTO message_text(rowid, subject) SELECT message_key, subject FROM messages;''')
+        c.execute('''INSERT INTO message_text(message_text) VALUES('optimize');''')
+    conn.commit()
+
+    c.execute('''VACUUM;''')
+    conn.close()
+
+
+def _anonymize_filename(filename):
+    """Returns "attachment" followed by the (lower case) extension of `filename`.
+    """
+    return 'attachment' + os.path.splitext(filename)[1].lower()
+
+
+def _pick(pool, number):
+    """Returns a name from `pool` (a names.FILES key) for 64-bit integer `number`, weighted by name frequency.
+    """
+    pool_names, cumulative = _name_pools(pool)
+    position = float(number) / 2 ** 64 * cumulative[-1]
+    return pool_names[min(bisect_right(cumulative, position), len(pool_names) - 1)]
+
+
+def _name_pools(pool):
+    """Returns (names, cumulative frequencies) lists for `pool` (a names.FILES key), reading the data file only once.
+    """
+    if pool not in _pools:
+        pool_names, cumulative = [], []
+        with open(names.FILES[pool]) as name_file:
+            for line in name_file:
+                name, _, cumulative_frequency, _ = line.split()
+                pool_names.append(name)
+                cumulative.append(float(cumulative_frequency))
+        _pools[pool] = (pool_names, cumulative)
+    return _pools[pool]
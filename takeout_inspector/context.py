@@ -0,0 +1,94 @@
+"""takeout_inspector/context.py
+
+Defines the settings and database connection shared by the graphs of a report.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+from . import utils
+from .db import CachingConnection, PlanCheckingConnection, QueryCache, connect_read_only, db_fingerprint
+from .facts import MessageFacts
+
+__all__ = ['ReportContext', 'open_query_cache']
+
+
+class ReportContext(object):
+    """Settings, database connection and account details shared by all the Graph classes of a report run, so settings
+    are parsed, the database is opened and the owner is looked up once.
+
+    The database is opened read-only (see connect_read_only()) with the page cache and memory-mapping sizes set by the
+    `cache_size` and `mmap_size` settings of the [report] section. Graph queries run through self.conn, which checks
+    query plans (if the `check_query_plans` setting is enabled) and caches results (if `query_cache_file` is set).
+
+    Keyword arguments:
+        config -- ConfigParser with the settings to use. Defaults to those read by the utils module (the
+                  settings.defaults.cfg file, overridden by settings.cfg).
+        read_only_cache -- Whether the query cache is opened read-only, with new results left for another process to
+                           store (see QueryCache).
+
+    Attributes:
+        owner_email -- Address of the owner of the account (anonymized, if the database is).
+        owner_id -- Address id of the owner, or None if the owner has not sent or received any message.
+        label_ids -- Dict of label -> label id.
+        facts -- MessageFacts loaded from the database if the `engine` setting of the [report] section is "numpy",
+                 otherwise None.
+        cache -- QueryCache in which graph query results are kept, or None.
+    """
+    def __init__(self, config=None, read_only_cache=False):
+        self.config = config or utils.config
+        db_file = self.config.get('mail', 'db_file')
+        conn = connect_read_only(db_file, self.config.getint('report', 'cache_size'),
+                                 self.config.getint('report', 'mmap_size'))
+
+        c = conn.cursor()
+        self.owner_email = self.config.get('mail', 'owner')
+        self.owner_id = None
+        c.execute('''SELECT anon_address, address_id FROM address_key WHERE real_address = ?;''', (self.owner_email,))
+        row = c.fetchone()
+        if row:
+            self.owner_id = row[1]
+            if self.config.getboolean('mail', 'anonymize'):  # Anonymized data uses a fake address for the owner.
+                self.owner_email = row[0]
+
+        c.execute('''SELECT label, label_id FROM labels;''')
+        self.label_ids = dict(c.fetchall())
+
+        self.facts = None
+        if self.config.get('report', 'engine') == 'numpy':
+            self.facts = MessageFacts(conn, self.owner_id, self.label_ids)
+
+        if self.config.getboolean('report', 'check_query_plans'):
+            conn = PlanCheckingConnection(conn)
+
+        self.cache = open_query_cache(self.config, read_only_cache)
+        if self.cache:
+            conn = CachingConnection(conn, self.cache, db_fingerprint(conn, db_file))
+        self.conn = conn
+
+
+def open_query_cache(config, read_only=False):
+    """Returns the QueryCache set by the `query_cache_file` and `query_cache_size` settings of the [report] section of
+    `config`, or None if `query_cache_file` is empty.
+    """
+    if not config.get('report', 'query_cache_file'):
+        return None
+    return QueryCache(config.get('report', 'query_cache_file'),
+                      config.getint('report', 'query_cache_size') * 1024 * 1024, read_only)
@@ -0,0 +1,485 @@
+"""takeout_inspector/db.py
+
+Defines helpers for writing imported data to the sqlite database and for checking and caching graph queries.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import hashlib
+import marshal
+import os
+import re
+import sqlite3
+import time
+import urllib
+import warnings
+
+from .utils import CacheInfo
+
+__all__ = ['BatchWriter', 'CachingConnection', 'PlanCheckingConnection', 'QueryCache', 'apply_load_profile',
+           'build_indexes', 'bump_generation', 'connect_in_memory', 'connect_read_only', 'db_fingerprint',
+           'finish_load', 'full_scans', 'save_in_memory']
+
+# PRAGMA settings for each load profile. Bulk loading trades durability for speed: with write-ahead logging and no
+# syncing, an interrupted import (e.g. a crash or Ctrl+C) is still rolled back to the last commit, but a power loss or
+# OS crash could corrupt the database.
+LOAD_PROFILES = {
+    'default': [],
+    'bulk': [
+        ('page_size', 32768),  # Only takes effect for a new database (before journal_mode is changed).
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+# PRAGMA settings restored once a load is finished.
+SAFE_SETTINGS = [
+    ('journal_mode', 'DELETE'),
+    ('synchronous', 'FULL'),
+]
+
+# Matches EXPLAIN QUERY PLAN details of full table scans: "SCAN messages" or "SCAN TABLE messages AS m" (SQLite before
+# 3.36), but not "SCAN m USING COVERING INDEX ...", "SCAN SUBQUERY 1" or "SCAN CONSTANT ROW".
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(?!SUBQUERY |CONSTANT ROW)(?P<name>\w+)( AS \w+)?$')
+
+# Small summary tables, kept up to date during import, that graphs are meant to read in full.
+SUMMARY_TABLES = ['message_rollup']
+
+# Suffixes of the shadow tables SQLite creates (and fills) for each FTS5 virtual table.
+FTS5_SHADOW_TABLES = ['_config', '_content', '_data', '_docsize', '_idx']
+
+
+class BatchWriter:
+    """Buffers rows per table and writes them to sqlite with executemany() once `batch_size` rows are waiting for a
+    table. commit_due() reports when `commit_size` rows have been inserted or `commit_interval` seconds have passed
+    since the last commit, whichever comes first. Committing is left to the caller so a commit never splits the rows of
+    a single message.
+
+    Keyword arguments:
+        batch_size -- Number of rows buffered per table before they are written.
+        commit_size -- Number of rows written between commits.
+        commit_interval -- Maximum number of seconds between commits.
+        timings -- Dict the seconds spent writing rows and committing are added to (as 'write' and 'commit').
+    """
+    def __init__(self, conn, batch_size=10000, commit_size=1000000, commit_interval=60.0, timings=None):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self.timings = timings if timings is not None else {'write': 0.0, 'commit': 0.0}
+
+        self.rows = {}
+        self.statements = {}
+        self.uncommitted = 0
+        self.last_commit = time.time()
+
+    def insert(self, table, row):
+        """Buffers `row` (a tuple of column values) for insertion in to `table`.
+        """
+        rows = self.rows.get(table)
+        if rows is None:
+            rows = self.rows[table] = []
+        rows.append(row)
+        self.uncommitted += 1
+
+        if len(rows) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table=None):
+        """Writes all buffered rows for `table` (or all tables, if `table` is None).
+        """
+        started = time.time()
+        for table in [table] if table else self.rows.keys():
+            rows = self.rows.get(table)
+            if not rows:
+                continue
+
+            if table not in self.statements:
+                self.statements[table] = 'INSERT INTO ' + table + ' VALUES(' + ', '.join(['?'] * len(rows[0])) + ');'
+            self.conn.executemany(self.statements[table], rows)
+            self.rows[table] = []
+        self.timings['write'] += time.time() - started
+
+    def commit_due(self):
+        """Returns True if the commit size or interval has been reached.
+        """
+        return self.uncommitted >= self.commit_size or time.time() - self.last_commit >= self.commit_interval
+
+    def commit(self):
+        """Writes all buffered rows and commits.
+        """
+        self.flush()
+        started = time.time()
+        self.conn.commit()
+        self.uncommitted = 0
+        self.last_commit = time.time()
+        self.timings['commit'] += self.last_commit - started
+
+
+def apply_load_profile(conn, profile, cache_size_mb):
+    """Applies the PRAGMA settings of load profile `profile` (see LOAD_PROFILES) to `conn`, with a page cache of
+    `cache_size_mb` megabytes.
+    """
+    for pragma, value in LOAD_PROFILES[profile]:
+        conn.execute('PRAGMA ' + pragma + ' = ' + str(value) + ';')
+    conn.execute('PRAGMA cache_size = ' + str(-1024 * cache_size_mb) + ';')  # Negative values are in KiB.
+
+
+def finish_load(conn, vacuum=False):
+    """Updates query planner statistics (ANALYZE), optionally rebuilds the database file (VACUUM) and restores safe
+    PRAGMA settings after a load.
+    """
+    conn.execute('ANALYZE;')
+    if vacuum:
+        conn.execute('VACUUM;')
+    for pragma, value in SAFE_SETTINGS:
+        conn.execute('PRAGMA ' + pragma + ' = ' + str(value) + ';')
+    conn.commit()
+
+
+def build_indexes(conn, plan, progress=None):
+    """Creates each index in `plan`, a list of (name, table, columns) tuples, that does not already exist and commits.
+    Building indexes once a load is finished is much faster than keeping them up to date during the load.
+
+    Keyword arguments:
+        progress -- Function called after each index is built with (name, number built, total, seconds taken).
+    """
+    c = conn.cursor()
+    for number, (name, table, columns) in enumerate(plan, 1):
+        started = time.time()
+        c.execute('CREATE INDEX IF NOT EXISTS ' + name + ' ON ' + table + ' (' + columns + ');')
+        conn.commit()
+        if progress:
+            progress(name, number, len(plan), time.time() - started)
+
+
+def full_scans(conn, sql, parameters=()):
+    """Returns the EXPLAIN QUERY PLAN details of each step of `sql` that scans a whole table without using an index
+    (e.g. "SCAN messages"). Scans of subquery results and of SUMMARY_TABLES are not included.
+    """
+    c = conn.cursor()
+    c.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+    details = [row[-1] for row in c.fetchall()]
+
+    subqueries = set(detail.split(' ', 1)[1] for detail in details
+                     if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE ')))
+    scans = []
+    for detail in details:
+        match = FULL_SCAN.match(detail)
+        if match and match.group('name') not in subqueries and match.group('name') not in SUMMARY_TABLES:
+            scans.append(detail)
+    return scans
+
+
+class PlanCheckingConnection(object):
+    """Wraps a sqlite3 connection so that every query run through its cursors is checked with EXPLAIN QUERY PLAN first.
+    A warning is issued for each query that scans a whole table without using an index.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self):
+        return PlanCheckingCursor(self.conn.cursor())
+
+
+class PlanCheckingCursor(object):
+    """Cursor returned by PlanCheckingConnection.cursor().
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, parameters=()):
+        for detail in full_scans(self.cursor.connection, sql, parameters):
+            warnings.warn('Query uses a full table scan (' + detail + '): ' + ' '.join(sql.split()))
+        return self.cursor.execute(sql, parameters)
+
+
+class QueryCache(object):
+    """Keeps query results in sqlite database file `cache_file`, so they can be reused by later runs. Results are keyed
+    on the query, its parameters and a fingerprint of the database they were read from (see db_fingerprint()), so they
+    are only reused while that database is unchanged. Once stored results take more than `max_size` bytes, the least
+    recently used are removed.
+
+    Rows are stored with marshal, so only results made of numbers, strings and None are cached.
+
+    A `read_only` cache (e.g. one of several processes sharing `cache_file`, which must already exist) never writes to
+    `cache_file`. The keys of the results it reuses, and the results it would store, are kept in self.pending instead
+    for the process that owns the cache file to merge().
+    """
+    def __init__(self, cache_file, max_size, read_only=False):
+        self.conn = sqlite3.connect(cache_file)
+        self.read_only = read_only
+        self.pending = []  # (key, None) for reused results and (key, rows) for new ones, with read_only.
+        if not read_only:
+            self.conn.execute('''PRAGMA synchronous = OFF;''')  # Losing recent results in a crash only costs queries.
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS results(
+                  key TEXT PRIMARY KEY,
+                  rows BLOB,
+                  size INT,
+                  used REAL
+                );
+            ''')
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS used ON results(used);''')
+            self.conn.commit()
+
+        self.max_size = max_size
+        self.size = self._stored_size()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fingerprint, sql, parameters=()):
+        """Returns the cache key of query `sql` with `parameters` on the database with fingerprint `fingerprint`.
+        """
+        return hashlib.sha1(marshal.dumps((fingerprint, sql, tuple(parameters)))).hexdigest()
+
+    def get(self, key):
+        """Returns the list of rows stored for `key`, or None if there are none.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT rows FROM results WHERE key = ?;''', (key,))
+        row = c.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if self.read_only:
+            self.pending.append((key, None))
+        else:
+            c.execute('''UPDATE results SET used = ? WHERE key = ?;''', (time.time(), key))
+            self.conn.commit()
+        return marshal.loads(str(row[0]))
+
+    def put(self, key, rows):
+        """Stores the list of `rows` for `key`, then removes the least recently used results until those left fit in
+        max_size. Results that cannot be marshalled, or that would not fit on their own, are not stored.
+        """
+        try:
+            data = marshal.dumps(rows)
+        except ValueError:
+            return
+        if len(data) > self.max_size:
+            return
+        if self.read_only:
+            self.pending.append((key, rows))
+            return
+
+        c = self.conn.cursor()
+        c.execute('''INSERT OR REPLACE INTO results VALUES(?, ?, ?, ?);''',
+                  (key, sqlite3.Binary(data), len(data), time.time()))
+        self.size = self._stored_size()
+        while self.size > self.max_size:
+            c.execute('''SELECT key, size FROM results ORDER BY used LIMIT 1;''')
+            oldest, size = c.fetchone()
+            c.execute('''DELETE FROM results WHERE key = ?;''', (oldest,))
+            self.size -= size
+        self.conn.commit()
+
+    def merge(self, pending):
+        """Stores the new results, and marks the reused results as used, in `pending` (the self.pending list of a
+        read_only cache of the same file), counting them as misses and hits.
+        """
+        for key, rows in pending:
+            if rows is None:
+                self.hits += 1
+                self.conn.execute('''UPDATE results SET used = ? WHERE key = ?;''', (time.time(), key))
+            else:
+                self.misses += 1
+                self.put(key, rows)
+        self.conn.commit()
+
+    def cache_info(self):
+        """Returns the number of hits and misses since the cache was opened and the maximum and current size (in bytes)
+        of the stored results, like lru_cache's cache_info().
+        """
+        return CacheInfo(self.hits, self.misses, self.max_size, self.size)
+
+    def _stored_size(self):
+        c = self.conn.cursor()
+        c.execute('''SELECT IFNULL(SUM(size), 0) FROM results;''')
+        return c.fetchone()[0]
+
+
+class CachingConnection(object):
+    """Wraps a sqlite3 connection so that the results of queries run through its cursors are looked up in QueryCache
+    `cache` first, and stored there otherwise. `fingerprint` identifies the current state of the database (see
+    db_fingerprint()). Cursors only support execute(), fetchone(), fetchall() and iteration.
+    """
+    def __init__(self, conn, cache, fingerprint):
+        self.conn = conn
+        self.cache = cache
+        self.fingerprint = fingerprint
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def cursor(self):
+        return CachingCursor(self.conn.cursor(), self.cache, self.fingerprint)
+
+
+class CachingCursor(object):
+    """Cursor returned by CachingConnection.cursor().
+    """
+    def __init__(self, cursor, cache, fingerprint):
+        self.cursor = cursor
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.rows = []
+        self.position = 0
+
+    def __iter__(self):
+        while self.position < len(self.rows):
+            yield self.fetchone()
+
+    def execute(self, sql, parameters=()):
+        key = self.cache.key(self.fingerprint, sql, parameters)
+        self.rows = self.cache.get(key)
+        if self.rows is None:
+            self.cursor.execute(sql, parameters)
+            self.rows = self.cursor.fetchall()
+            self.cache.put(key, self.rows)
+        self.position = 0
+        return self
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        self.position += 1
+        return self.rows[self.position - 1]
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return rows
+
+
+def db_fingerprint(conn, db_file):
+    """Returns a string that changes whenever database file `db_file` (open as `conn`) is modified: its path, size,
+    modification time and import generation (see bump_generation()).
+    """
+    stat = os.stat(db_file)
+    c = conn.cursor()
+    c.execute('''PRAGMA user_version;''')
+    return '%s:%d:%r:%d' % (os.path.abspath(db_file), stat.st_size, stat.st_mtime, c.fetchone()[0])
+
+
+def bump_generation(conn):
+    """Increments the import generation of the database, kept as its user_version, so the fingerprint of the database
+    (see db_fingerprint()) changes even if its size and modification time do not.
+    """
+    c = conn.cursor()
+    c.execute('''PRAGMA user_version;''')
+    conn.execute('''PRAGMA user_version = %d;''' % (c.fetchone()[0] + 1))
+
+
+def connect_read_only(db_file, cache_size_mb, mmap_size_mb):
+    """Returns a connection to existing database file `db_file` for reading only, with a page cache of `cache_size_mb`
+    megabytes and up to `mmap_size_mb` megabytes of the file memory-mapped. The file is opened in read-only mode when
+    sqlite accepts URI file names (i.e. it was built with SQLITE_USE_URI, which Python 2's sqlite3 module relies on) and
+    writes are refused with `query_only` either way.
+
+    Raises sqlite3.OperationalError if `db_file` does not exist.
+    """
+    if not os.path.isfile(db_file):
+        raise sqlite3.OperationalError('unable to open database file: ' + db_file)
+
+    compile_options = [row[0] for row in sqlite3.connect(':memory:').execute('''PRAGMA compile_options;''')]
+    if 'USE_URI' in compile_options:
+        conn = sqlite3.connect('file:' + urllib.quote(os.path.abspath(db_file)) + '?mode=ro')
+    else:
+        conn = sqlite3.connect(db_file)
+    conn.execute('''PRAGMA query_only = ON;''')
+    conn.execute('PRAGMA cache_size = ' + str(-1024 * cache_size_mb) + ';')  # Negative values are in KiB.
+    conn.execute('PRAGMA mmap_size = ' + str(1024 * 1024 * mmap_size_mb) + ';')
+    return conn
+
+
+def connect_in_memory(db_file):
+    """Returns a connection to a new in-memory database containing a copy of `db_file` (if it exists), so an import
+    staged in memory can still resume or append to earlier data.
+
+    FTS5 virtual tables (e.g. the `message_text` search index) are created again, which creates their shadow tables,
+    and refilled through the virtual table (see _copy_fts5()).
+    """
+    conn = sqlite3.connect(':memory:')
+    if not os.path.isfile(db_file):
+        return conn
+
+    conn.execute('ATTACH DATABASE ? AS disk;', (db_file,))
+    c = conn.cursor()
+    c.execute("""SELECT type, name, sql FROM disk.sqlite_master WHERE sql NOT NULL AND name NOT LIKE 'sqlite_%'
+        ORDER BY type = 'index';""")  # Tables are created (and filled) before indexes.
+    objects = c.fetchall()
+    virtual_tables = [name for object_type, name, sql in objects if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+    shadow_tables = set([name + suffix for name in virtual_tables for suffix in FTS5_SHADOW_TABLES])
+    for object_type, name, sql in objects:
+        if name in shadow_tables:
+            continue
+        conn.execute(sql)
+        if name in virtual_tables:
+            _copy_fts5(conn, name)
+        elif object_type == 'table':
+            conn.execute('INSERT INTO main.`' + name + '` SELECT * FROM disk.`' + name + '`;')
+    c.execute('''PRAGMA disk.user_version;''')  # The import generation (see bump_generation()).
+    conn.execute('''PRAGMA main.user_version = %d;''' % c.fetchone()[0])
+    conn.commit()
+    conn.execute('DETACH DATABASE disk;')
+
+    return conn
+
+
+def _copy_fts5(conn, name):
+    """Copies the configuration options (e.g. "rank") and rows of FTS5 table `name` from the attached `disk` database in
+    to the (new, empty) table of the same name in the main database.
+    """
+    c = conn.cursor()
+    c.execute('SELECT k, v FROM disk.`' + name + '_config` WHERE k != \'version\';')
+    for key, value in c.fetchall():
+        conn.execute('INSERT INTO main.`' + name + '`(`' + name + '`, rank) VALUES(?, ?);', (key, value))
+
+    c.execute('PRAGMA disk.table_info(`' + name + '`);')
+    columns = ', '.join(['rowid'] + ['`' + row[1] + '`' for row in c.fetchall()])
+    conn.execute('INSERT INTO main.`' + name + '`(' + columns + ') SELECT ' + columns + ' FROM disk.`' + name + '`;')
+
+
+def save_in_memory(conn, db_file):
+    """Writes in-memory database `conn` to `db_file`, replacing it. The copy is made with VACUUM INTO (SQLite 3.27+) in
+    to a temporary file next to `db_file`, which is then renamed, so `db_file` is never left half-written.
+    """
+    temp_file = db_file + '.tmp'
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    conn.execute('VACUUM INTO ?;', (temp_file,))
+    for suffix in ['-wal', '-shm']:  # Stale write-ahead log files would otherwise be applied to the new file.
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+    os.rename(temp_file, db_file)
@@ -0,0 +1,222 @@
+"""takeout_inspector/facts.py
+
+Defines a columnar, in-memory copy of message data used to compute graphs with NumPy.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Only the "sql" graph engine can be used.
+
+__all__ = ['MessageFacts', 'bucket_counts']
+
+# Number of rows fetched from sqlite at a time while loading facts.
+FETCH_SIZE = 65536
+
+
+class MessageFacts(object):
+    """The `messages` table (and message labels) of an imported database, loaded once in to NumPy arrays, one per
+    column, so that each graph takes a few vectorized operations (bincount(), digitize(), ...) instead of an SQL query
+    and a Python loop over its results. Used by mail.Graph and talk.Graph when the `engine` setting of the [report]
+    section is "numpy".
+
+    Grouping columns ("dow", "hour", "year_month", "from_id" and "thread") are stored as dense integer codes, with
+    code 0 standing for NULL (except for "thread"), so grouping by one is a single bincount() (see count()).
+    `values[column]` maps codes back to column values. Boolean columns (`dated`, `is_chat`, `is_sent`, `from_owner` and
+    `not_from_owner`) select messages.
+
+    Keyword arguments:
+        owner_id -- Address id of the owner of the account (see Graph.owner_id), or None if unknown.
+        label_ids -- Dict of label -> label id (see Graph.label_ids).
+    """
+    def __init__(self, conn, owner_id=None, label_ids=None):
+        if np is None:
+            raise ValueError('The "numpy" graph engine requires the numpy package.')
+        self.conn = conn
+        self.label_ids = label_ids or {}
+
+        table = _fetch_array(conn, '''SELECT message_key, epoch IS NOT NULL, IFNULL(epoch, 0), IFNULL(from_id, -1),
+            CAST(gmail_thread_id AS INTEGER), IFNULL(size, 0), is_chat, is_sent
+            FROM messages
+            ORDER BY message_key;''', 8)
+        self.keys = table[:, 0]
+        self.dated = table[:, 1] == 1
+        self.epoch = table[:, 2]
+        from_id = table[:, 3]
+        self.size = table[:, 5]
+        self.is_chat = table[:, 6] == 1
+        self.is_sent = table[:, 7] == 1
+        # Like `from_id = ?` and `from_id IS NOT ?` in SQL: when the owner is unknown, no message is from the owner and
+        # only messages without a sender are not from someone other than the owner.
+        self.from_owner = from_id == (owner_id if owner_id is not None else -2)
+        self.not_from_owner = from_id != (owner_id if owner_id is not None else -1)
+
+        self.codes = {}
+        self.values = {}
+        self._add_dated('dow', (np.floor_divide(self.epoch, 86400) + 4) % 7, range(7))  # 1970-01-01 was a Thursday.
+        self._add_dated('hour', np.floor_divide(self.epoch, 3600) % 24, range(24))
+        months = self.epoch.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)  # Since January 1970.
+        first_month, last_month = (months[self.dated].min(), months[self.dated].max()) if self.dated.any() else (0, -1)
+        self._add_dated('year_month', months - first_month, ['%04d-%02d' % (1970 + month // 12, month % 12 + 1)
+                                                             for month in range(first_month, last_month + 1)])
+        self.codes['from_id'] = from_id + 1
+        self.values['from_id'] = [None] + range(from_id.max() + 1 if len(from_id) else 0)
+        threads, self.codes['thread'] = np.unique(table[:, 4], return_inverse=True)
+        self.values['thread'] = threads.tolist()
+
+        self.label_pairs = None  # (message position, label id) arrays, loaded by label_counts().
+
+    def count(self, column, where=None, weights=None):
+        """Returns an array of the number of messages (or the sum of `weights`, an array with one value per message)
+        for each code of grouping column `column`, among the messages selected by boolean array `where` (or all of
+        them).
+        """
+        codes = self.codes[column]
+        if where is not None:
+            codes = codes[where]
+            weights = weights[where] if weights is not None else None
+        counts = np.bincount(codes, weights, len(self.values[column]))
+        return counts if weights is None else counts.astype(np.int64)
+
+    def group_by(self, column, where=None, counts=(), sums=()):
+        """Returns a list of rows like those of an SQL `GROUP BY column ORDER BY column` query over the messages
+        selected by boolean array `where` (or all of them): one row per value of `column` (None, for NULL, first) with
+        the value followed by the number of selected messages for which each boolean array in `counts` is True and by
+        the sum of each array in `sums`.
+        """
+        present = np.flatnonzero(self.count(column, where))
+        columns = [self.count(column, where, flags.astype(np.int64)) for flags in counts] + \
+                  [self.count(column, where, values) for values in sums]
+        names = self.values[column]
+        return [(names[code],) + tuple(int(amounts[code]) for amounts in columns) for code in present]
+
+    def top(self, column, amounts, limit, where=None, others=()):
+        """Returns a list of (value, amount) tuples for the (up to) `limit` values of grouping column `column` with the
+        largest `amounts` (an array from count()), largest first, like an SQL `GROUP BY column ORDER BY amount DESC
+        LIMIT limit` query over the messages selected by boolean array `where` (or all of them). Ties are broken by the
+        column value. Each tuple also holds the amount, for the same value, in each array in `others`.
+        """
+        present = np.flatnonzero(self.count(column, where))
+        names = self.values[column]
+        return [(names[code],) + tuple(int(column_amounts[code]) for column_amounts in [amounts] + list(others))
+                for code in present[np.argsort(-amounts[present], kind='mergesort')[:limit]]]
+
+    def threads(self, where=None):
+        """Returns two arrays with, for each thread among the messages selected by boolean array `where` (or all of
+        them), the number of selected messages in the thread and the seconds between the first and last of them (NaN
+        if none of them is dated).
+        """
+        codes, epoch, dated = self.codes['thread'], self.epoch, self.dated
+        if where is not None:
+            codes, epoch, dated = codes[where], epoch[where], dated[where]
+        counts = np.bincount(codes, minlength=len(self.values['thread']))
+        present = np.flatnonzero(counts)
+        if not len(present):
+            return counts[present], np.zeros(0)
+
+        order = np.argsort(codes, kind='mergesort')
+        starts = np.searchsorted(codes[order], present)
+        limits = np.iinfo(np.int64)
+        first = np.minimum.reduceat(np.where(dated, epoch, limits.max)[order], starts)
+        last = np.maximum.reduceat(np.where(dated, epoch, limits.min)[order], starts)
+        return counts[present], np.where(first <= last, (last - first).astype(float), np.nan)
+
+    def label_counts(self, where=None):
+        """Returns a dict of label -> number of messages, among those selected by boolean array `where` (or all of
+        them), with the label.
+        """
+        if self.label_pairs is None:
+            pairs = _fetch_array(self.conn, '''SELECT message_key, label_id FROM message_labels;''', 2)
+            positions, found = self._positions(pairs[:, 0])
+            self.label_pairs = positions[found], pairs[found, 1]
+
+        positions, label_ids = self.label_pairs
+        if where is not None:
+            label_ids = label_ids[where[positions]]
+        counts = np.bincount(label_ids)
+        labels = dict((label_id, label) for label, label_id in self.label_ids.items())
+        return dict((labels[label_id], int(counts[label_id])) for label_id in np.flatnonzero(counts))
+
+    def with_addresses(self, rows):
+        """Returns `rows` (e.g. from top("from_id", ...)) with the address id at the start of each row replaced by the
+        name and address from the `addresses` table. Like an SQL JOIN, rows without a known address are left out.
+        """
+        address_ids = [row[0] for row in rows if row[0] is not None]
+        c = self.conn.cursor()
+        c.execute('''SELECT address_id, name, address FROM addresses
+            WHERE address_id IN (''' + ', '.join(['?'] * len(address_ids)) + ''');''', address_ids)
+        addresses = dict((address_id, (name, address)) for address_id, name, address in c.fetchall())
+        return [addresses[row[0]] + tuple(row[1:]) for row in rows if row[0] in addresses]
+
+    @staticmethod
+    def value_counts(values):
+        """Returns a dict of value -> number of occurrences of each distinct value in array `values`.
+        """
+        distinct, counts = np.unique(values, return_counts=True)
+        return dict(zip(distinct.tolist(), counts.tolist()))
+
+    def _add_dated(self, column, values, names):
+        """Stores `values` (codes from zero, only meaningful for dated messages) as grouping column `column`, with code
+        0 for undated messages. `names` are the column values of codes 1 onwards.
+        """
+        self.codes[column] = np.where(self.dated, values + 1, 0)
+        self.values[column] = [None] + list(names)
+
+    def _positions(self, keys):
+        """Returns the positions of message keys `keys` in self.keys and a boolean array of those that were found.
+        """
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return np.minimum(positions, max(len(self.keys) - 1, 0)), found
+
+
+def bucket_counts(values, bounds):
+    """Returns a list of the number of `values` in each of the buckets delimited by ascending `bounds`: values up to
+    (and including) bounds[0], those up to bounds[1] and so on, then those above bounds[-1]. Values can be a list (in
+    which None counts as less than any bound) or a NumPy array (in which NaN does).
+    """
+    if np is not None and isinstance(values, np.ndarray):
+        buckets = np.digitize(np.where(np.isnan(values), -np.inf, values), bounds, right=True)
+        return np.bincount(buckets, minlength=len(bounds) + 1).tolist()
+
+    counts = [0] * (len(bounds) + 1)
+    for value in values:
+        counts[bisect_left(bounds, value)] += 1
+    return counts
+
+
+def _fetch_array(conn, sql, columns, parameters=()):
+    """Returns the (integer) results of query `sql` as a two-dimensional NumPy array with `columns` columns. Rows are
+    fetched FETCH_SIZE at a time, so they are never all held as Python tuples.
+    """
+    c = conn.cursor()
+    c.execute(sql, parameters)
+    chunks = [np.zeros((0, columns), dtype=np.int64)]
+    rows = c.fetchmany(FETCH_SIZE)
+    while rows:
+        chunks.append(np.array(rows, dtype=np.int64))
+        rows = c.fetchmany(FETCH_SIZE)
+    return np.concatenate(chunks)
@@ -27,39 +27,210 @@ SOFTWARE.
 import calendar
 import ConfigParser
 import email
-import mailbox
-import names
+import email.header
+import email.utils
+import multiprocessing
+import os
 import plotly.graph_objs as pgo
 import re
 import sqlite3
+import time
 import wordcloud as wc
 
+from .anonymize import Anonymizer, database_secret
+from .context import ReportContext
+from .facts import bucket_counts
+from .db import (BatchWriter, apply_load_profile, build_indexes, bump_generation, connect_in_memory, finish_load,
+                 save_in_memory)
+from .mbox import MboxReader, find_mbox_files, hash_head, is_compressed, split_ranges
+from .stats import ImportStats, timed
 from .utils import *
-from collections import OrderedDict
+from collections import defaultdict, deque, OrderedDict
 from datetime import datetime
+from itertools import islice
 
 __all__ = ['Import', 'Graph']
 
+# Indexes built once messages are loaded, as (name, table, columns). Between them they cover the filters, joins and
+# groupings used by the Mail and Talk graphs.
+INDEX_PLAN = [
+    ('id_date', 'messages', '`date` DESC'),
+    ('is_chat_gmail_thread_id', 'messages', 'is_chat, gmail_thread_id, epoch'),
+    ('is_chat_is_sent_from_id', 'messages', 'is_chat, is_sent, from_id, size'),
+    ('year_month', 'messages', 'year_month'),
+    ('from_id', 'messages', 'from_id'),
+    ('message_key_address_id', 'recipients', 'message_key, address_id'),
+    ('address_id_message_key', 'recipients', 'address_id, message_key'),
+    ('label_id_message_key', 'message_labels', 'label_id, message_key'),
+    ('header_id_message_key', 'headers', 'header_id, message_key'),
+    ('content_type_filename', 'parts', 'content_type, filename, encoded_size'),
+]
+
+# Matches the Gmail message id in the "From " lines of Takeout mbox files (e.g. "1543289045311029317@xxx Mon Jan 04").
+GMAIL_FROM_LINE = re.compile(r'^(\d+)@xxx ')
+
+
+class _Record(object):
+    """Base class for slotted records passed between Import's worker processes and the main process.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return [getattr(self, attribute) for attribute in self.__slots__]
+
+    def __setstate__(self, state):
+        for attribute, value in zip(self.__slots__, state):
+            setattr(self, attribute, value)
+
+
+class ParsedMessage(_Record):
+    """Data parsed from a single message's headers, ready to be inserted by Import. Parsing does not depend on any
+    Import state so it can be done in worker processes (see Import.jobs).
+
+    Addresses are lists of (name, address) tuples with decoded names and normalized addresses (see _parse_addresses()).
+    Anonymization is applied later, by Import, so that address_key remains consistent across workers. `end` is the byte
+    offset in the mbox file immediately following the message. `epoch` is the message date as a Unix timestamp (or None
+    if the date is unknown). `gmail_message_id` and `message_id` identify the message when it appears in more than one
+    mbox file (see _gmail_message_id()). `size` is the size of the raw message in bytes and `parts` is a list of
+    (content type, filename, encoded size) tuples for its MIME parts. `text` is the plain text body of the message, if
+    it was extracted for the search index.
+    """
+    __slots__ = ('key', 'end', 'size', 'senders', 'to', 'cc', 'subject', 'date', 'epoch', 'thread_id',
+                 'gmail_message_id', 'message_id', 'labels', 'headers', 'parts', 'text')
+
+    def __init__(self, key, end, size, senders, to, cc, subject, date, epoch, thread_id, gmail_message_id, message_id,
+                 labels, headers, parts, text=None):
+        self.key = key
+        self.end = end
+        self.size = size
+        self.senders = senders
+        self.to = to
+        self.cc = cc
+        self.subject = subject
+        self.date = date
+        self.epoch = epoch
+        self.thread_id = thread_id
+        self.gmail_message_id = gmail_message_id
+        self.message_id = message_id
+        self.labels = labels
+        self.headers = headers
+        self.parts = parts
+        self.text = text
+
+
+class QuarantinedMessage(_Record):
+    """A message that could not be parsed. The error and the raw header block are kept for the `quarantine` table so
+    the rest of the import can continue.
+    """
+    __slots__ = ('key', 'start', 'end', 'error', 'headers')
+
+    def __init__(self, key, start, end, error, headers):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.error = error
+        self.headers = headers
+
+
+class KnownMessage(_Record):
+    """A message that was passed over, without being parsed, because it has already been imported (see
+    Import._is_known()). Only its position is kept, for the import checkpoint.
+    """
+    __slots__ = ('key', 'end')
+
+    def __init__(self, key, end):
+        self.key = key
+        self.end = end
+
+
+class KnownMessageFilter(object):
+    """MboxReader `skip` function for Import's worker processes. Returns True for "From " lines with a Gmail message id
+    (see _gmail_message_id()) that is already in the `messages` table of database file `db_file`. Only the file name is
+    pickled and the database is opened on first use.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = None
+
+    def __getstate__(self):
+        return self.db_file
+
+    def __setstate__(self, db_file):
+        self.__init__(db_file)
+
+    def __call__(self, from_line):
+        gmail_message_id = _gmail_message_id(from_line)
+        if gmail_message_id is None:
+            return False
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_file)
+        c = self.conn.cursor()
+        c.execute('''SELECT 1 FROM messages WHERE gmail_message_id = ? LIMIT 1;''', (gmail_message_id,))
+        return c.fetchone() is not None
+
 
 class Import:
     """Parses and imports Google Takeout mbox file data in to sqlite.
+
+    Any number of mbox files can be imported in to the same database, e.g. the separate files of one export or
+    successive exports of the same mailbox. Message keys are unique across all of them and messages that have already
+    been imported, from any file, are skipped (see _is_known()).
+
+    Keyword arguments:
+        jobs -- Number of worker processes used to parse the mbox files. With more than one job, each mbox file is split
+                in to byte ranges (of about `chunk_size` bytes) aligned to "From " lines and each range is parsed in a
+                worker. Ranges of all files share the same workers, so several files are parsed at once. Rows are still
+                written, in file and mbox order, by this process so message keys and address_key are the same as for a
+                serial import. Defaults to the `jobs` setting in the [mail] section.
+        progress -- Function called with the ImportStats of the running import (see self.stats) about every
+                    `progress_interval` seconds while messages are imported, after each index is built and once the
+                    import is finished (when stats.phase is "done").
+        mbox_files -- Path of an mbox file or folder of mbox files, or a list of them (see find_mbox_files()).
+                      Defaults to the `mbox_file` setting in the [mail] section.
     """
-    def __init__(self, settings_file='settings.cfg'):
+    chunk_size = 32 * 1024 * 1024  # Approximate size (in bytes) of the mbox ranges handed to each worker.
+    batch_messages = 2000  # Number of messages handed to each worker at a time when reading a compressed mbox.
+    progress_interval = 1.0  # Minimum number of seconds between progress calls while messages are imported.
+
+    def __init__(self, settings_file='settings.cfg', jobs=None, progress=None, mbox_files=None):
         self.config = ConfigParser.ConfigParser()
         self.config.readfp(open('settings.defaults.cfg'))
         self.config.read([settings_file])
 
-        self.email = mailbox.mbox(self.config.get('mail', 'mbox_file'))
-        self.conn = sqlite3.connect(self.config.get('mail', 'db_file'))
+        self.mbox_files = find_mbox_files(mbox_files or self.config.get('mail', 'mbox_file'))
+        self.stage_in_memory = self.config.getboolean('mail', 'stage_in_memory')
+        if self.stage_in_memory:
+            self.conn = connect_in_memory(self.config.get('mail', 'db_file'))
+        else:
+            self.conn = sqlite3.connect(self.config.get('mail', 'db_file'))
+        apply_load_profile(self.conn, self.config.get('mail', 'load_profile'), self.config.getint('mail', 'cache_size'))
+        self.jobs = jobs or self.config.getint('mail', 'jobs')
+        self.progress = progress
+        self.stats = None
+        self.next_key = 0
+        self.uncommitted_ids = set()  # Ids (see _is_known()) of messages inserted since the last commit.
+        self.owner = self.config.get('mail', 'owner')
+        self.rollup = {}  # `message_rollup` key -> number of messages inserted since the last commit.
 
         self.address_key = {}
+        self.domain_ids = {}
+        self.label_key = {}
+        self.header_key = {}
 
-        self.anonymize = self.config.getboolean('mail', 'anonymize')
-        if self.anonymize:
-            self.domain_key = {}
+        self.stored_headers = _stored_headers(self.config.get('mail', 'headers'))
+        self.search_index = self.config.getboolean('mail', 'search_index')
 
         self._create_tables()
-        self.query_count = 0
+
+        self.anonymize = self.config.getboolean('mail', 'anonymize')
+        if self.anonymize:
+            self.anonymizer = Anonymizer(self.config.get('mail', 'anonymize_secret') or database_secret(self.conn))
+        self.writer = BatchWriter(
+            self.conn,
+            batch_size=self.config.getint('mail', 'batch_size'),
+            commit_size=self.config.getint('mail', 'commit_size'),
+            commit_interval=self.config.getfloat('mail', 'commit_interval'),
+        )
 
     def _create_tables(self):
         """Creates the required tables for message data storage. Indexes will be added after data import.
@@ -69,184 +240,582 @@ class Import:
         c.execute('''
             CREATE TABLE IF NOT EXISTS messages(
               message_key INT PRIMARY KEY,
+              from_id INT,
               `from` TEXT,
               `to` TEXT,
               subject TEXT,
               `date` DATETIME,
+              epoch INT,
+              year_month TEXT,
+              dow INT,
+              hour INT,
+              gmail_message_id INT,
               gmail_thread_id INT,
-              gmail_labels TEXT
+              gmail_labels TEXT,
+              message_id TEXT,
+              size INT,
+              is_chat INT,
+              is_sent INT,
+              from_owner INT,
+              FOREIGN KEY(from_id) REFERENCES addresses(address_id)
+             );
+        ''')
+        # Unlike the indexes in INDEX_PLAN, these are needed while importing, to skip messages already imported.
+        c.execute('''CREATE INDEX IF NOT EXISTS gmail_message_id ON messages(gmail_message_id);''')
+        c.execute('''CREATE INDEX IF NOT EXISTS message_id ON messages(message_id);''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS header_names(
+              header_id INTEGER PRIMARY KEY,
+              header TEXT UNIQUE
              );
         ''')
         c.execute('''
              CREATE TABLE IF NOT EXISTS headers(
               message_key INT,
-              header TEXT,
+              header_id INT,
               value TEXT,
               FOREIGN KEY(message_key) REFERENCES messages(message_key)
              );
         ''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS parts(
+              message_key INT,
+              content_type TEXT,
+              filename TEXT,
+              encoded_size INT,
+              FOREIGN KEY(message_key) REFERENCES messages(message_key)
+             );
+        ''')
         c.execute('''
              CREATE TABLE IF NOT EXISTS recipients(
               message_key INT,
-              name TEXT,
-              address TEXT,
+              address_id INT,
               header TEXT,
-              FOREIGN KEY(message_key) REFERENCES messages(message_key)
+              FOREIGN KEY(message_key) REFERENCES messages(message_key),
+              FOREIGN KEY(address_id) REFERENCES addresses(address_id)
+             );
+        ''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS domains(
+              domain_id INTEGER PRIMARY KEY,
+              domain TEXT UNIQUE
+             );
+        ''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS addresses(
+              address_id INTEGER PRIMARY KEY,
+              address TEXT,
+              name TEXT,
+              domain_id INT,
+              FOREIGN KEY(domain_id) REFERENCES domains(domain_id)
              );
         ''')
 
-        if self.anonymize:
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS labels(
+              label_id INTEGER PRIMARY KEY,
+              label TEXT UNIQUE
+             );
+        ''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS message_labels(
+              message_key INT,
+              label_id INT,
+              PRIMARY KEY(message_key, label_id),
+              FOREIGN KEY(message_key) REFERENCES messages(message_key),
+              FOREIGN KEY(label_id) REFERENCES labels(label_id)
+             ) WITHOUT ROWID;
+        ''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS address_key(
+              real_address TEXT,
+              anon_address TEXT,
+              real_name TEXT,
+              anon_name TEXT,
+              address_id INT,
+              FOREIGN KEY(address_id) REFERENCES addresses(address_id)
+             );
+        ''')
+
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS import_state(
+              mbox_file TEXT PRIMARY KEY,
+              size INT,
+              mtime REAL,
+              head_hash TEXT,
+              `offset` INT,
+              next_key INT,
+              complete INT
+             );
+        ''')
+        c.execute('''
+             CREATE TABLE IF NOT EXISTS quarantine(
+              message_key INT PRIMARY KEY,
+              mbox_file TEXT,
+              start INT,
+              `end` INT,
+              error TEXT,
+              headers BLOB
+             );
+        ''')
+
+        if self.search_index:
+            c.execute('''SELECT COUNT(*) FROM sqlite_master WHERE name = 'message_text';''')
+            if not c.fetchone()[0]:
+                # Full-text search index (see search.Search) with message_key as the rowid. Matches in subjects rank
+                # twice as high as matches in bodies.
+                c.execute('''CREATE VIRTUAL TABLE message_text USING fts5(subject, body);''')
+                c.execute('''INSERT INTO message_text(message_text, rank) VALUES('rank', 'bm25(2.0, 1.0)');''')
+
+        c.execute('''PRAGMA table_info(messages);''')
+        if 'is_chat' not in [row[1] for row in c.fetchall()]:  # Messages imported before the flag columns existed.
+            for column in ['is_chat', 'is_sent', 'from_owner']:
+                c.execute('ALTER TABLE messages ADD COLUMN ' + column + ' INT;')
+            c.execute('''UPDATE messages SET
+                is_chat = message_key IN (SELECT message_key FROM message_labels
+                  WHERE label_id = (SELECT label_id FROM labels WHERE label = 'Chat')),
+                is_sent = message_key IN (SELECT message_key FROM message_labels
+                  WHERE label_id = (SELECT label_id FROM labels WHERE label = 'Sent')),
+                from_owner = CASE WHEN from_id NOTNULL
+                  THEN IFNULL(from_id = (SELECT address_id FROM address_key WHERE real_address = ?), 0)
+                END;''', (self.owner,))
+
+        c.execute('''PRAGMA table_info(message_rollup);''')
+        rollup_columns = [row[1] for row in c.fetchall()]
+        if 'is_sent' in rollup_columns:  # Rollups from before the column was renamed to from_owner are rebuilt.
+            c.execute('''DROP TABLE message_rollup;''')
+        if not rollup_columns or 'is_sent' in rollup_columns:
+            # Number of messages by UTC day and hour, chat label and whether they were sent by the owner (from_owner in
+            # `messages`, so NULL for messages without a sender), kept up to date as messages are imported (see
+            # _write_rollup()) so graphs of activity over time do not have to scan `messages`.
             c.execute('''
-                 CREATE TABLE IF NOT EXISTS address_key(
-                  real_address TEXT,
-                  anon_address TEXT,
-                  real_name TEXT,
-                  anon_name TEXT
+                 CREATE TABLE message_rollup(
+                  day TEXT,
+                  hour INT,
+                  dow INT,
+                  is_chat INT,
+                  from_owner INT,
+                  count INT
                  );
             ''')
+            c.execute('''CREATE INDEX message_rollup_key ON message_rollup(day, hour, is_chat, from_owner);''')
+            # Messages imported before the table existed.
+            c.execute('''INSERT INTO message_rollup
+                SELECT date(epoch, 'unixepoch') AS day, hour, dow, is_chat, from_owner, COUNT(*)
+                FROM messages
+                GROUP BY day, hour, is_chat, from_owner;''')
 
         self.conn.commit()
 
     def import_messages(self):
         """Imports message details in to the `messages` table and all message headers in to the `headers` table.
+
+        Progress is checkpointed, per mbox file, in the `import_state` table with every commit. If a previous import of
+        an mbox file was interrupted, importing resumes from the last checkpoint. If an mbox file has grown since it was
+        last imported (e.g. a newer export of the same mailbox), only the new messages are read. Messages already in the
+        database (e.g. from an earlier, overlapping export) are skipped, so merging a new export costs time in
+        proportion to its new messages. Messages that cannot be parsed are added to the `quarantine` table instead of
+        stopping the import.
+
+        If the `search_index` setting is enabled, subjects and plain text bodies are also added to the `message_text`
+        full-text search index (see search.Search) as messages are imported. Only one message body is read at a time.
+
+        Statistics for the import are kept in self.stats (see ImportStats) and, if the `stats_file` setting is set,
+        saved there as JSON once the import is finished.
+        """
+        positions = OrderedDict()  # Mbox file -> byte offset to import from, for files not fully imported yet.
+        for path in self.mbox_files:
+            offset = self._resume_position(path)
+            if offset is not None:
+                positions[path] = offset
+        self.stats = ImportStats(None if any(is_compressed(path) for path in positions)
+                                 else sum(os.path.getsize(path) - offset for path, offset in positions.items()),
+                                 self.config.getboolean('mail', 'trace_memory'))
+        self.writer.timings = stages = self.stats.stages
+        if not positions:  # All mbox files have already been fully imported.
+            self._finish_load()
+            return
+        self.next_key = self._next_key()
+        if self.next_key > 0:
+            self._load_address_key()
+            self._load_label_key()
+            self._load_header_key()
+
+        offsets, last_progress = positions.copy(), time.time()
+        for path, message in self._parse_messages(positions):
+            started, excluded = time.time(), stages['anonymize'] + stages['write']
+            if isinstance(message, KnownMessage):
+                self.stats.duplicates += 1
+            elif isinstance(message, QuarantinedMessage):
+                message.key = self._new_key()
+                self.writer.insert('quarantine', (message.key, os.path.abspath(path), message.start, message.end,
+                                                  message.error, sqlite3.Binary(message.headers)))
+                self.stats.quarantined += 1
+            else:
+                if self.anonymize and message.message_id:  # Anonymized the same way every time, for _is_known().
+                    with self.stats.timer('anonymize'):
+                        message.message_id = self.anonymizer.anonymize_message_id(message.message_id)
+                if self._is_known(message.gmail_message_id, message.message_id):
+                    message = KnownMessage(message.key, message.end)
+                    self.stats.duplicates += 1
+                else:
+                    message.key = self._new_key()
+                    self.uncommitted_ids.update([message.gmail_message_id, message.message_id])
+                    self._insert_messages(message)
+                    self._insert_labels(message)
+                    self._insert_headers(message)
+                    self._insert_recipients(message)
+                    self._insert_parts(message)
+            self.stats.messages += 1
+            stages['insert'] += time.time() - started - (stages['anonymize'] + stages['write'] - excluded)
+
+            if self.search_index and isinstance(message, ParsedMessage):
+                with self.stats.timer('search'):  # Not batched, so bodies are not held in memory.
+                    self.conn.execute('''INSERT INTO message_text(rowid, subject, body) VALUES(?, ?, ?);''',
+                                      (message.key, message.subject, message.text))
+
+            offsets[path] = message.end
+            if self.writer.commit_due():
+                for checkpoint_path in positions:
+                    if offsets[checkpoint_path] > positions[checkpoint_path]:
+                        self._save_state(checkpoint_path, offsets[checkpoint_path], False)
+                self._write_rollup()
+                self.writer.commit()
+                self.uncommitted_ids.clear()
+
+            if self.progress and time.time() - last_progress >= self.progress_interval:
+                self.stats.bytes = sum(offsets[path] - positions[path] for path in positions)
+                self._report_progress()
+                last_progress = time.time()
+
+        self.stats.bytes = sum(offsets[path] - positions[path] for path in positions)
+        for path in positions:
+            self._save_state(path, offsets[path], True)
+        self._write_rollup()
+        self.writer.commit()
+        self.uncommitted_ids.clear()
+
+        self.stats.phase = 'index'
+        build_indexes(self.conn, INDEX_PLAN, self._index_built)
+        if self.search_index:  # Merges the index segments written during the import, which speeds up searches.
+            started = time.time()
+            self.conn.execute('''INSERT INTO message_text(message_text) VALUES('optimize');''')
+            self.conn.commit()
+            self._index_built('message_text', len(INDEX_PLAN) + 1, len(INDEX_PLAN) + 1, time.time() - started)
+        self._finish_load()
+
+    def _index_built(self, name, number, total, seconds):
+        """Records the time taken to build an index (see build_indexes()).
+        """
+        self.stats.indexes[name] = seconds
+        self.stats.stages['index'] += seconds
+        self._report_progress()
+
+    def _report_progress(self):
+        """Samples memory use and passes self.stats to the `progress` function, if there is one.
+        """
+        if self.progress:
+            self.stats.sample_memory()
+            self.progress(self.stats)
+
+    def _finish_load(self):
+        """Runs ANALYZE (and VACUUM, if enabled) and restores safe database settings. When staging in memory, the
+        database is then written to db_file. Finally, import statistics are recorded (and saved to `stats_file`).
+        """
+        self.stats.phase = 'finish'
+        with self.stats.timer('finish'):
+            bump_generation(self.conn)
+            if self.stage_in_memory:  # VACUUM INTO already produces a compact file.
+                finish_load(self.conn)
+                save_in_memory(self.conn, self.config.get('mail', 'db_file'))
+            else:
+                finish_load(self.conn, self.config.getboolean('mail', 'vacuum'))
+
+        self.stats.caches = dict((function.__name__, function.cache_info()._asdict())
+                                 for function in [_decode_header, _parse_addresses])
+        self.stats.finish()
+        if self.config.get('mail', 'stats_file'):
+            self.stats.save(self.config.get('mail', 'stats_file'))
+        self._report_progress()
+
+    def _resume_position(self, path):
+        """Returns the byte offset to begin importing mbox file `path` from, based on its `import_state` checkpoint, or
+        None if the file has not changed since it was fully imported. A file that no longer begins with the same data
+        as when it was last imported (e.g. it was replaced by a newer export) is imported from the start.
         """
         c = self.conn.cursor()
+        c.execute('''SELECT size, head_hash, `offset`, complete FROM import_state WHERE mbox_file = ?;''',
+                  (os.path.abspath(path),))
+        state = c.fetchone()
+        if state is None:
+            return 0
+
+        size, head_hash, offset, complete = state
+        current_size = os.path.getsize(path)
+        if current_size < size or hash_head(path, size) != head_hash:
+            return 0
+        if complete and current_size == size:
+            return None
+        return offset
+
+    def _save_state(self, path, offset, complete):
+        """Records the import position in mbox file `path` in `import_state`. Should be committed along with the rows
+        it describes.
+        """
+        stat = os.stat(path)
+        self.conn.execute('''INSERT OR REPLACE INTO import_state VALUES(?, ?, ?, ?, ?, ?, ?);''',
+                          (os.path.abspath(path), stat.st_size, stat.st_mtime, hash_head(path, stat.st_size), offset,
+                           self.next_key, int(complete)))
 
-        for key, message in self.email.items():
-            self._insert_messages(c, key, message)
-            self._insert_headers(c, key, message)
-            self._insert_recipients(c, key, message)
+    def _write_rollup(self):
+        """Adds the counts in self.rollup to `message_rollup`. Should be committed along with the messages they count.
+        """
+        with self.stats.timer('write'):
+            c = self.conn.cursor()
+            for key, count in self.rollup.items():
+                day, hour, dow, is_chat, from_owner = key
+                c.execute('''UPDATE message_rollup SET count = count + ?
+                    WHERE day IS ? AND hour IS ? AND is_chat = ? AND from_owner IS ?;''',
+                          (count, day, hour, is_chat, from_owner))
+                if not c.rowcount:
+                    c.execute('''INSERT INTO message_rollup VALUES(?, ?, ?, ?, ?, ?);''', key + (count,))
+        self.rollup.clear()
+
+    def _next_key(self):
+        """Returns the message key following those of all messages (including quarantined ones) already imported.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT MAX(message_key) FROM (
+            SELECT MAX(message_key) AS message_key FROM messages
+            UNION ALL
+            SELECT MAX(message_key) FROM quarantine);''')
+        last_key = c.fetchone()[0]
+        return 0 if last_key is None else last_key + 1
+
+    def _new_key(self):
+        """Returns the next unused message key.
+        """
+        self.next_key += 1
+        return self.next_key - 1
 
-            if self.query_count > 1000000:
-                self.conn.commit()
-                self.query_count = 0
+    def _is_known(self, gmail_message_id, message_id):
+        """Returns True if a message with Gmail message id `gmail_message_id` or, for messages without one, Message-ID
+        `message_id` has already been imported. Both are looked up with an index, so the cost does not grow with the
+        size of the database.
+        """
+        if gmail_message_id is not None:
+            column, value = 'gmail_message_id', gmail_message_id
+        elif message_id:
+            column, value = 'message_id', message_id
+        else:
+            return False
 
-        if self.anonymize:
-            for address, address_info in self.address_key.iteritems():
-                c.execute('''INSERT INTO address_key VALUES(?, ?, ?, ?);''',
-                          (address_info['real_address'].decode('utf-8'), address_info['address'],
-                           self._decode_header(address_info['real_name']), address_info['name']))
+        if value in self.uncommitted_ids:
+            return True
+        c = self.conn.cursor()
+        c.execute('SELECT 1 FROM messages WHERE ' + column + ' = ? LIMIT 1;', (value,))
+        return c.fetchone() is not None
 
-        c.execute('''CREATE INDEX id_date ON messages (`date` DESC)''')
+    def _is_known_from_line(self, from_line):
+        """Returns True if the message with mbox "From " line `from_line` has already been imported (see _is_known()).
+        Used to skip reading known messages in the first place.
+        """
+        return self._is_known(_gmail_message_id(from_line), None)
 
-        self.conn.commit()
+    def _load_address_key(self):
+        """Restores self.address_key, self.domain_ids (and self.anonymizer) from the `address_key` and `domains` tables
+        so a resumed import keeps using the same names, anonymized addresses and ids.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT real_address, anon_address, real_name, anon_name, address_id FROM address_key;''')
+        for real_address, anon_address, real_name, anon_name, address_id in c.fetchall():
+            real_address = real_address.encode('utf-8')
+            if self.anonymize:
+                self.address_key[real_address] = {
+                    'real_address': real_address,
+                    'address': anon_address,
+                    'real_name': real_name,
+                    'name': anon_name,
+                    'id': address_id,
+                }
+                self.anonymizer.restore(real_address, anon_address)
+            else:
+                self.address_key[real_address] = {
+                    'address': real_address,
+                    'name': real_name,
+                    'id': address_id,
+                }
 
-    def _insert_recipients(self, c, key, message):
-        """Parses contents of the To and CC headers for unique email addresses to be added to the one-row-per-address
-        `recipients` table.
+        c.execute('''SELECT domain, domain_id FROM domains;''')
+        self.domain_ids = dict(c.fetchall())
+
+    def _load_label_key(self):
+        """Restores self.label_key from the `labels` table so a resumed import keeps using the same label ids.
         """
-        mail_all_to = message.get_all('To', [])
-        for name, address in self._parse_addresses(mail_all_to):
-            c.execute('''INSERT INTO recipients VALUES(?, ?, ?, ?);''',
-                      (key, self._decode_header(name), address.decode('utf-8'), 'To'))
-            self.query_count += 1
+        c = self.conn.cursor()
+        c.execute('''SELECT label, label_id FROM labels;''')
+        self.label_key = dict(c.fetchall())
 
-        mail_all_cc = message.get_all('CC', [])
-        for name, address in self._parse_addresses(mail_all_cc):
-            c.execute('''INSERT INTO recipients VALUES(?, ?, ?, ?);''',
-                      (key, self._decode_header(name), address.decode('utf-8'), 'CC'))
-            self.query_count += 1
+    def _load_header_key(self):
+        """Restores self.header_key from the `header_names` table so a resumed import keeps using the same header ids.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT header, header_id FROM header_names;''')
+        self.header_key = dict((header.encode('utf-8'), header_id) for header, header_id in c.fetchall())
+
+    def _parse_messages(self, positions):
+        """Yields (mbox file, ParsedMessage, QuarantinedMessage or KnownMessage) for each message in the mbox files of
+        `positions`, a dict of mbox file -> byte offset to start from, in file and mbox order. When self.jobs is greater
+        than one, parsing is done by a pool of worker processes, each handling one byte range of an mbox file at a time
+        (or, for a compressed mbox, one batch of `batch_messages` header records read by this process). At most two
+        tasks per worker are in flight at once to keep memory use bounded. Time spent reading and parsing (by this
+        process or by workers) is added to self.stats.
+
+        If the database already held messages, those with a known Gmail message id in their "From " line are passed
+        over as KnownMessage records without being parsed. Message keys are assigned later, by import_messages().
+        """
+        stages = self.stats.stages
+        skip = self._is_known_from_line if self.next_key > 0 else None
+        if self.jobs <= 1:
+            for path, offset in positions.items():
+                for message in timed(MboxReader(path, offset, text=self.search_index, skip=skip), stages, 'read'):
+                    yield path, _parse_or_quarantine(message, self.stored_headers, stages)
+            return
+
+        # Workers look up known messages in the database file, which includes everything committed so far (or, when
+        # staging in memory, everything imported before this import). This process checks the rest (see _is_known()).
+        known = KnownMessageFilter(self.config.get('mail', 'db_file')) if skip else None
+
+        def tasks():
+            for path, offset in positions.items():
+                if is_compressed(path):  # A compressed stream can only be read in order, by one process.
+                    for batch in _batches(timed(MboxReader(path, offset, text=self.search_index, skip=skip),
+                                                stages, 'read'), self.batch_messages):
+                        yield path, (_parse_batch, (batch, self.stored_headers))
+                else:
+                    for start, end in split_ranges(path, self.chunk_size, offset):
+                        yield path, (_parse_range, (path, start, end, self.stored_headers, self.search_index, known))
+        tasks = tasks()
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            pending = deque()
+            for path, (function, args) in islice(tasks, self.jobs * 2):
+                pending.append((path, pool.apply_async(function, args)))
+
+            while pending:
+                path, result = pending.popleft()
+                messages, timings = result.get()
+                self.stats.add(timings)
+                next_task = next(tasks, None)
+                if next_task is not None:
+                    pending.append((next_task[0], pool.apply_async(*next_task[1])))
+
+                for message in messages:
+                    yield path, message
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _insert_recipients(self, message):
+        """Adds the contents of the To and CC headers to the one-row-per-address `recipients` table.
+        """
+        for address in self._key_addresses(message.to):
+            self.writer.insert('recipients', (message.key, address['id'], 'To'))
 
-    def _insert_headers(self, c, key, message):
-        """Adds all headers to `headers`.
+        for address in self._key_addresses(message.cc):
+            self.writer.insert('recipients', (message.key, address['id'], 'CC'))
 
-        WARNING: Data in this table does _not_ currently respect the self.anonymize setting. This is meant to be a raw
-        record of all headers.
+    def _insert_parts(self, message):
+        """Adds one row per leaf MIME part of the message (e.g. its text, HTML and attachments) to `parts`.
+
+        WARNING: Attachment filenames do _not_ currently respect the self.anonymize setting (see anonymize_database()).
         """
-        for header, value in message.items():
-            c.execute('''INSERT INTO headers VALUES(?, ?, ?);''', (key, header, value.decode('utf-8')))
-            self.query_count += 1
+        for content_type, filename, encoded_size in message.parts:
+            self.writer.insert('parts', (message.key, content_type, filename, encoded_size))
 
-    def _insert_messages(self, c, key, message):
-        """Creates a basic index of important message data in `messages`.
+    def _insert_labels(self, message):
+        """Adds one row per Gmail label of the message to `message_labels`. Labels are added to the `labels` table
+        (and self.label_key) the first time they are seen. Nested labels (e.g. "Travel/2016") are kept as-is.
         """
-        mail_from = ''
-        for idx, address in enumerate(self._parse_addresses(message.get_all('From', []))):
-            mail_from += email.utils.formataddr(address) + ','  # Final ',' is removed at INSERT below.
-        mail_from = self._decode_header(mail_from)
+        for label in set(message.labels.split(',')) if message.labels else []:
+            if label not in self.label_key:
+                self.label_key[label] = len(self.label_key) + 1
+                self.writer.insert('labels', (self.label_key[label], label))
 
-        mail_to = ''
-        for idx, address in enumerate(self._parse_addresses(message.get_all('To', []))):
-            mail_to += email.utils.formataddr(address) + ','  # Final ',' is removed at INSERT below.
-        mail_to = self._decode_header(mail_to)
+            self.writer.insert('message_labels', (message.key, self.label_key[label]))
 
-        mail_subject = self._decode_header(message.get('Subject', ''))
-        mail_date_utc = self._get_message_date(message)
-        mail_gmail_id = message.get('X-GM-THRID', '')
-        mail_gmail_labels = self._decode_header(message.get('X-Gmail-Labels', ''))
+    def _insert_headers(self, message):
+        """Adds headers (all of them, or those set by the `headers` setting) to `headers`. Header names are stored
+        once in `header_names` and referenced by id.
 
-        c.execute('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?);''',
-                  (key, mail_from[:-1], mail_to[:-1], mail_subject, mail_date_utc, mail_gmail_id, mail_gmail_labels))
-        self.query_count += 1
+        WARNING: Data in this table does _not_ currently respect the self.anonymize setting. This is meant to be a raw
+        record of all headers.
+        """
+        for header, value in message.headers:
+            if header not in self.header_key:
+                self.header_key[header] = len(self.header_key) + 1
+                self.writer.insert('header_names', (self.header_key[header], header))
 
-    def _decode_header(self, header):
-        """Attempts to clean up a header:
-            1. Removes newline and tab characters.
-            2. Attempts to resole bad formatting.
-            3. Decodes the header (if the header starts with "=?", for example).
-            4. Recombines the decoded header in to a single unicode string.
+            self.writer.insert('headers', (message.key, self.header_key[header], value))
 
-        Badly formatted characters are ignored.
+    def _insert_messages(self, message):
+        """Creates a basic index of important message data in `messages` and counts the message in self.rollup (see
+        _write_rollup()).
 
-        TODO: Put email.header.decode_header() in a try and do something when it raises exceptions.
+        The is_chat and is_sent flags are set for messages with the "Chat" and "Sent" labels and from_owner is set for
+        messages whose (first) sender is the `owner` address (before anonymization, as in `address_key`). from_owner is
+        NULL for messages without a sender.
         """
-        if header:
-            header = ' '.join(header.split())  # Gets rid of newline and tab characters.
-            header = header.replace('?==?', '?= =?')  # Encoded words must be separated by a space.
-            header = email.header.decode_header(header)  # Handles UTF-8 and other encoded types.
-            header = ' '.join([unicode(t[0], t[1] or 'utf-8', 'ignore') for t in header])  # Recombines all pieces.
-        return header
+        senders = self._key_addresses(message.senders)
+        mail_from = ','.join([_format_address(address) for address in senders])
+        mail_to = ','.join([_format_address(address) for address in self._key_addresses(message.to)])
+        year_month, dow, hour = _date_columns(message.epoch)
+        labels = message.labels.split(',') if message.labels else []
+        is_chat = int('Chat' in labels)
+        from_owner = int(message.senders[0][1] == self.owner) if message.senders else None
+
+        self.writer.insert('messages', (message.key, senders[0]['id'] if senders else None, mail_from, mail_to,
+                                        message.subject, message.date, message.epoch, year_month, dow, hour,
+                                        message.gmail_message_id, message.thread_id, message.labels,
+                                        message.message_id, message.size, is_chat, int('Sent' in labels), from_owner))
+
+        rollup_key = (time.strftime('%Y-%m-%d', time.gmtime(message.epoch)) if message.epoch is not None else None,
+                      hour, dow, is_chat, from_owner)
+        self.rollup[rollup_key] = self.rollup.get(rollup_key, 0) + 1
 
     def _anonymize_address(self, address, name):
         """Turns a name and address in to an anonymized [address, anon_address, name, anon_name] dict and returns the
         result.
 
-        Additionally, self.domain_key is maintained so the domain can be anonymized consistently in order to allow for
-        potential querying of the database with domain-based grouping.
+        The domain is anonymized consistently in order to allow for potential querying of the database with domain-based
+        grouping (see Anonymizer).
         """
-        domain = address.split('@', 1)[1]
-        if domain not in self.domain_key:
-            self.domain_key[domain] = 'domain' + str(len(self.domain_key)) + '.tld'
-
-        anon_name = names.get_full_name()
+        with self.stats.timer('anonymize'):
+            anon_address, anon_name = self.anonymizer.anonymize(address)
 
         return {
             'real_address': address,
-            'address': anon_name.replace(' ', '-').lower() + '@' + self.domain_key[domain],
+            'address': anon_address,
             'real_name': name,
             'name': anon_name
         }
 
-    def _parse_addresses(self, addresses, unique=True):
-        """Turns a list of address strings (e.g. from email.Message.get_all()) in to a list of formatted [name, address]
-        tuples. Formatting does the following:
-            1) Removes XMPP Resourceparts (https://xmpp.org/rfcs/rfc6122.html).
-            2) Removes periods from the local part for @gmail.com addresses.
-            3) Converts the full address to lower case.
-
-        Also adds address information to self.address_key with address as the key (if it does not already exist). As a
-        side effect, this method will only use the first name it encounters for any particular email. Not ideal, but
-        also not a big deal as long as the actual unique identifer (the email) is preserved.
-
-        Keyword arguments:
-            unique -- Produces a list of unique entries by email address.
-        """
-        addresses = email.utils.getaddresses(addresses)
-        if unique:
-            addresses = list(set(addresses))
-
-        for idx, address in enumerate(addresses):
-            name = address[0]
-            try:
-                [local_part, domain] = address[1].split('@', 1)
-                domain = domain.split('/', 1)[0].lower()  # Removes Resourcepart and normalizes case.
-                local_part = local_part.lower()  # Normalizes to all lower case.
-                if domain in ['gmail.com']:  # Removes dots for services that disregard them.
-                    local_part = local_part.replace('.', '')
-                address = local_part + '@' + domain
-            except ValueError:  # Throws when the address does not have an @ anywhere in the string.
-                address = address[1] + '@domain-not-found.tld'
+    def _key_addresses(self, addresses):
+        """Turns a list of parsed (name, address) tuples (see _parse_addresses()) in to a list of self.address_key
+        entries (dicts with at least 'name', 'address' and 'id' keys).
 
+        Address information is added to self.address_key with address as the key (if it does not already exist) and
+        the (possibly anonymized) address is added to the `addresses` table with a new integer id. As a side effect,
+        this method will only use the first name it encounters for any particular email. Not ideal, but also not a big
+        deal as long as the actual unique identifer (the email) is preserved.
+        """
+        keyed = []
+        for name, address in addresses:
             if address not in self.address_key:
                 if self.anonymize:
                     self.address_key[address] = self._anonymize_address(address, name)
@@ -255,66 +824,316 @@ class Import:
                         'address': address,
                         'name': name,
                     }
+                self._add_address(address, name, self.address_key[address])
 
-            addresses[idx] = [self.address_key[address]['name'], self.address_key[address]['address']]
+            keyed.append(self.address_key[address])
 
-        return addresses
+        return keyed
 
-    def _get_message_date(self, message):
-        """Finds date and time information for `message` and converts it to ISO-8601 format and UTC timezone.
+    def _add_address(self, real_address, real_name, address_info):
+        """Assigns an id to new self.address_key entry `address_info` and adds it to the `addresses`, `domains` and
+        `address_key` tables. Rows are written straight away so every checkpoint includes the addresses it relies on.
         """
-        mail_date = message.get('Date', '').decode('utf-8')
-        if not mail_date:
-            """The get_from() result always (so far as I have seen!) has the date string in the last 30 characters"""
-            mail_date = message.get_from().strip()[-30:]
+        address = address_info['address'].decode('utf-8')
+        domain = address.partition('@')[2]
+        if domain not in self.domain_ids:
+            self.domain_ids[domain] = len(self.domain_ids) + 1
+            self.writer.insert('domains', (self.domain_ids[domain], domain))
+
+        address_info['id'] = len(self.address_key)
+        self.writer.insert('addresses', (address_info['id'], address, address_info['name'], self.domain_ids[domain]))
+        self.writer.insert('address_key', (real_address.decode('utf-8'), address, real_name, address_info['name'],
+                                           address_info['id']))
+
+
+def _parse_message(message, stored_headers=None, timings=None):
+    """Turns a MessageHeaders record in to a ParsedMessage. Only headers named in `stored_headers` (a set of lower case
+    header names) are kept for the `headers` table, or all of them if `stored_headers` is None. If `timings` is given,
+    the time spent decoding headers is moved from timings['parse'] to timings['decode'].
+    """
+    started = time.time()
+    senders = _parse_addresses(message.get_all('From', []))
+    to = _parse_addresses(message.get_all('To', []))
+    cc = _parse_addresses(message.get_all('CC', []))
+    subject = _decode_header(message.get('Subject', ''))
+    labels = _decode_header(message.get('X-Gmail-Labels', ''))
+    if timings is not None:
+        decoding = time.time() - started
+        timings['decode'] += decoding
+        timings['parse'] -= decoding
+
+    for name, address in senders + to + cc:
+        address.decode('utf-8')  # Fails here, so the message is quarantined, rather than when the address is added.
+
+    date, epoch = _get_message_date(message)
+    message_id = message.get('Message-ID', '').strip()
+    return ParsedMessage(
+        message.key,
+        message.end,
+        message.end - message.start,
+        senders,
+        to,
+        cc,
+        subject,
+        date,
+        epoch,
+        message.get('X-GM-THRID', ''),
+        _gmail_message_id(message.get_from(), message.get('X-GM-MSGID')),
+        message_id.decode('utf-8') if message_id else None,
+        labels,
+        [(header.decode('utf-8'), value.decode('utf-8')) for header, value in message.items()
+         if stored_headers is None or header.lower() in stored_headers],
+        message.parts,
+        message.text
+    )
+
+
+def _parse_or_quarantine(message, stored_headers=None, timings=None):
+    """Turns a MessageHeaders record in to a ParsedMessage or, if parsing fails, a QuarantinedMessage (or, if the
+    MboxReader skipped it, a KnownMessage). If `timings` (a dict of stage name -> seconds) is given, the time taken is
+    added to its 'parse' and 'decode' stages.
+    """
+    if message.headers is None:
+        return KnownMessage(message.key, message.end)
+
+    started = time.time()
+    try:
+        parsed = _parse_message(message, stored_headers, timings)
+    except Exception as e:
+        parsed = QuarantinedMessage(message.key, message.start, message.end, type(e).__name__ + ': ' + str(e),
+                                    '\n'.join([header + ': ' + value for header, value in message.items()]))
+    if timings is not None:
+        timings['parse'] += time.time() - started
+    return parsed
+
+
+def _parse_range(path, start, end, stored_headers=None, text=False, skip=None):
+    """Parses all messages between byte offsets `start` and `end` of mbox file `path` (extracting their plain text
+    bodies, if `text` is True, and passing over those `skip` returns True for, see MboxReader). Run by Import's worker
+    processes. Returns a list of ParsedMessage (or QuarantinedMessage or KnownMessage) objects, whose keys are assigned
+    later by Import, and a dict of the seconds spent in each stage (see ImportStats).
+    """
+    timings = defaultdict(float)
+    messages = [_parse_or_quarantine(message, stored_headers, timings)
+                for message in timed(MboxReader(path, start, end, text=text, skip=skip), timings, 'read')]
+    return messages, timings
 
-        datetime_tuple = email.utils.parsedate_tz(mail_date)
-        if datetime_tuple:
-            unix_time = email.utils.mktime_tz(datetime_tuple)
-            mail_date_iso8601 = datetime.utcfromtimestamp(unix_time).isoformat(' ')
-        else:
-            mail_date_iso8601 = ''
 
-        return mail_date_iso8601
+def _parse_batch(records, stored_headers=None):
+    """Parses a list of MessageHeaders records. Run by Import's worker processes. Returns a list of ParsedMessage (or
+    QuarantinedMessage or KnownMessage) objects, whose keys are assigned later by Import, and a dict of the seconds
+    spent in each stage (see ImportStats).
+    """
+    timings = defaultdict(float)
+    return [_parse_or_quarantine(record, stored_headers, timings) for record in records], timings
+
+
+def _batches(iterable, size):
+    """Yields lists of up to `size` items from `iterable`.
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def _gmail_message_id(from_line, header=None):
+    """Returns the Gmail message id of a message, from its X-GM-MSGID `header` (if it has one) or else its mbox "From "
+    line (which holds the id in Takeout mbox files, see GMAIL_FROM_LINE), or None if neither has one.
+    """
+    if header and header.strip().isdigit():
+        gmail_message_id = int(header.strip())
+    else:
+        match = GMAIL_FROM_LINE.match(from_line)
+        if match is None:
+            return None
+        gmail_message_id = int(match.group(1))
+    return gmail_message_id if gmail_message_id < 2 ** 63 else None  # Larger ids do not fit in an sqlite INT.
+
+
+def _stored_headers(setting):
+    """Turns the `headers` setting ("all", "none" or a comma separated list of header names) in to a set of lower case
+    header names to store, or None to store all headers.
+    """
+    setting = setting.strip().lower()
+    if setting == 'all':
+        return None
+    if setting == 'none':
+        return frozenset()
+    return frozenset([header.strip() for header in setting.split(',') if header.strip()])
+
+
+@lru_cache(maxsize=100000)
+def _decode_header(header):
+    """Attempts to clean up a header:
+        1. Removes newline and tab characters.
+        2. Attempts to resole bad formatting.
+        3. Decodes the header (if the header starts with "=?", for example).
+        4. Recombines the decoded header in to a single unicode string.
+
+    Badly formatted characters are ignored. Results are cached (keyed on the raw header) as mail archives repeat the
+    same subjects, names and labels many times.
+
+    TODO: Put email.header.decode_header() in a try and do something when it raises exceptions.
+    """
+    if header:
+        header = ' '.join(header.split())  # Gets rid of newline and tab characters.
+        header = header.replace('?==?', '?= =?')  # Encoded words must be separated by a space.
+        header = email.header.decode_header(header)  # Handles UTF-8 and other encoded types.
+        header = ' '.join([unicode(t[0], t[1] or 'utf-8', 'ignore') for t in header])  # Recombines all pieces.
+    return header
+
+
+def _format_address(address):
+    """Formats a self.address_key entry for the `messages` table (e.g. "Name <user@example.com>").
+    """
+    return email.utils.formataddr((address['name'], address['address'].decode('utf-8')))
+
+
+@lru_cache(maxsize=100000)
+def _parse_addresses(addresses, unique=True):
+    """Turns a list of address strings (e.g. from email.Message.get_all()) in to a list of (name, address) tuples
+    with decoded names and formatted addresses. Formatting does the following:
+        1) Removes XMPP Resourceparts (https://xmpp.org/rfcs/rfc6122.html).
+        2) Removes periods from the local part for @gmail.com addresses.
+        3) Converts the full address to lower case.
+
+    Results are cached (keyed on the raw address strings) and shared between calls, so they must not be modified.
+
+    Keyword arguments:
+        unique -- Produces a list of unique entries by email address.
+    """
+    parsed = []
+    for name, address in email.utils.getaddresses(addresses):
+        try:
+            [local_part, domain] = address.split('@', 1)
+            domain = domain.split('/', 1)[0].lower()  # Removes Resourcepart and normalizes case.
+            local_part = local_part.lower()  # Normalizes to all lower case.
+            if domain in ['gmail.com']:  # Removes dots for services that disregard them.
+                local_part = local_part.replace('.', '')
+            address = local_part + '@' + domain
+        except ValueError:  # Throws when the address does not have an @ anywhere in the string.
+            address = address + '@domain-not-found.tld'
+
+        parsed.append((_decode_header(name), address))
+
+    if unique:
+        seen = set()
+        parsed = [p for p in parsed if not (p in seen or seen.add(p))]  # Preserves order, unlike set().
+
+    return parsed
+
+
+def _get_message_date(message):
+    """Finds date and time information for `message` and returns it in ISO-8601 format and UTC timezone along with the
+    equivalent Unix timestamp (or '' and None if no date is found).
+    """
+    mail_date = message.get('Date', '').decode('utf-8')
+    if not mail_date:
+        """The get_from() result always (so far as I have seen!) has the date string in the last 30 characters"""
+        mail_date = message.get_from().strip()[-30:]
+
+    datetime_tuple = email.utils.parsedate_tz(mail_date)
+    if datetime_tuple:
+        unix_time = email.utils.mktime_tz(datetime_tuple)
+        mail_date_iso8601 = datetime.utcfromtimestamp(unix_time).isoformat(' ')
+    else:
+        unix_time = None
+        mail_date_iso8601 = ''
+
+    return mail_date_iso8601, unix_time
+
+
+def _date_columns(epoch):
+    """Returns the (year_month, dow, hour) columns of the `messages` table for Unix timestamp `epoch` (in UTC). As with
+    sqlite's strftime(), year_month is formatted as "YYYY-MM" and dow uses 0 = SUNDAY.
+    """
+    if epoch is None:
+        return None, None, None
+
+    date = time.gmtime(epoch)
+    return '%04d-%02d' % (date.tm_year, date.tm_mon), (date.tm_wday + 1) % 7, date.tm_hour
 
 
 class Graph:
     """Creates offline plotly graphs using imported data from sqlite.
+
+    Keyword arguments:
+        context -- ReportContext with the settings, database connection and owner details to use (e.g. shared with
+                   talk.Graph). By default, a new one is created.
     """
-    def __init__(self):
-        self.report = 'Mail'
+    report = 'Mail'
 
-        self.config = ConfigParser.ConfigParser()
-        self.config.readfp(open('settings.defaults.cfg'))
-        self.config.read(['settings.cfg'])
+    def __init__(self, context=None):
+        self.context = context or ReportContext()
+        self.config = self.context.config
+        self.conn = self.context.conn
+        self.owner_email = self.context.owner_email
+        self.owner_id = self.context.owner_id
+        self.label_ids = self.context.label_ids
+        self.facts = self.context.facts
 
-        self.conn = sqlite3.connect(self.config.get('mail', 'db_file'))
+    def attachment_types(self, limit=10):
+        """Returns a pie chart showing the (encoded) size of attachments by content type.
 
-        self.owner_email = self.config.get('mail', 'owner')
-        if self.config.getboolean('mail', 'anonymize'):  # If data is anonymized, get the fake address for the owner.
-            c = self.conn.cursor()
-            c.execute('''SELECT anon_address FROM address_key WHERE real_address = ?;''', (self.owner_email,))
-            self.owner_email = c.fetchone()[0]
+        Keyword arguments:
+            limit -- Number of content types to include. Other content types are grouped together.
+        """
+        c = self.conn.cursor()
+
+        c.execute('''SELECT content_type, SUM(encoded_size) AS total_size
+            FROM parts
+            WHERE filename IS NOT NULL
+            GROUP BY content_type
+            ORDER BY total_size DESC;''')
+
+        sizes = OrderedDict()
+        for content_type, total_size in c.fetchall():
+            if len(sizes) == limit:
+                content_type = 'Other'
+            sizes[content_type] = sizes.get(content_type, 0) + round(total_size / 1048576.0, 2)
+
+        trace = pgo.Pie(
+            labels=sizes.keys(),
+            values=sizes.values(),
+            marker=dict(
+                colors=[
+                    self.config.get('color', 'primary'),
+                    self.config.get('color', 'secondary'),
+                ]
+            )
+        )
+
+        layout_args = plotly_default_layout_options()
+        layout_args['title'] = 'Attachment Types (MB)'
+        del layout_args['xaxis']
+        del layout_args['yaxis']
+
+        layout = pgo.Layout(**layout_args)
+
+        return plotly_output(pgo.Figure(data=[trace], layout=layout))
 
     def day_of_week(self):
         """Returns a graph showing email activity (sent/received) by day of the week.
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%w', `date`) AS dow,
-          COUNT(CASE WHEN `from` LIKE ? THEN 1 ELSE NULL END) AS emails_sent,
-          COUNT(CASE WHEN `from` NOT LIKE ? THEN 1 ELSE NULL END) AS emails_received
-          FROM messages
-          WHERE gmail_labels LIKE '%Chat%'
+        c.execute('''SELECT dow,
+          SUM(CASE WHEN from_owner THEN count ELSE 0 END) AS emails_sent,
+          SUM(CASE WHEN NOT from_owner OR (from_owner ISNULL AND ? NOTNULL) THEN count ELSE 0 END) AS emails_received
+          FROM message_rollup
+          WHERE is_chat
           GROUP BY dow
-          ORDER BY dow ASC;''', ('%' + self.owner_email + '%', '%' + self.owner_email + '%'))
+          ORDER BY dow ASC;''', (self.owner_id,))
+        rows = c.fetchall()
 
         sent = OrderedDict()
         sent_text = OrderedDict()
         received = OrderedDict()
         received_text = OrderedDict()
-        for row in c.fetchall():
-            dow = calendar.day_name[int(row[0]) - 1]  # sqlite strftime() uses 0 = SUNDAY.
+        for row in rows:
+            dow = calendar.day_name[row[0] - 1]  # dow uses 0 = SUNDAY.
             sent[dow] = row[1]
             received[dow] = row[2]
             sent_text[dow] = str(round(float(sent[dow]) / float(sent[dow] + received[dow]) * 100, 2)) + '%'
@@ -436,15 +1255,15 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT gmail_labels FROM messages
-            WHERE gmail_labels != '' AND gmail_labels NOT LIKE '%Chat%';''')
-
-        counts = {}
-        for row in c.fetchall():
-            for label in row[0].split(','):
-                if label not in counts:
-                    counts[label] = 0
-                counts[label] += 1
+        if self.facts is not None:
+            counts = self.facts.label_counts(~self.facts.is_chat)
+        else:
+            c.execute('''SELECT l.label, COUNT(ml.message_key) AS message_count
+                FROM message_labels AS ml
+                JOIN labels AS l ON(l.label_id = ml.label_id)
+                WHERE ml.message_key NOT IN (SELECT message_key FROM message_labels WHERE label_id = ?)
+                GROUP BY ml.label_id;''', (self.label_ids.get('Chat'),))
+            counts = dict(c.fetchall())
 
         trace = pgo.Pie(
             labels=counts.keys(),
@@ -466,6 +1285,47 @@ class Graph:
 
         return plotly_output(pgo.Figure(data=[trace], layout=layout))
 
+    def size_by_year(self):
+        """Returns a bar graph showing the size of all messages (including attachments and chats) by year.
+        """
+        c = self.conn.cursor()
+
+        if self.facts is not None:
+            rows = self.facts.group_by('year_month', self.facts.dated, sums=[self.facts.size])
+        else:
+            c.execute('''SELECT year_month, SUM(size) AS total_size
+                FROM messages
+                WHERE year_month IS NOT NULL
+                GROUP BY year_month
+                ORDER BY year_month;''')
+            rows = c.fetchall()
+
+        sizes = OrderedDict()
+        for year_month, total_size in rows:
+            year = year_month[:4]
+            sizes[year] = sizes.get(year, 0) + total_size
+
+        data = dict(
+            x=sizes.keys(),
+            y=[round(size / 1048576.0, 2) for size in sizes.values()],
+            marker=dict(
+                color=self.config.get('color', 'primary_light'),
+                line=dict(
+                    color=self.config.get('color', 'primary'),
+                    width=1,
+                ),
+            ),
+        )
+
+        layout_args = plotly_default_layout_options()
+        layout_args['title'] = 'Mailbox Size by Year'
+        layout_args['xaxis']['title'] = 'Year'
+        layout_args['xaxis']['type'] = 'category'
+        layout_args['yaxis']['title'] = 'Size (MB)'
+        layout = pgo.Layout(**layout_args)
+
+        return plotly_output(pgo.Figure(data=[pgo.Bar(**data)], layout=layout))
+
     def subject_word_cloud(self, base_dir='./', rel_dir=''):
         """Returns HTML for a word cloud of words used in email subjects. The word cloud image file is saved to
         `base_dir` + `rel_dir` + `subject_word_cloud.png` and linked in HTML as `rel_dir` + `subject_word_cloud.png`.
@@ -473,7 +1333,8 @@ class Graph:
         c = self.conn.cursor()
 
         c.execute('''SELECT subject FROM messages
-            WHERE gmail_labels NOT LIKE '%Chat%' AND subject != '';''')
+            WHERE is_chat = 0
+                AND subject != '';''')
 
         words = {}
         for row in c.fetchall():
@@ -518,30 +1379,20 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%s', MAX(`date`)) - strftime('%s', MIN(`date`)) AS duration,
-            COUNT(message_key) AS message_count
-            FROM messages
-            WHERE gmail_labels NOT LIKE '%Chat%'
-            GROUP BY gmail_thread_id
-            HAVING message_count > 1;''')
+        if self.facts is not None:
+            counts, durations = self.facts.threads(~self.facts.is_chat)
+            durations = durations[counts > 1]
+        else:
+            c.execute('''SELECT MAX(epoch) - MIN(epoch) AS duration,
+                COUNT(message_key) AS message_count
+                FROM messages
+                WHERE is_chat = 0
+                GROUP BY gmail_thread_id
+                HAVING message_count > 1;''')
+            durations = [row[0] for row in c.fetchall()]
 
-        data = {'<= 10 min.': 0, '10 mins - 1 hr.': 0, '1 - 10 hrs.': 0,
-                '10 - 24 hrs.': 0, '1 - 7 days': 0, '1 - 2 weeks': 0, 'more than 2 weeks': 0}
-        for row in c.fetchall():
-            if row[0] <= 600:
-                data['<= 10 min.'] += 1
-            elif row[0] <= 3600:
-                data['10 mins - 1 hr.'] += 1
-            elif row[0] <= 36000:
-                data['1 - 10 hrs.'] += 1
-            elif row[0] <= 86400:
-                data['10 - 24 hrs.'] += 1
-            elif row[0] <= 604800:
-                data['1 - 7 days'] += 1
-            elif row[0] <= 1209600:
-                data['1 - 2 weeks'] += 1
-            else:
-                data['more than 2 weeks'] += 1
+        data = dict(zip(['<= 10 min.', '10 mins - 1 hr.', '1 - 10 hrs.', '10 - 24 hrs.', '1 - 7 days', '1 - 2 weeks',
+                         'more than 2 weeks'], bucket_counts(durations, [600, 3600, 36000, 86400, 604800, 1209600])))
 
         trace = pgo.Pie(
             labels=data.keys(),
@@ -568,17 +1419,20 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT COUNT(message_key) AS message_count
-            FROM messages
-            WHERE gmail_labels NOT LIKE '%Chat%'
-            GROUP BY gmail_thread_id
-            HAVING message_count > 1;''')
-
         counts = {}
-        for row in c.fetchall():
-            if row[0] not in counts:
-                counts[row[0]] = 0
-            counts[row[0]] += 1
+        if self.facts is not None:
+            sizes = self.facts.threads(~self.facts.is_chat)[0]
+            counts = self.facts.value_counts(sizes[sizes > 1])
+        else:
+            c.execute('''SELECT COUNT(message_key) AS message_count
+                FROM messages
+                WHERE is_chat = 0
+                GROUP BY gmail_thread_id
+                HAVING message_count > 1;''')
+            for row in c.fetchall():
+                if row[0] not in counts:
+                    counts[row[0]] = 0
+                counts[row[0]] += 1
 
         data = dict(
             x=counts.keys(),
@@ -603,23 +1457,25 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%H', `date`) AS hour,
-          COUNT(CASE WHEN `from` LIKE ? THEN 1 ELSE NULL END) AS emails_sent,
-          COUNT(CASE WHEN `from` NOT LIKE ? THEN 1 ELSE NULL END) AS emails_received
-          FROM messages
-          WHERE gmail_labels LIKE '%Chat%'
+        c.execute('''SELECT hour,
+          SUM(CASE WHEN from_owner THEN count ELSE 0 END) AS emails_sent,
+          SUM(CASE WHEN NOT from_owner OR (from_owner ISNULL AND ? NOTNULL) THEN count ELSE 0 END) AS emails_received
+          FROM message_rollup
+          WHERE is_chat
           GROUP BY hour
-          ORDER BY hour ASC;''', ('%' + self.owner_email + '%', '%' + self.owner_email + '%'))
+          ORDER BY hour ASC;''', (self.owner_id,))
+        rows = c.fetchall()
 
         sent = OrderedDict()
         sent_total = 0
         received = OrderedDict()
         received_total = 0
-        for row in c.fetchall():
+        for row in rows:
+            hour = '%02d' % row[0] if row[0] is not None else None
             sent_total += row[1]
             received_total += row[2]
-            sent[row[0]] = row[1]
-            received[row[0]] = row[2]
+            sent[hour] = row[1]
+            received[hour] = row[2]
 
         sent_args = dict(
             x=sent.keys(),
@@ -658,13 +1514,15 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT address, COUNT(r.message_key) AS message_count
-            FROM recipients AS r
-            LEFT JOIN messages AS m ON(m.message_key = r.message_key)
-            WHERE m.gmail_labels LIKE '%Sent%'
-            GROUP BY address
-            ORDER BY message_count DESC
-            LIMIT ?''', (limit,))
+        c.execute('''SELECT a.address, r.message_count
+            FROM (SELECT address_id, COUNT(message_key) AS message_count
+                FROM recipients
+                WHERE message_key IN (SELECT message_key FROM message_labels WHERE label_id = ?)
+                GROUP BY address_id
+                ORDER BY message_count DESC
+                LIMIT ?) AS r
+            JOIN addresses AS a ON(a.address_id = r.address_id)
+            ORDER BY r.message_count DESC''', (self.label_ids.get('Sent'), limit))
 
         addresses = OrderedDict()
         longest_address = 0
@@ -702,19 +1560,28 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT `from`, COUNT(message_key) AS message_count
-            FROM messages
-            WHERE gmail_labels NOT LIKE '%Sent%'
-                AND gmail_labels NOT LIKE '%Chat%'
-            GROUP BY `from`
-            ORDER BY message_count DESC
-            LIMIT ?''', (limit,))
+        if self.facts is not None:
+            received = ~(self.facts.is_sent | self.facts.is_chat)
+            counts = self.facts.count('from_id', received)
+            rows = self.facts.with_addresses(self.facts.top('from_id', counts, limit, received))
+        else:
+            c.execute('''SELECT a.name, a.address, m.message_count
+                FROM (SELECT from_id, COUNT(message_key) AS message_count
+                    FROM messages
+                    WHERE is_chat = 0 AND is_sent = 0
+                    GROUP BY from_id
+                    ORDER BY message_count DESC
+                    LIMIT ?) AS m
+                JOIN addresses AS a ON(a.address_id = m.from_id)
+                ORDER BY m.message_count DESC''', (limit,))
+            rows = c.fetchall()
 
         addresses = OrderedDict()
         longest_address = 0
-        for row in c.fetchall():
-            addresses[row[0]] = row[1]
-            longest_address = max(longest_address, len(row[0]))
+        for row in rows:
+            address = email.utils.formataddr((row[0], row[1]))
+            addresses[address] = row[2]
+            longest_address = max(longest_address, len(address))
 
         data = dict(
             x=addresses.values(),
@@ -737,3 +1604,57 @@ class Graph:
         layout['yaxis']['title'] = 'Sender address'
 
         return plotly_output(pgo.Figure(data=[pgo.Bar(**data)], layout=pgo.Layout(**layout)))
+
+    def top_senders_by_size(self, limit=10):
+        """Returns a bar graph showing the top `limit` number of senders by the total size of emails received from them
+        (including attachments).
+
+        Keyword arguments:
+            limit -- Number of senders to include.
+        """
+        c = self.conn.cursor()
+
+        if self.facts is not None:
+            received = ~(self.facts.is_sent | self.facts.is_chat)
+            sizes = self.facts.count('from_id', received, self.facts.size)
+            rows = self.facts.with_addresses(self.facts.top('from_id', sizes, limit, received))
+        else:
+            c.execute('''SELECT a.name, a.address, m.total_size
+                FROM (SELECT from_id, SUM(size) AS total_size
+                    FROM messages
+                    WHERE is_chat = 0 AND is_sent = 0
+                    GROUP BY from_id
+                    ORDER BY total_size DESC
+                    LIMIT ?) AS m
+                JOIN addresses AS a ON(a.address_id = m.from_id)
+                ORDER BY m.total_size DESC''', (limit,))
+            rows = c.fetchall()
+
+        addresses = OrderedDict()
+        longest_address = 0
+        for row in rows:
+            address = email.utils.formataddr((row[0], row[1]))
+            addresses[address] = round(row[2] / 1048576.0, 2)
+            longest_address = max(longest_address, len(address))
+
+        data = dict(
+            x=addresses.values(),
+            y=addresses.keys(),
+            marker=dict(
+                color=self.config.get('color', 'primary_light'),
+                line=dict(
+                    color=self.config.get('color', 'primary'),
+                    width=1,
+                ),
+            ),
+            orientation='h',
+        )
+
+        layout = plotly_default_layout_options()
+        layout['margin']['l'] = longest_address * self.config.getfloat('font', 'size')/1.55
+        layout['margin'] = pgo.Margin(**layout['margin'])
+        layout['title'] = 'Top ' + str(limit) + ' Senders by Size'
+        layout['xaxis']['title'] = 'Size of emails received from (MB)'
+        layout['yaxis']['title'] = 'Sender address'
+
+        return plotly_output(pgo.Figure(data=[pgo.Bar(**data)], layout=pgo.Layout(**layout)))
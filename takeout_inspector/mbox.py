@@ -0,0 +1,687 @@
+"""takeout_inspector/mbox.py
+
+Defines a streaming, header-only reader for Google Takeout mbox files (plain, compressed or inside a Takeout archive).
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import base64
+import bz2
+import email.errors
+import email.header
+import email.message
+import gzip
+import hashlib
+import mmap
+import os
+import quopri
+import tarfile
+import zipfile
+
+from .utils import lru_cache
+from collections import namedtuple
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None  # .xz files can not be read.
+
+__all__ = ['MboxReader', 'MessageHeaders', 'MimePart', 'PartScanner', 'extract_text', 'find_mbox_files', 'hash_head',
+           'is_compressed', 'iter_parts', 'open_mbox', 'split_ranges']
+
+# File name endings of the compressed mbox files and archives that can be read (see open_mbox()).
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zip', '.tgz', '.tar')
+
+# MIME headers of a message or part, as parsed by _mime_part(). `content_type` and `encoding` are lower case,
+# `boundary` is None unless the part is multipart and `attachment` is True if the part has a filename or an
+# "attachment" disposition.
+MimePart = namedtuple('MimePart', ['content_type', 'boundary', 'charset', 'encoding', 'filename', 'attachment'])
+
+# Size (in bytes) of part header blocks that PartScanner waits for before treating them as complete.
+MAX_PART_HEADERS = 65536
+
+
+class MessageHeaders(object):
+    """Compact record of a single mbox message's header block. Only the parts of the email.Message interface used
+    during import are provided (get(), get_all(), items() and get_from()). The message body is not kept, only its
+    location in the mbox file (`start` and `end` byte offsets) is recorded, along with a list of its leaf MIME parts as
+    (content type, filename, encoded size) tuples (see PartScanner) and its plain text (see extract_text()) if the
+    MboxReader was asked for it. `headers` is None for messages passed over by the MboxReader's `skip` function.
+    """
+    __slots__ = ('key', 'start', 'end', 'from_line', 'headers', 'parts', 'text')
+
+    def __init__(self, key, start, end, from_line, headers, parts=None, text=None):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.from_line = from_line
+        self.headers = headers
+        self.parts = parts or []
+        self.text = text
+
+    def get(self, name, failobj=None):
+        """Returns the value of the first header matching `name` (case insensitive) or `failobj` if there is none.
+        """
+        name = name.lower()
+        for header, value in self.headers:
+            if header.lower() == name:
+                return value
+        return failobj
+
+    def get_all(self, name, failobj=None):
+        """Returns a list of all values for headers matching `name` (case insensitive) or `failobj` if there are none.
+        """
+        name = name.lower()
+        values = [value for header, value in self.headers if header.lower() == name]
+        return values or failobj
+
+    def get_from(self):
+        """Returns the mbox "From " line, excluding the leading "From " (matches mailbox.mboxMessage.get_from()).
+        """
+        return self.from_line
+
+    def items(self):
+        """Returns a list of all (header, value) tuples in the order they appear in the message.
+        """
+        return list(self.headers)
+
+
+class MboxReader:
+    """Iterates over messages in an mbox file without loading it in to memory. Message boundaries ("From " lines) are
+    located directly and only the header block of each message is parsed. Plain files are memory-mapped. Compressed
+    files and archives (see is_compressed()) are decompressed as a stream, holding no more than one message's headers
+    plus `read_size` bytes (and, if `text` is True, `text_size` bytes of its body) in memory, and byte offsets refer to
+    the decompressed mbox.
+
+    Keys are assigned sequentially in file order, starting from `first_key`, which is consistent with the keys used by
+    mailbox.mbox.
+
+    Keyword arguments:
+        start -- Byte offset to begin reading from. Must be the start of a "From " line.
+        end -- Byte offset to stop reading at. Messages starting at or after this offset are not read.
+        first_key -- Key assigned to the first message read.
+        text -- Whether or not to extract the plain text of each message (see extract_text()) from the first
+                `text_size` bytes of its body.
+        skip -- Function called with the "From " line of each message (see MessageHeaders.get_from()). Messages it
+                returns True for are passed over without parsing their headers or scanning their bodies and are
+                yielded with `headers` set to None (e.g. messages that have already been imported).
+    """
+    read_size = 1024 * 1024  # Number of bytes read from a compressed stream at a time.
+    text_size = 1024 * 1024  # Number of bytes of each message body searched for plain text.
+
+    def __init__(self, path, start=0, end=None, first_key=0, text=False, skip=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.first_key = first_key
+        self.text = text
+        self.skip = skip
+
+    def __iter__(self):
+        if is_compressed(self.path):
+            f = open_mbox(self.path)
+            try:
+                for message in self._iter_stream(f):
+                    yield message
+            finally:
+                f.close()
+            return
+
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:  # Empty files cannot be memory-mapped.
+                return
+
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for message in self._iter_mapped(mm):
+                    yield message
+            finally:
+                mm.close()
+
+    def _iter_mapped(self, mm):
+        """Yields a MessageHeaders record for each message in `mm` between self.start and self.end.
+        """
+        size = mm.size()
+        end = size if self.end is None else min(self.end, size)
+
+        start = self.start
+        if mm[start:start + 5] != 'From ':
+            start = find_next_boundary(mm, start, size)
+
+        key = self.first_key
+        while start < end:
+            next_start = find_next_boundary(mm, start + 1, size)
+            if self.skip is not None:
+                from_line = read_from_line(mm, start, next_start)
+                if self.skip(from_line):
+                    yield MessageHeaders(key, start, next_start, from_line, None)
+                    key += 1
+                    start = next_start
+                    continue
+
+            from_line, headers, body = parse_head(mm, start, next_start)
+            text = None
+            if self.text:
+                text = extract_text(mm, body, min(next_start, body + self.text_size), headers)
+            parts = [(part.content_type, part.filename, part_end - part_start)
+                     for part, part_start, part_end in iter_parts(mm, body, next_start, headers)]
+            yield MessageHeaders(key, start, next_start, from_line, headers, parts, text)
+
+            key += 1
+            start = next_start
+
+    def _iter_stream(self, f):
+        """Yields a MessageHeaders record for each message in stream `f` between self.start and self.end. The part of
+        the stream before self.start is read and discarded.
+        """
+        position = 0  # Stream offset of the start of the buffer.
+        while position < self.start:
+            skipped = len(f.read(min(self.read_size, self.start - position)))
+            if not skipped:
+                return
+            position += skipped
+
+        buffer = f.read(max(self.read_size, 5))  # Enough to check for a "From " line.
+        eof = not buffer
+        if buffer[:5] != 'From ':  # Skips to the first "From " line.
+            boundary = buffer.find('\nFrom ')
+            while boundary == -1:
+                data = f.read(self.read_size)
+                if not data:
+                    return
+                position += max(len(buffer) - 5, 0)
+                buffer = buffer[-5:] + data
+                boundary = buffer.find('\nFrom ')
+            position += boundary + 1
+            buffer = buffer[boundary + 1:]
+
+        key = self.first_key
+        i = 0  # Index of the current message in the buffer.
+        while i < len(buffer) and (self.end is None or position + i < self.end):
+            # Reads until the header block (or the whole message, if there is no body) is in the buffer.
+            while not eof:
+                boundary = buffer.find('\nFrom ', i + 1)
+                limit = len(buffer) if boundary == -1 else boundary + 1
+                if boundary > -1 or buffer.find('\n\n', i, limit) > -1 or buffer.find('\n\r\n', i, limit) > -1:
+                    break
+                data = f.read(self.read_size)
+                eof = not data
+                position += i
+                buffer = buffer[i:] + data
+                i = 0
+
+            start = position + i
+            boundary = buffer.find('\nFrom ', i + 1)
+            if self.skip is not None:
+                from_line = read_from_line(buffer, i, len(buffer) if boundary == -1 else boundary + 1)
+                if self.skip(from_line):  # Discards the message while looking for the next "From " line.
+                    while boundary == -1 and not eof:
+                        data = f.read(self.read_size)
+                        eof = not data
+                        discarded = max(len(buffer) - 5, i)
+                        position += discarded
+                        buffer = buffer[discarded:] + data
+                        i -= discarded
+                        boundary = buffer.find('\nFrom ', max(i + 1, 0))
+                    i = len(buffer) if boundary == -1 else boundary + 1
+                    yield MessageHeaders(key, start, position + i, from_line, None)
+                    key += 1
+                    continue
+
+            from_line, headers, body = parse_head(buffer, i, len(buffer) if boundary == -1 else boundary + 1)
+
+            text = None
+            if self.text:  # Reads (up to text_size bytes of) the body before it is discarded.
+                while boundary == -1 and not eof and len(buffer) - body < self.text_size:
+                    data = f.read(self.read_size)
+                    eof = not data
+                    searched = max(len(buffer) - 5, i + 1)
+                    buffer += data
+                    boundary = buffer.find('\nFrom ', searched)
+                limit = len(buffer) if boundary == -1 else boundary + 1
+                text = extract_text(buffer, body, min(limit, body + self.text_size), headers)
+
+            # Scans the MIME parts of the message body, then discards it, while looking for the next "From " line.
+            scanner = PartScanner(headers, position + body)
+            scanned = body
+            while boundary == -1 and not eof:
+                scanned = scanner.scan(buffer, scanned, len(buffer), base=position)
+                data = f.read(self.read_size)
+                eof = not data
+                discarded = max(min(len(buffer) - 5, scanned - 1), i)  # Keeps a "\r" before a delimiter.
+                position += discarded
+                buffer = buffer[discarded:] + data
+                i -= discarded
+                scanned -= discarded
+                boundary = buffer.find('\nFrom ', max(i + 1, 0))
+            i = len(buffer) if boundary == -1 else boundary + 1
+            scanner.scan(buffer, scanned, i, final=True, base=position)
+            scanner.finish(position + i)
+
+            parts = [(part.content_type, part.filename, part_end - part_start)
+                     for part, part_start, part_end in scanner.parts]
+            yield MessageHeaders(key, start, position + i, from_line, headers, parts, text)
+            key += 1
+
+
+def is_compressed(path):
+    """Returns True if `path` is a compressed mbox file or an archive that has to be read with open_mbox().
+    """
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def open_mbox(path):
+    """Returns a file object for reading (decompressing) the mbox file `path` as a stream. `path` may be an mbox file
+    compressed with gzip (.gz), bzip2 (.bz2) or xz (.xz, requires the backports.lzma package), or a Google Takeout
+    .zip, .tgz (or .tar.gz) or .tar archive, in which case the mail mbox within the archive is read (see
+    choose_mbox()). Nothing is extracted to disk.
+    """
+    lower_path = path.lower()
+    if lower_path.endswith(('.tgz', '.tar.gz', '.tar.bz2', '.tar')):
+        # Archives are read as a stream, so members can only be checked in order. The archive is only read a second
+        # time if it has no mbox in a "Mail" folder.
+        names = []
+        archive = tarfile.open(path, 'r|*')
+        for member in archive:
+            if member.isfile():
+                names.append(member.name)
+                if choose_mbox([member.name], strict=True):
+                    return _ArchiveMember(archive.extractfile(member), archive)
+        archive.close()
+
+        member_name = choose_mbox(names)
+        archive = tarfile.open(path, 'r|*')
+        for member in archive:
+            if member.name == member_name:
+                return _ArchiveMember(archive.extractfile(member), archive)
+    elif lower_path.endswith('.zip'):
+        with zipfile.ZipFile(path) as archive:
+            return archive.open(choose_mbox(archive.namelist()))  # Opens its own handle on `path`.
+    elif lower_path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif lower_path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    elif lower_path.endswith('.xz'):
+        if lzma is None:
+            raise ValueError('Reading .xz files requires the backports.lzma package.')
+        return lzma.LZMAFile(path, 'rb')
+    return open(path, 'rb')
+
+
+def choose_mbox(names, strict=False):
+    """Returns the name of the mail mbox among archive member `names`: the first .mbox file in a "Mail" folder (e.g.
+    "Takeout/Mail/All mail Including Spam and Trash.mbox") or else the first .mbox file.
+
+    Raises ValueError if there is no .mbox file.
+
+    Keyword arguments:
+        strict -- Returns None, instead of another .mbox file, if there is no .mbox file in a "Mail" folder.
+    """
+    mbox_names = [name for name in names if name.lower().endswith('.mbox')]
+    for name in mbox_names:
+        if '/mail/' in '/' + name.lower():
+            return name
+    if strict:
+        return None
+    if not mbox_names:
+        raise ValueError('No .mbox file found in archive.')
+    return mbox_names[0]
+
+
+class _ArchiveMember(object):
+    """File object for a member of a streamed tar archive that also closes the archive.
+    """
+    def __init__(self, f, archive):
+        self.f = f
+        self.archive = archive
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+        self.archive.close()
+
+
+def find_mbox_files(paths):
+    """Returns a sorted list of the mbox files in `paths`, a list of paths (or a string of paths, one per line). Files
+    are included as-is. Folders are searched (including subfolders) for .mbox files, either plain or compressed (e.g.
+    "Inbox.mbox.gz"). Takeout archives (see open_mbox()) are only included if they are listed themselves.
+
+    Raises ValueError if a folder contains no mbox files.
+    """
+    if isinstance(paths, basestring):
+        paths = [path.strip() for path in paths.splitlines() if path.strip()]
+
+    mbox_files = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            mbox_files.add(path)
+            continue
+
+        found = [os.path.join(folder, name) for folder, folders, names in os.walk(path) for name in names
+                 if _is_mbox_name(name)]
+        if not found:
+            raise ValueError('No mbox files found in ' + path + '.')
+        mbox_files.update(found)
+    return sorted(mbox_files)
+
+
+def _is_mbox_name(name):
+    """Returns True if file name `name` is that of a plain or compressed (.gz, .bz2 or .xz) mbox file.
+    """
+    root, extension = os.path.splitext(name.lower())
+    if extension in ('.gz', '.bz2', '.xz'):
+        root, extension = os.path.splitext(root)
+    return extension == '.mbox'
+
+
+def hash_head(path, size, limit=65536):
+    """Returns a SHA-1 hex digest of the first `size` bytes (up to `limit`) of `path`. Used to recognize an mbox file
+    that has been imported before, even if messages have since been appended to it.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(min(size, limit))).hexdigest()
+
+
+def split_ranges(path, chunk_size, start=0):
+    """Splits mbox file `path` (from byte offset `start`) in to a list of (start, end) byte ranges of roughly
+    `chunk_size` bytes each. Every range starts at a "From " line, so each message falls entirely within one range.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            boundaries = [find_next_boundary(mm, start, size)]
+            while boundaries[-1] < size:
+                boundaries.append(find_next_boundary(mm, boundaries[-1] + chunk_size, size))
+        finally:
+            mm.close()
+
+    return zip(boundaries, boundaries[1:])
+
+
+def find_next_boundary(mm, position, size):
+    """Returns the offset of the first "From " line at or after `position` in `mm` (or `size` if there is none).
+    """
+    if position == 0 and mm[0:5] == 'From ':
+        return 0
+
+    boundary = mm.find('\nFrom ', max(position - 1, 0))
+    if boundary == -1:
+        return size
+    return boundary + 1
+
+
+def parse_head(data, start, end):
+    """Returns the mbox "From " line (excluding the leading "From "), the parsed headers (see parse_header_block()) and
+    the offset of the body of the message between offsets `start` and `end` of `data` (a string or memory map).
+    """
+    from_end = data.find('\n', start, end)
+    if from_end == -1:
+        from_end = end
+    header_start = from_end + 1
+    header_end, body = _find_body(data, from_end, end)
+
+    return (data[start + 5:from_end].rstrip('\r'), parse_header_block(data[header_start:max(header_start, header_end)]),
+            body)
+
+
+def read_from_line(data, start, end):
+    """Returns the mbox "From " line (excluding the leading "From ") of the message between offsets `start` and `end`
+    of `data` (a string or memory map).
+    """
+    from_end = data.find('\n', start, end)
+    return data[start + 5:end if from_end == -1 else from_end].rstrip('\r')
+
+
+def _find_body(data, start, end):
+    """Returns the offset of the end of the header block beginning (just before) `start` in `data` and the offset of
+    the body following it. Both are `end` if there is no body.
+    """
+    header_end = data.find('\n\n', start, end)
+    crlf_header_end = data.find('\n\r\n', start, end)
+    if header_end == -1 or -1 < crlf_header_end < header_end:
+        header_end = crlf_header_end
+    if header_end == -1:  # No body, the headers run to the end of the message.
+        return end, end
+
+    header_end += 1  # Keeps the newline ending the last header line.
+    return header_end, data.find('\n', header_end, end) + 1
+
+
+class PartScanner(object):
+    """Finds the leaf (non-multipart) MIME parts of a message body from its delimiter lines and part headers alone, so
+    parts are never decoded or copied. A body can be scanned in pieces, as it is read from a stream (see scan()). Once
+    finish() is called, `parts` is a list of (MimePart, start, end) tuples, where `start` and `end` are the offsets of
+    each part's (still encoded) body.
+
+    Keyword arguments:
+        headers -- List of (header, value) tuples of the message.
+        start -- Offset of the body.
+    """
+    def __init__(self, headers, start):
+        self.parts = []
+        self.delimiters = []  # Delimiters ("--" + boundary) of the enclosing multiparts, outermost first.
+        self.part = None  # (MimePart, start offset) of the leaf part being scanned.
+        self.first_scan = True
+        self._begin(_mime_part(headers), start)
+
+    def scan(self, data, start, end, final=False, base=0):
+        """Scans `data` (a string or memory map) between offsets `start` and `end` and returns the offset the next
+        scan should begin from (data before it is no longer needed). Unless `final` is True, a line that could be a
+        delimiter, or a part header block, that runs past `end` is left for the next scan. Offsets in `parts` are
+        offsets in `data` plus `base`.
+        """
+        position = start
+        while self.delimiters:
+            if self.first_scan and data[start:start + 2] == '--':
+                line = start
+            else:
+                line = data.find('\n--', position, end)
+                if line == -1:
+                    # Only the last (possibly incomplete) line could still be a delimiter.
+                    return end if final else max(position, data.rfind('\n', position, end), end - 100)
+                line += 1
+            self.first_scan = False
+
+            line_end = data.find('\n', line, end)
+            if line_end == -1:
+                if not final:
+                    return line - 1
+                line_end = end
+
+            match = self._match(data[line:line_end].rstrip())
+            if match is None:
+                position = line_end
+                continue
+            depth, closing = match
+
+            if not closing:
+                limit = min(end, line_end + MAX_PART_HEADERS)
+                header_end, body = _find_body(data, line_end, limit)
+                if body == end and not final:
+                    return line - 1  # Waits for the rest of the part headers.
+
+            part_end = line - 1  # The newline before a delimiter is part of the delimiter.
+            if data[max(part_end - 1, 0):part_end] == '\r':
+                part_end -= 1
+            self._end_part(base + part_end)
+            del self.delimiters[depth + 1:]
+
+            if closing:
+                del self.delimiters[depth]
+                position = line_end
+            else:
+                self._begin(_mime_part(parse_header_block(data[line_end + 1:header_end])), base + body)
+                position = max(body - 1, line_end)
+        self.first_scan = False
+        return end
+
+    def finish(self, end):
+        """Records `end` as the end offset of the body (and of the part being scanned).
+        """
+        self._end_part(end)
+
+    def _begin(self, part, start):
+        if part.boundary:
+            self.delimiters.append('--' + part.boundary)
+        else:
+            self.part = (part, start)
+
+    def _end_part(self, end):
+        if self.part is not None:
+            part, start = self.part
+            self.parts.append((part, start, max(start, end)))
+            self.part = None
+
+    def _match(self, line):
+        """Returns (depth, closing) for delimiter `line` of the multipart at `depth` in self.delimiters (closing is True
+        for a closing "--boundary--" delimiter), or None if `line` is not a delimiter.
+        """
+        for depth in range(len(self.delimiters) - 1, -1, -1):
+            delimiter = self.delimiters[depth]
+            if line == delimiter:
+                return depth, False
+            if line == delimiter + '--':
+                return depth, True
+        return None
+
+
+def iter_parts(data, start, end, headers):
+    """Returns a list of (MimePart, start, end) tuples for the leaf MIME parts of the body between offsets `start` and
+    `end` of `data` (a string or memory map), with `headers` (a list of (header, value) tuples) as the headers of the
+    message (see PartScanner).
+    """
+    part = _mime_part(headers)
+    if not part.boundary:
+        return [(part, start, end)]
+
+    scanner = PartScanner(headers, start)
+    scanner.scan(data, start, end, final=True)
+    scanner.finish(end)
+    return scanner.parts
+
+
+def _mime_part(headers):
+    """Returns the MimePart for a list of (header, value) tuples.
+    """
+    values = {}
+    for header, value in headers:
+        if header[7:8] == '-':  # Skips most other headers without lower casing them.
+            header = header.lower()
+            if header in ('content-type', 'content-disposition', 'content-transfer-encoding') and header not in values:
+                values[header] = value
+    return _parse_mime(values.get('content-type'), values.get('content-disposition'),
+                       values.get('content-transfer-encoding'))
+
+
+@lru_cache(maxsize=10000)
+def _parse_mime(content_type, disposition, encoding):
+    """Returns a MimePart for the values of the Content-Type, Content-Disposition and Content-Transfer-Encoding
+    headers (each None if missing). Results are cached as most messages use the same few values.
+    """
+    part = email.message.Message()
+    if content_type is not None:
+        part['Content-Type'] = content_type
+    if disposition is not None:
+        part['Content-Disposition'] = disposition
+
+    filename = part.get_filename()
+    if isinstance(filename, str):
+        try:
+            filename = u''.join([text.decode(charset or 'utf-8', 'replace')
+                                 for text, charset in email.header.decode_header(filename)])
+        except (LookupError, email.errors.HeaderParseError):
+            filename = filename.decode('utf-8', 'replace')
+
+    return MimePart(
+        part.get_content_type(),
+        part.get_boundary() if part.get_content_maintype() == 'multipart' else None,
+        part.get_content_charset(),
+        (encoding or '').strip().lower(),
+        filename,
+        filename is not None or (disposition or '').strip().lower().startswith('attachment'),
+    )
+
+
+def extract_text(data, start, end, headers):
+    """Returns the decoded text (as unicode) of the first text/plain part, that is not an attachment, of the body
+    between offsets `start` and `end` of `data` (see iter_parts()), or None if there is no such part.
+    """
+    for part, part_start, part_end in iter_parts(data, start, end, headers):
+        if part.content_type == 'text/plain' and not part.attachment:
+            return decode_part(part, data[part_start:part_end])
+    return None
+
+
+def decode_part(part, payload):
+    """Decodes `payload`, the body of MimePart `part`, according to its transfer encoding and charset and returns it as
+    unicode. Truncated or badly encoded payloads are decoded as far as possible.
+    """
+    if part.encoding == 'base64':
+        payload = ''.join(payload.split())
+        try:
+            payload = base64.b64decode(payload[:len(payload) // 4 * 4])
+        except TypeError:
+            payload = ''
+    elif part.encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+
+    try:
+        return payload.decode(part.charset or 'us-ascii', 'replace')
+    except LookupError:  # Unknown charset.
+        return payload.decode('utf-8', 'replace')
+
+
+def parse_header_block(block):
+    """Turns a raw header block in to a list of (header, value) tuples. Folded (continuation) lines are joined to the
+    preceding header's value the same way email.feedparser does: leading whitespace on the first line is stripped and
+    continuation lines are kept as-is.
+    """
+    headers = []
+    name = None
+    value = []
+    for line in block.split('\n'):
+        line = line.rstrip('\r')
+        if line[:1] in (' ', '\t') and name is not None:
+            value.append(line)
+            continue
+
+        if name is not None:
+            headers.append((name, '\n'.join(value)))
+            name = None
+
+        i = line.find(':')
+        if i > 0:
+            name = line[:i]
+            value = [line[i + 1:].lstrip()]
+
+    if name is not None:
+        headers.append((name, '\n'.join(value)))
+
+    return headers
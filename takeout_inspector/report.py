@@ -23,25 +23,46 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
 """
-import ConfigParser
+import gzip
+import multiprocessing
 import os
+import traceback
+import warnings
 
 from . import mail, talk
+from .context import ReportContext, open_query_cache
+from .utils import config
+from collections import OrderedDict
 from inspect import getmembers, getargspec, ismethod
 from shutil import copytree
 
 __all__ = ['Report']
 
+# Graph instances used by each of Report's worker processes (see _init_worker()), by report name. They share one
+# ReportContext, with a read-only query cache.
+_worker_graphs = {}
+
 
 class Report:
     """Creates offline plotly graphs using imported data from sqlite.
+
+    Keyword arguments:
+        jobs -- Number of worker processes used to create graphs. With more than one job, graph methods run in a pool of
+                worker processes, each with its own ReportContext (and so its own database connection and, for the
+                "numpy" engine, its own copy of message facts), and none is created in this process. Workers only read
+                the query cache. The results they query are stored in it by this process. Graph output is still
+                written in method order. Defaults to the `jobs` setting in the [report] section.
     """
-    def __init__(self):
-        self.config = ConfigParser.ConfigParser()
-        self.config.readfp(open('settings.defaults.cfg'))
-        self.config.read(['settings.cfg'])
+    def __init__(self, jobs=None):
+        self.context = None  # ReportContext of the last generate() call, if it created graphs in this process.
+        self.cache = None  # QueryCache of the last generate() call, if any (e.g. for cache.cache_info()).
+        self.errors = {}  # Graph method name -> traceback, for graphs that failed in the last generate() call.
+
+        self.config = config
+        self.jobs = jobs or self.config.getint('report', 'jobs')
 
         self.base_dir = self.config.get('report', 'destination')
+        self.data_dir = self.base_dir + 'resources/data/'  # Graph data files, with the `external_data` setting.
 
         if not os.path.isdir(self.base_dir):
             os.mkdir(self.base_dir)
@@ -53,50 +74,163 @@ class Report:
         in the `resources/js` directory of Takeout Inspector:
           - Plotly: https://plot.ly/javascript/
           - WayPoints: http://imakewebthings.com/waypoints/ (Note: the JS file erroneously states v4.0.0 but is v4.0.1.)
+
+        A graph method that raises an exception is left out of the page, with a warning, and its traceback is kept in
+        self.errors.
+
+        With the `external_data` setting of the [report] section, the data of each graph is written to its own file in
+        `resources/data` (replacing those of earlier reports) and fetched by the page when the graph scrolls in to view.
         """
-        graph_classes = [mail.Graph(), talk.Graph()]
-        for graph_class in graph_classes:
-            report = graph_class.__dict__['report']
-            methods = getmembers(graph_class, ismethod)
-
-            html_file = self.base_dir + report.lower() + '.html'
-            js_file = self.base_dir + '/resources/js/' + report.lower() + '.js'
-
-            with open(html_file, 'w') as html, open(js_file, 'w') as js:
-                html.write(''.join([
-                    '<!DOCTYPE HTML>\n',
-                    '<html>\n',
-                    '<head>\n',
-                    '\t<meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />\n',
-                    '\t<title>' + report + ' | Takeout Inspector</title>\n',
-                    '</head>\n',
-                    '<body style="max-width: 800px; margin: 0 auto;">\n',
-                    '<h1 style="text-align: center;">' + report + ' Statistics</h1>\n'
-                ]))
-
-                for method in methods:
-                    if method[0][0] == '_':
+        self.errors = {}
+        if self.config.getboolean('report', 'external_data'):
+            self._clear_data_dir()
+        if self.jobs > 1:
+            self.context = None
+            self.cache = open_query_cache(self.config)  # Created before the workers, which expect the file to exist.
+            graph_classes = [mail.Graph, talk.Graph]  # Only used for their methods.
+        else:
+            self.context = ReportContext(self.config)
+            self.cache = self.context.cache
+            graph_classes = [mail.Graph(self.context), talk.Graph(self.context)]
+
+        pool = multiprocessing.Pool(self.jobs, _init_worker) if self.jobs > 1 else None
+        try:
+            pending = OrderedDict()  # Report -> list of (graph method name, result or AsyncResult).
+            for graph_class in graph_classes:
+                report = graph_class.report
+                pending[report] = []
+                for name, method in getmembers(graph_class, ismethod):
+                    if name[0] == '_':
                         continue
 
                     args = {}
-                    argspec = getargspec(method[1])
+                    argspec = getargspec(method)
                     if 'base_dir' in argspec.args:
                         args['base_dir'] = self.base_dir
                     if 'rel_dir' in argspec.args:
                         args['rel_dir'] = 'resources/misc/'
 
-                    output = method[1](**args)
-
-                    if type(output) is dict:
-                        if 'html' in output:
-                            html.write(output['html'] + '\n')
-                        if 'js' in output:
-                            js.write(output['js'] + '\n')
-
-                html.write(''.join([
-                    '<script src="resources/js/plotly-v1.20.5.min.js"></script>\n',
-                    '<script src="resources/js/waypoints-v4.0.1.min.js"></script>\n',
-                    '<script src="resources/js/' + report.lower() + '.js"></script>\n',
-                    '</body>\n',
-                    '</html>',
-                ]))
+                    if pool:
+                        pending[report].append((name, pool.apply_async(_render_in_worker, (report, name, args))))
+                    else:
+                        pending[report].append((name, _render(graph_class, name, args)))
+
+            for report, results in pending.items():
+                self._write_report(report, [(name, self._collect(result) if pool else result)
+                                            for name, result in results])
+
+            if pool:
+                pool.close()
+        except:
+            if pool:
+                pool.terminate()
+            raise
+        finally:
+            if pool:
+                pool.join()
+
+    def _collect(self, async_result):
+        """Waits for the (output, error, cache results) tuple of a graph method run by _render_in_worker() and returns
+        (output, error), after adding the query results read by the worker to self.cache.
+        """
+        output, error, cache_results = async_result.get()
+        if self.cache:
+            self.cache.merge(cache_results)
+        return output, error
+
+    def _write_report(self, report, outputs):
+        """Writes the HTML page and JavaScript file of report `report` (e.g. "Mail") from `outputs`, a list of (graph
+        method name, (output, error)) tuples (see _render()) in method order.
+        """
+        html_file = self.base_dir + report.lower() + '.html'
+        js_file = self.base_dir + '/resources/js/' + report.lower() + '.js'
+
+        with open(html_file, 'w') as html, open(js_file, 'w') as js:
+            html.write(''.join([
+                '<!DOCTYPE HTML>\n',
+                '<html>\n',
+                '<head>\n',
+                '\t<meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />\n',
+                '\t<title>' + report + ' | Takeout Inspector</title>\n',
+                '</head>\n',
+                '<body style="max-width: 800px; margin: 0 auto;">\n',
+                '<h1 style="text-align: center;">' + report + ' Statistics</h1>\n'
+            ]))
+
+            for name, (output, error) in outputs:
+                if error:
+                    self.errors[name] = error
+                    warnings.warn('The ' + name + ' graph failed and was left out of the report:\n' + error)
+                    continue
+
+                if type(output) is dict:
+                    if 'html' in output:
+                        html.write(output['html'] + '\n')
+                    if 'js' in output:
+                        js.write(output['js'] + '\n')
+                    if 'data' in output:
+                        self._write_data(output['data_file'], output['data'])
+
+            html.write(''.join([
+                '<script src="resources/js/plotly-v1.20.5.min.js"></script>\n',
+                '<script src="resources/js/waypoints-v4.0.1.min.js"></script>\n',
+                '<script src="resources/js/' + report.lower() + '.js"></script>\n',
+                '</body>\n',
+                '</html>',
+            ]))
+
+    def _clear_data_dir(self):
+        """Creates the folder of graph data files, or removes the data files left in it by an earlier report.
+        """
+        if not os.path.isdir(self.data_dir):
+            os.makedirs(self.data_dir)
+            return
+
+        for file_name in os.listdir(self.data_dir):
+            if file_name.endswith('.json') or file_name.endswith('.json.gz'):
+                os.remove(self.data_dir + file_name)
+
+    def _write_data(self, data_file, data):
+        """Writes JSON `data` of a graph to file `data_file` in the graph data folder, along with a gzip-compressed copy
+        (`data_file` + ".gz") if the `gzip_data` setting of the [report] section is enabled.
+        """
+        with open(self.data_dir + data_file, 'w') as f:
+            f.write(data)
+        if self.config.getboolean('report', 'gzip_data'):
+            with open(self.data_dir + data_file + '.gz', 'wb') as raw:
+                with gzip.GzipFile(data_file, 'wb', 9, raw, 0) as f:
+                    f.write(data)
+
+
+def _render(graph_class, name, args):
+    """Calls graph method `name` of `graph_class` with keyword arguments `args` and returns (output, None), or (None,
+    traceback) if it raises an exception.
+    """
+    try:
+        return getattr(graph_class, name)(**args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _init_worker():
+    """Creates the graph classes used by a worker process of Report.generate(), with a new ReportContext. Connections
+    cannot be shared with the parent process, which is the only one to write to the query cache.
+    """
+    context = ReportContext(read_only_cache=True)
+    for graph_class in [mail.Graph(context), talk.Graph(context)]:
+        _worker_graphs[graph_class.report] = graph_class
+
+
+def _render_in_worker(report, name, args):
+    """Runs _render() for graph method `name` of the graph class of report `report` in a worker process. Returns the
+    output and error along with the query cache results read since the last call, for the parent process to store (see
+    QueryCache.merge()).
+    """
+    graph_class = _worker_graphs[report]
+    output, error = _render(graph_class, name, args)
+    cache = graph_class.context.cache
+    if not cache:
+        return output, error, []
+
+    cache_results, cache.pending = cache.pending, []
+    return output, error, cache_results
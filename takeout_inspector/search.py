@@ -0,0 +1,82 @@
+"""takeout_inspector/search.py
+
+Defines a class used to search the full-text index of imported messages.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import ConfigParser
+import sqlite3
+
+from collections import namedtuple
+
+__all__ = ['Search', 'SearchResult']
+
+# A single search result. `rank` is the BM25 score of the match (lower is better) and `subject` and `snippet` are the
+# subject and an excerpt of the body, with matching terms marked.
+SearchResult = namedtuple('SearchResult', ['message_key', 'rank', 'subject', 'snippet'])
+
+
+class Search:
+    """Searches message subjects and plain text bodies using the `message_text` SQLite FTS5 index, built during import
+    when the `search_index` setting is enabled.
+
+    Queries use the FTS5 query syntax (https://www.sqlite.org/fts5.html#full_text_query_syntax), e.g. `lunch friday`
+    (both words), `"lunch on friday"` (a phrase), `lunch OR dinner`, `subject:lunch` or `photo*` (a prefix).
+    """
+    highlight = ('[', ']')  # Marks placed before and after matching terms in subjects and snippets.
+    snippet_tokens = 16  # Maximum number of tokens in each snippet.
+
+    def __init__(self, settings_file='settings.cfg'):
+        self.config = ConfigParser.ConfigParser()
+        self.config.readfp(open('settings.defaults.cfg'))
+        self.config.read([settings_file])
+
+        self.conn = sqlite3.connect(self.config.get('mail', 'db_file'))
+
+        c = self.conn.cursor()
+        c.execute('''SELECT COUNT(*) FROM sqlite_master WHERE name = 'message_text';''')
+        if not c.fetchone()[0]:
+            raise ValueError(self.config.get('mail', 'db_file') + ' has no search index. Enable the search_index '
+                             'setting and import the mbox file in to a new db_file.')
+
+    def search(self, query, limit=20, offset=0):
+        """Returns a list of up to `limit` SearchResult tuples for messages matching `query`, best matches first,
+        skipping the first `offset` matches.
+
+        Raises sqlite3.OperationalError if `query` is not a valid FTS5 query.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT rowid, rank,
+            highlight(message_text, 0, ?, ?),
+            snippet(message_text, 1, ?, ?, '...', ?)
+            FROM message_text
+            WHERE message_text MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?;''', self.highlight + self.highlight + (self.snippet_tokens, query, limit, offset))
+        return [SearchResult(*row) for row in c.fetchall()]
+
+    def count(self, query):
+        """Returns the number of messages matching `query`.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT COUNT(*) FROM message_text WHERE message_text MATCH ?;''', (query,))
+        return c.fetchone()[0]
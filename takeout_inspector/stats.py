@@ -0,0 +1,210 @@
+"""takeout_inspector/stats.py
+
+Defines the statistics (stage timings, throughput and memory use) collected during an import.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import json
+import sys
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+try:
+    import tracemalloc  # Python 3.4+, or the pytracemalloc package (which needs a patched Python 2.7).
+except ImportError:
+    tracemalloc = None
+
+__all__ = ['ImportStats', 'peak_rss', 'timed']
+
+# Import stages, in the order they happen to each message. Stage times do not overlap (e.g. `parse` does not include
+# `decode` and `insert` does not include `anonymize` or `write`), so they can be compared directly.
+STAGES = [
+    'read',  # Finding messages, their header blocks and plain text bodies in the mbox file (including decompression).
+    'parse',  # Parsing header blocks and dates.
+    'decode',  # Decoding encoded headers (subject and labels) and parsing addresses.
+    'anonymize',  # Deriving fake names and addresses for new addresses.
+    'insert',  # Building rows and looking up ids for messages, labels, headers and recipients.
+    'write',  # Writing buffered rows to sqlite (executemany).
+    'search',  # Adding subjects and bodies to the full-text search index.
+    'commit',  # Committing.
+    'index',  # Building the indexes in INDEX_PLAN.
+    'finish',  # ANALYZE, VACUUM and saving an in-memory database.
+]
+
+
+class ImportStats(object):
+    """Statistics for one run of Import.import_messages(): message and byte counts, the cumulative time spent in each
+    stage (see STAGES), throughput and peak memory use. Import updates the counters as it goes and passes this object to
+    its `progress` function, and as_dict() or save() export the statistics (e.g. to compare imports across versions).
+
+    With more than one job, `read`, `parse` and `decode` are added up across all worker processes so, together, stages
+    can take longer than the import itself.
+
+    Keyword arguments:
+        total_bytes -- Number of bytes to import (for eta()), or None if not known in advance (e.g. a compressed mbox).
+        trace_memory -- Whether or not to trace Python memory allocations with tracemalloc, if it is available. Tracing
+                        slows the import down considerably.
+    """
+    def __init__(self, total_bytes=None, trace_memory=False):
+        self.total_bytes = total_bytes
+        self.phase = 'import'  # Then "index", "finish" and "done".
+        self.messages = 0
+        self.quarantined = 0
+        self.duplicates = 0  # Messages skipped because they had already been imported (included in `messages`).
+        self.bytes = 0
+        self.stages = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.indexes = OrderedDict()  # Index name -> seconds taken to build it.
+        self.caches = {}  # Cache name -> lru_cache cache_info() as a dict.
+        self.peak_rss = None
+        self.peak_rss_workers = None
+        self.traced_memory = None  # tracemalloc (current, peak) bytes.
+        self.top_allocations = []  # Largest tracemalloc allocations, by source line, once finished.
+
+        self.trace_memory = trace_memory and tracemalloc is not None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, timings):
+        """Adds the seconds in `timings`, a dict of stage name -> seconds (e.g. from a worker process), to the stages.
+        """
+        for stage, seconds in timings.items():
+            self.stages[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        """Context manager adding the time taken by its block to `stage`.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.stages[stage] += time.time() - started
+
+    def elapsed(self):
+        """Returns the number of seconds since the import started (until it finished, once it has).
+        """
+        return (self.finished or time.time()) - self.started
+
+    def messages_per_second(self):
+        elapsed = self.elapsed()
+        return self.messages / elapsed if elapsed else 0.0
+
+    def bytes_per_second(self):
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed else 0.0
+
+    def eta(self):
+        """Returns the estimated number of seconds until all messages are read, based on the bytes read so far, or None
+        if the total is not known.
+        """
+        rate = self.bytes_per_second()
+        if self.total_bytes is None or not rate:
+            return None
+        return max(self.total_bytes - self.bytes, 0) / rate
+
+    def sample_memory(self):
+        """Updates peak memory use (peak resident set size of this process and of finished worker processes and, when
+        tracing, the current and peak memory allocated by Python).
+        """
+        self.peak_rss = peak_rss()
+        self.peak_rss_workers = peak_rss(children=True)
+        if self.trace_memory and tracemalloc.is_tracing():
+            self.traced_memory = tracemalloc.get_traced_memory()
+
+    def finish(self):
+        """Records the end of the import and takes a final memory sample (and tracemalloc snapshot).
+        """
+        self.phase = 'done'
+        self.finished = time.time()
+        self.sample_memory()
+        if self.trace_memory:
+            self.top_allocations = [str(statistic)
+                                    for statistic in tracemalloc.take_snapshot().statistics('lineno')[:10]]
+            tracemalloc.stop()
+
+    def as_dict(self):
+        """Returns all statistics as a dict of JSON serializable values.
+        """
+        return OrderedDict([
+            ('python', sys.version.split()[0]),
+            ('phase', self.phase),
+            ('started', self.started),
+            ('seconds', self.elapsed()),
+            ('messages', self.messages),
+            ('quarantined', self.quarantined),
+            ('duplicates', self.duplicates),
+            ('bytes', self.bytes),
+            ('messages_per_second', self.messages_per_second()),
+            ('bytes_per_second', self.bytes_per_second()),
+            ('stages', self.stages),
+            ('indexes', self.indexes),
+            ('caches', self.caches),
+            ('peak_rss', self.peak_rss),
+            ('peak_rss_workers', self.peak_rss_workers),
+            ('traced_memory', self.traced_memory),
+            ('top_allocations', self.top_allocations),
+        ])
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, separators=(',', ': '))
+
+    def save(self, path):
+        """Writes the statistics to `path` as JSON.
+        """
+        with open(path, 'w') as stats_file:
+            stats_file.write(self.to_json() + '\n')
+
+
+def peak_rss(children=False):
+    """Returns the peak resident set size (in bytes) of this process (or of its largest finished child process), or
+    None if it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    if sys.platform == 'darwin':  # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+
+def timed(iterable, timings, stage):
+    """Yields the items of `iterable`, adding the time taken to produce each one to timings[`stage`].
+    """
+    iterator = iter(iterable)
+    while True:
+        started = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[stage] += time.time() - started
+            return
+        timings[stage] += time.time() - started
+        yield item
@@ -24,10 +24,11 @@ SOFTWARE.
 
 """
 import calendar
-import ConfigParser
+import email.utils
 import plotly.graph_objs as pgo
-import sqlite3
 
+from .context import ReportContext
+from .facts import bucket_counts
 from .utils import *
 from collections import OrderedDict
 
@@ -44,21 +45,21 @@ class Import:
 
 class Graph:
     """Creates offline plotly graphs using imported data from sqlite.
-    """
-    def __init__(self):
-        self.report = 'Talk'
 
-        self.config = ConfigParser.ConfigParser()
-        self.config.readfp(open('settings.defaults.cfg'))
-        self.config.read(['settings.cfg'])
-
-        self.conn = sqlite3.connect(self.config.get('mail', 'db_file'))
+    Keyword arguments:
+        context -- ReportContext with the settings, database connection and owner details to use (e.g. shared with
+                   mail.Graph). By default, a new one is created.
+    """
+    report = 'Talk'
 
-        self.owner_email = self.config.get('mail', 'owner')
-        if self.config.getboolean('mail', 'anonymize'):  # If data is anonymized, get the fake address for the owner.
-            c = self.conn.cursor()
-            c.execute('''SELECT anon_address FROM address_key WHERE real_address = ?;''', (self.owner_email,))
-            self.owner_email = c.fetchone()[0]
+    def __init__(self, context=None):
+        self.context = context or ReportContext()
+        self.config = self.context.config
+        self.conn = self.context.conn
+        self.owner_email = self.context.owner_email
+        self.owner_id = self.context.owner_id
+        self.label_ids = self.context.label_ids
+        self.facts = self.context.facts
 
     def talk_clients(self):
         """Returns a pie chart showing distribution of services/client used (based on known resourceparts). This likely
@@ -66,7 +67,9 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT value FROM headers WHERE header = 'To' AND value NOT LIKE '%,%';''')
+        c.execute('''SELECT value FROM headers
+            WHERE header_id = (SELECT header_id FROM header_names WHERE header = 'To')
+                AND value NOT LIKE '%,%';''')
 
         clients = {'android': 0, 'Adium': 0, 'BlackBerry': 0, 'Festoon': 0, 'fire': 0,
                     'Gush': 0, 'Gaim': 0, 'gmail': 0, 'Meebo': 0, 'Miranda': 0,
@@ -118,19 +121,20 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%w', `date`) AS dow,
-            COUNT(CASE WHEN gmail_labels LIKE '%Chat%' THEN 1 ELSE NULL END) AS talk_messages,
-            COUNT(CASE WHEN gmail_labels NOT LIKE '%Chat%' THEN 1 ELSE NULL END) AS email_messages
-            FROM messages
+        c.execute('''SELECT dow,
+            SUM(CASE WHEN is_chat THEN count ELSE 0 END) AS talk_messages,
+            SUM(CASE WHEN is_chat THEN 0 ELSE count END) AS email_messages
+            FROM message_rollup
             WHERE dow NOTNULL
             GROUP BY dow;''')
+        rows = c.fetchall()
 
         talk_percentages = OrderedDict()
         talk_messages = OrderedDict()
         email_percentages = OrderedDict()
         email_messages = OrderedDict()
-        for row in c.fetchall():
-            dow = calendar.day_name[int(row[0]) - 1]  # sqlite strftime() uses 0 = SUNDAY.
+        for row in rows:
+            dow = calendar.day_name[row[0] - 1]  # dow uses 0 = SUNDAY.
             talk_percentages[dow] = str(round(float(row[1]) / sum([row[1], row[2]]) * 100, 2)) + '%'
             email_percentages[dow] = str(round(float(row[2]) / sum([row[1], row[2]]) * 100, 2)) + '%'
             talk_messages[dow] = row[1]
@@ -169,26 +173,19 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%s', MAX(`date`)) - strftime('%s', MIN(`date`)) AS duration
-            FROM messages
-            WHERE gmail_labels LIKE '%Chat%'
-            GROUP BY gmail_thread_id
-            HAVING duration > 0;''')
+        if self.facts is not None:
+            durations = self.facts.threads(self.facts.is_chat)[1]
+            durations = durations[durations > 0]
+        else:
+            c.execute('''SELECT MAX(epoch) - MIN(epoch) AS duration
+                FROM messages
+                WHERE is_chat = 1
+                GROUP BY gmail_thread_id
+                HAVING duration > 0;''')
+            durations = [row[0] for row in c.fetchall()]
 
-        data = {'<= 1 min.': 0, '1 - 10 mins.': 0,
-                '10 - 30 mins.': 0, '30 mins. - 1 hr.': 0,
-                '> 1 hr.': 0}
-        for row in c.fetchall():
-            if row[0] <= 60:
-                data['<= 1 min.'] += 1
-            elif row[0] <= 600:
-                data['1 - 10 mins.'] += 1
-            elif row[0] <= 1800:
-                data['10 - 30 mins.'] += 1
-            elif row[0] <= 3600:
-                data['30 mins. - 1 hr.'] += 1
-            else:
-                data['> 1 hr.'] += 1
+        data = dict(zip(['<= 1 min.', '1 - 10 mins.', '10 - 30 mins.', '30 mins. - 1 hr.', '> 1 hr.'],
+                        bucket_counts(durations, [60, 600, 1800, 3600])))
 
         trace = pgo.Pie(
             labels=data.keys(),
@@ -220,7 +217,7 @@ class Graph:
             COUNT(message_key) as thread_size,
             GROUP_CONCAT(DISTINCT `from`) AS participants
             FROM messages
-            WHERE gmail_labels LIKE '%Chat%'
+            WHERE is_chat = 1
             GROUP BY gmail_thread_id;''')
 
         messages = []
@@ -262,15 +259,16 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%H', `date`) AS hour, COUNT(message_key) AS talk_messages
-            FROM messages
-            WHERE gmail_labels LIKE '%Chat%'
+        c.execute('''SELECT hour, SUM(count) AS talk_messages
+            FROM message_rollup
+            WHERE is_chat
             GROUP BY hour
             ORDER BY hour ASC;''')
+        rows = c.fetchall()
 
         data = OrderedDict()
-        for row in c.fetchall():
-            data[row[0]] = row[1]
+        for row in rows:
+            data['%02d' % row[0] if row[0] is not None else None] = row[1]
 
         total_messages = sum(data.values())
         percentages = OrderedDict()
@@ -306,22 +304,33 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT `from`,
-            COUNT(CASE WHEN gmail_labels LIKE '%Chat%' THEN 1 ELSE NULL END) AS talk_messages,
-            COUNT(CASE WHEN gmail_labels NOT LIKE '%Chat%' THEN 1 ELSE NULL END) AS email_messages
-            FROM messages
-            WHERE `from` NOT LIKE ?
-            GROUP BY `from`
-            ORDER BY talk_messages DESC
-            LIMIT ?;''', ('%' + self.owner_email + '%', limit,))
+        if self.facts is not None:
+            others = self.facts.not_from_owner
+            talk_messages = self.facts.count('from_id', others, self.facts.is_chat)
+            email_messages = self.facts.count('from_id', others, ~self.facts.is_chat)
+            rows = self.facts.with_addresses(self.facts.top('from_id', talk_messages, limit, others, [email_messages]))
+        else:
+            c.execute('''SELECT a.name, a.address, m.talk_messages, m.email_messages
+                FROM (SELECT from_id,
+                    SUM(is_chat) AS talk_messages,
+                    COUNT(*) - SUM(is_chat) AS email_messages
+                    FROM messages
+                    WHERE from_owner = 0
+                    GROUP BY from_id
+                    ORDER BY talk_messages DESC
+                    LIMIT ?) AS m
+                JOIN addresses AS a ON(a.address_id = m.from_id)
+                ORDER BY m.talk_messages DESC;''', (limit,))
+            rows = c.fetchall()
 
         chats = OrderedDict()
         emails = OrderedDict()
         longest_address = 0
-        for row in c.fetchall():
-            chats[row[0]] = row[1]
-            emails[row[0]] = row[2]
-            longest_address = max(longest_address, len(row[0]))
+        for row in rows:
+            address = email.utils.formataddr((row[0], row[1]))
+            chats[address] = row[2]
+            emails[address] = row[3]
+            longest_address = max(longest_address, len(address))
 
         chats_trace = pgo.Bar(
             x=chats.keys(),
@@ -359,18 +368,19 @@ class Graph:
         """
         c = self.conn.cursor()
 
-        c.execute('''SELECT strftime('%Y-%m', `date`) as period,
-          COUNT(CASE WHEN gmail_labels LIKE '%Chat%' THEN 1 ELSE NULL END) AS talk_messages,
-          COUNT(CASE WHEN gmail_labels NOT LIKE '%Chat%' THEN 1 ELSE NULL END) AS email_messages
-          FROM messages
+        c.execute('''SELECT substr(day, 1, 7) AS period,
+          SUM(CASE WHEN is_chat THEN count ELSE 0 END) AS talk_messages,
+          SUM(CASE WHEN is_chat THEN 0 ELSE count END) AS email_messages
+          FROM message_rollup
           GROUP BY period
           ORDER BY period ASC;''')
+        rows = c.fetchall()
 
         talk_data = OrderedDict()
         talk_total = 0
         email_data = OrderedDict()
         email_total = 0
-        for row in c.fetchall():
+        for row in rows:
             talk_total += row[1]
             email_total += row[2]
             if cumulative:
@@ -0,0 +1,56 @@
+"""takeout_inspector/test/anonymize.py
+
+Defines unittest tests for the anonymizer.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import unittest
+
+from takeout_inspector.anonymize import Anonymizer
+
+
+class Anonymize(unittest.TestCase):
+
+    def test_deterministic(self):
+        addresses = ['jane.doe@example.com', 'johnwilkersoniv@gmail.com', 'bob@example.org']
+        first = [Anonymizer('secret').anonymize(address) for address in addresses]
+        self.assertEqual([Anonymizer('secret').anonymize(address) for address in reversed(addresses)],
+                         list(reversed(first)))
+        self.assertNotEqual([Anonymizer('other secret').anonymize(address) for address in addresses], first)
+
+        anon_address, name = first[0]
+        self.assertEqual(anon_address.split('@')[0], name.replace(' ', '-').lower())
+        self.assertEqual(Anonymizer('secret').anonymize('john@example.com')[0].split('@')[1],
+                         anon_address.split('@')[1])
+
+    def test_collisions(self):
+        anonymizer = Anonymizer('secret')
+        anon_address, name = Anonymizer('secret').anonymize('jane.doe@example.com')
+        anonymizer.restore('someone.else@example.com', anon_address)
+
+        self.assertEqual(anonymizer.anonymize('jane.doe@example.com'),
+                         (anon_address.replace('@', '-2@'), name))
+        self.assertEqual(anonymizer.anonymize('jane.doe@example.com'),
+                         (anon_address.replace('@', '-2@'), name))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""takeout_inspector/test/context.py
+
+Defines unittest tests for the report context.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import warnings
+
+from takeout_inspector import mail, report, talk, utils
+from takeout_inspector.context import ReportContext
+
+
+class Context(unittest.TestCase):
+
+    def setUp(self):
+        self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg')
+        self.m.import_messages()
+        self.m.config.set('report', 'query_cache_file', '')
+        self.context = ReportContext(self.m.config)
+
+    def tearDown(self):
+        os.remove(self.m.config.get('mail', 'db_file'))
+
+    def test_context(self):
+        self.assertEqual(self.context.owner_email, 'johnwilkersoniv@gmail.com')
+        self.assertEqual(self.context.owner_id, 2)
+        self.assertEqual(sorted(self.context.label_ids), ['Category Updates', 'Chat', 'Important', 'Inbox', 'Sent',
+                                                          'Travel/2016'])
+        self.assertIsNone(self.context.facts)
+        self.assertIsNone(self.context.cache)
+
+        graphs = [mail.Graph(self.context), talk.Graph(self.context)]
+        self.assertTrue(all(graph.conn is self.context.conn for graph in graphs), 'Connection not shared.')
+        self.assertIn('html', graphs[1].talk_days())
+
+        with self.assertRaises(sqlite3.OperationalError):
+            self.context.conn.execute('''DELETE FROM messages;''')
+        self.assertEqual(self.m.conn.execute('''SELECT COUNT(*) FROM messages;''').fetchone()[0], 5)
+
+    def test_render(self):
+        graph = talk.Graph(self.context)
+        output, error = report._render(graph, 'talk_days', {})
+        self.assertIn('html', output)
+        self.assertIsNone(error)
+
+        output, error = report._render(graph, 'talk_top_chatters', {'limit': 'ten'})
+        self.assertIsNone(output)
+        self.assertIn('Traceback', error)
+
+    def test_parallel_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        settings = dict((section, dict(utils.config.items(section))) for section in ['mail', 'report'])
+        try:
+            for option in ['anonymize', 'db_file', 'owner']:
+                utils.config.set('mail', option, self.m.config.get('mail', option))
+            utils.config.set('report', 'destination', os.path.join(temp_dir, 'report') + '/')
+            utils.config.set('report', 'query_cache_file', os.path.join(temp_dir, 'cache.db'))
+            reports = [report.Report(jobs=2), report.Report(jobs=2)]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')  # Graphs that fail (e.g. with another wordcloud version) are skipped.
+                for r in reports:
+                    r.generate()
+
+            self.assertIsNone(reports[0].context)
+            hits, misses = reports[0].cache.cache_info()[:2]
+            self.assertGreater(misses, 0)
+            self.assertEqual(reports[1].cache.cache_info()[:2], (hits + misses, 0), 'Worker results not cached.')
+        finally:
+            for section, options in settings.items():
+                for option, value in options.items():
+                    utils.config.set(section, option, value)
+            shutil.rmtree(temp_dir)
+
+    def test_external_data(self):
+        base_dir = tempfile.mkdtemp() + '/'
+        settings = dict(utils.config.items('report'))
+        try:
+            utils.config.set('report', 'destination', base_dir)
+            utils.config.set('report', 'external_data', 'True')
+            utils.config.set('report', 'gzip_data', 'True')
+            output = talk.Graph(self.context).talk_days()
+            figure = json.loads(output['data'])
+            self.assertEqual(figure['data'][0]['type'], 'bar')
+            self.assertIn('resources/data/' + output['data_file'], output['js'])
+            self.assertNotIn('"x":', output['js'])
+
+            r = report.Report()
+            r._clear_data_dir()
+            r._write_data(output['data_file'], output['data'])
+            with open(base_dir + 'resources/data/' + output['data_file']) as f:
+                self.assertEqual(f.read(), output['data'])
+            with gzip.open(base_dir + 'resources/data/' + output['data_file'] + '.gz') as f:
+                self.assertEqual(f.read(), output['data'])
+
+            r._clear_data_dir()
+            self.assertEqual(os.listdir(base_dir + 'resources/data/'), [])
+        finally:
+            for option in ['destination', 'external_data', 'gzip_data']:
+                utils.config.set('report', option, settings[option])
+            shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""takeout_inspector/test/db.py
+
+Defines unittest tests for database helpers.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import warnings
+
+from takeout_inspector.db import (BatchWriter, CachingConnection, PlanCheckingConnection, QueryCache, build_indexes,
+                                  bump_generation, db_fingerprint, full_scans)
+
+
+class Db(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('''CREATE TABLE t(a INT, b TEXT);''')
+
+    def _count(self):
+        return self.conn.execute('''SELECT COUNT(*) FROM t;''').fetchone()[0]
+
+    def test_batch_writer(self):
+        writer = BatchWriter(self.conn, batch_size=3, commit_size=100, commit_interval=3600)
+        writer.insert('t', (1, 'a'))
+        writer.insert('t', (2, 'b'))
+        self.assertEqual(self._count(), 0, 'Rows written before the batch was full.')
+
+        writer.insert('t', (3, 'c'))
+        self.assertEqual(self._count(), 3, 'Full batch not written.')
+        self.assertEqual(writer.uncommitted, 3)
+
+        writer.insert('t', (4, 'd'))
+        writer.commit()
+        self.assertEqual(self._count(), 4, 'Buffered rows not written on commit.')
+        self.assertEqual(writer.uncommitted, 0)
+
+    def test_build_indexes(self):
+        built = []
+        build_indexes(self.conn, [('t_a', 't', 'a'), ('t_b', 't', 'b')],
+                      progress=lambda name, number, total, seconds: built.append((name, number, total)))
+        self.assertEqual(built, [('t_a', 1, 2), ('t_b', 2, 2)])
+        self.assertEqual(full_scans(self.conn, '''SELECT b FROM t WHERE a = ?;''', (1,)), [])
+
+    def test_full_scans(self):
+        self.assertEqual(full_scans(self.conn, '''SELECT b FROM t WHERE a = ?;''', (1,)), ['SCAN t'])
+        self.assertEqual(full_scans(self.conn, '''SELECT * FROM (SELECT a, COUNT(*) AS n FROM t GROUP BY a
+            ORDER BY n LIMIT 1) AS top;'''), ['SCAN t'])
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            c = PlanCheckingConnection(self.conn).cursor()
+            c.execute('''SELECT b FROM t WHERE a = ?;''', (1,))
+            self.assertEqual(c.fetchall(), [])
+        self.assertEqual(len(caught), 1)
+
+    def test_query_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = QueryCache(os.path.join(temp_dir, 'cache.db'), max_size=200)
+            self.conn.executemany('''INSERT INTO t VALUES(?, ?);''', [(1, u'a'), (2, u'b')])
+            c = CachingConnection(self.conn, cache, 'one').cursor()
+            for run in range(2):
+                c.execute('''SELECT a, b FROM t WHERE a > ? ORDER BY a;''', (0,))
+                self.assertEqual(c.fetchone(), (1, u'a'))
+                self.assertEqual(list(c), [(2, u'b')])
+            self.assertEqual(cache.cache_info()[:2], (1, 1))
+
+            self.conn.execute('''DELETE FROM t;''')
+            c = CachingConnection(self.conn, cache, 'two').cursor()
+            self.assertEqual(c.execute('''SELECT a, b FROM t WHERE a > ? ORDER BY a;''', (0,)).fetchall(), [],
+                             'Results reused for a different database fingerprint.')
+
+            for value in range(20):  # Each result takes more than 10 bytes, so older ones are removed.
+                c.execute('''SELECT ?;''', (value,))
+            self.assertLessEqual(cache.cache_info().currsize, 200)
+            self.assertEqual(c.execute('''SELECT ?;''', (19,)).fetchall(), [(19,)])
+            self.assertEqual(cache.get(cache.key('one', '''SELECT a, b FROM t WHERE a > ? ORDER BY a;''', (0,))), None,
+                             'Least recently used result not removed.')
+
+            worker_cache = QueryCache(os.path.join(temp_dir, 'cache.db'), max_size=200, read_only=True)
+            c = CachingConnection(self.conn, worker_cache, 'two').cursor()
+            self.assertEqual(c.execute('''SELECT ?;''', (19,)).fetchall(), [(19,)])
+            self.assertEqual(c.execute('''SELECT ?;''', (20,)).fetchall(), [(20,)])
+            self.assertEqual(worker_cache.pending, [(cache.key('two', '''SELECT ?;''', (19,)), None),
+                                                    (cache.key('two', '''SELECT ?;''', (20,)), [(20,)])])
+            self.assertIsNone(cache.get(cache.key('two', '''SELECT ?;''', (20,))), 'Read-only cache stored results.')
+            cache.merge(worker_cache.pending)
+            self.assertEqual(cache.get(cache.key('two', '''SELECT ?;''', (20,))), [(20,)])
+
+            db_file = os.path.join(temp_dir, 'test.db')
+            conn = sqlite3.connect(db_file)
+            fingerprint = db_fingerprint(conn, db_file)
+            bump_generation(conn)
+            self.assertNotEqual(db_fingerprint(conn, db_file), fingerprint)
+            conn.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""takeout_inspector/test/facts.py
+
+Defines unittest tests for the NumPy graph engine.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import os
+import unittest
+
+from takeout_inspector import facts, mail
+
+
+@unittest.skipIf(facts.np is None, 'numpy is not installed.')
+class Facts(unittest.TestCase):
+
+    def setUp(self):
+        self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg')
+        self.m.import_messages()
+        c = self.m.conn.cursor()
+        c.execute('''SELECT label, label_id FROM labels;''')
+        self.label_ids = dict(c.fetchall())
+        self.facts = facts.MessageFacts(self.m.conn, label_ids=self.label_ids)
+
+    def tearDown(self):
+        os.remove(self.m.config.get('mail', 'db_file'))
+
+    def _query(self, sql):
+        c = self.m.conn.cursor()
+        c.execute(sql)
+        return c.fetchall()
+
+    def test_group_by(self):
+        self.assertEqual(self.facts.group_by('hour', sums=[self.facts.size]), self._query('''SELECT
+            CAST(strftime('%H', date) AS INTEGER) AS hour, SUM(size)
+            FROM messages
+            GROUP BY hour
+            ORDER BY hour;'''))
+        self.assertEqual(self.facts.group_by('year_month', counts=[self.facts.is_chat]), self._query('''SELECT
+            strftime('%Y-%m', date) AS year_month, SUM(message_key IN
+                (SELECT message_key FROM message_labels JOIN labels USING (label_id) WHERE label = 'Chat'))
+            FROM messages
+            GROUP BY year_month
+            ORDER BY year_month;'''))
+
+    def test_top(self):
+        counts = self.facts.count('from_id')
+        self.assertEqual(self.facts.top('from_id', counts, 3), self._query('''SELECT from_id, COUNT(*) AS messages
+            FROM messages
+            GROUP BY from_id
+            ORDER BY messages DESC, from_id
+            LIMIT 3;'''))
+
+    def test_threads(self):
+        counts, durations = self.facts.threads()
+        expected = self._query('''SELECT COUNT(*), MAX(epoch) - MIN(epoch)
+            FROM messages
+            GROUP BY gmail_thread_id
+            ORDER BY CAST(gmail_thread_id AS INTEGER);''')
+        self.assertEqual(counts.tolist(), [row[0] for row in expected])
+        self.assertEqual([None if duration != duration else duration for duration in durations.tolist()],
+                         [row[1] for row in expected])
+
+    def test_label_counts(self):
+        self.assertEqual(self.facts.label_counts(), dict(self._query('''SELECT label, COUNT(*)
+            FROM message_labels
+            JOIN labels USING (label_id)
+            GROUP BY label_id;''')))
+        self.assertEqual(self.facts.label_counts(~self.facts.is_chat).get('Chat'), None)
+
+    def test_bucket_counts(self):
+        bounds = [60, 3600]
+        values = [None, 0, 60, 61, 3600, 86400]
+        self.assertEqual(facts.bucket_counts(values, bounds), [3, 2, 1])
+        self.assertEqual(facts.bucket_counts(facts.np.array(values, dtype=float), bounds), [3, 2, 1])
+
+if __name__ == '__main__':
+    unittest.main()
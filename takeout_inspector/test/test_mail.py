@@ -23,13 +23,26 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
 """
+import bz2
+import gzip
+import json
+import mailbox
 import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
 import unittest
+import zipfile
 
+from collections import OrderedDict
 from takeout_inspector import mail
+from takeout_inspector.anonymize import anonymize_database
+from takeout_inspector.mbox import MboxReader, split_ranges
 
 
 class Mail(unittest.TestCase):
+    maxDiff = None
 
     def setUp(self):
         self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg')
@@ -41,5 +54,507 @@ class Mail(unittest.TestCase):
     def test_tables(self):
         self.assertTrue(os.path.isfile(self.m.config.get('mail', 'db_file')), 'Database file not created.')
 
+    def test_messages(self):
+        c = self.m.conn.cursor()
+        c.execute('''SELECT COUNT(*) FROM messages;''')
+        self.assertEqual(c.fetchone()[0], 5, 'Not all messages were imported.')
+
+    def test_labels(self):
+        c = self.m.conn.cursor()
+        c.execute('''SELECT ml.message_key, l.label
+            FROM message_labels AS ml
+            JOIN labels AS l ON(l.label_id = ml.label_id)
+            WHERE ml.message_key = 4
+            ORDER BY l.label;''')
+        self.assertEqual(c.fetchall(), [(4, 'Inbox'), (4, 'Travel/2016')])
+
+    def test_addresses(self):
+        c = self.m.conn.cursor()
+        c.execute('''SELECT a.address, d.domain
+            FROM messages AS m
+            JOIN addresses AS a ON(a.address_id = m.from_id)
+            JOIN domains AS d ON(d.domain_id = a.domain_id)
+            WHERE m.message_key = 1;''')
+        self.assertEqual(c.fetchall(), [('johnwilkersoniv@gmail.com', 'gmail.com')])
+
+        c.execute('''SELECT a.address, r.header
+            FROM recipients AS r
+            JOIN addresses AS a ON(a.address_id = r.address_id)
+            WHERE r.message_key = 1
+            ORDER BY a.address;''')
+        self.assertEqual(c.fetchall(), [('bob@example.org', 'CC'), ('carol@example.net', 'CC'),
+                                        ('jane.doe@example.com', 'To')])
+
+    def test_date_columns(self):
+        c = self.m.conn.cursor()
+        c.execute('''SELECT epoch, year_month, dow, hour FROM messages ORDER BY message_key;''')
+        columns = c.fetchall()
+        c.execute('''SELECT CAST(strftime('%s', `date`) AS INT), strftime('%Y-%m', `date`),
+            CAST(strftime('%w', `date`) AS INT), CAST(strftime('%H', `date`) AS INT)
+            FROM messages ORDER BY message_key;''')
+        self.assertEqual(columns, c.fetchall())
+
+    def test_header_cache(self):
+        hits = mail._parse_addresses.cache_info().hits
+        parsed = mail._parse_addresses(['Jane Doe <Jane.Doe@Example.com>', 'John <John.Wilkerson.IV@gmail.com>'])
+        self.assertEqual(parsed, [(u'Jane Doe', 'jane.doe@example.com'), (u'John', 'johnwilkersoniv@gmail.com')])
+        self.assertIs(mail._parse_addresses(['Jane Doe <Jane.Doe@Example.com>', 'John <John.Wilkerson.IV@gmail.com>']),
+                      parsed)
+        self.assertEqual(mail._parse_addresses.cache_info().hits, hits + 1)
+
+    def test_parts(self):
+        c = self.m.conn.cursor()
+        c.execute('''SELECT message_key, content_type, filename, encoded_size FROM parts WHERE message_key > 2;''')
+        self.assertEqual(c.fetchall(), [(3, 'text/plain', None, 5), (4, 'text/plain', None, 31),
+                                        (4, 'image/jpeg', 'cafe.jpg', 153)])
+        c.execute('''SELECT SUM(size) FROM messages;''')
+        self.assertEqual(c.fetchone()[0], os.path.getsize(self.m.config.get('mail', 'mbox_file')))
+
+        body = '\r\n'.join(['--outer', 'Content-Type: multipart/alternative; boundary="inner"', '',
+                             'preamble', '--inner', 'Content-Type: text/plain', '', 'Text', '--inner',
+                             'Content-Type: text/html', '', '<p>Text</p>', '--inner--', 'epilogue', '--outer',
+                             'Content-Type: application/pdf; name="=?UTF-8?B?w4lsb2lzZS5wZGY=?="',
+                             'Content-Transfer-Encoding: base64', '', 'AAAA', 'BBBB', '--outer--', ''])
+        mbox_data = ('From nobody\nSubject: Parts\nContent-Type: multipart/mixed; boundary=outer\n\n' + body +
+                     '\nFrom nobody\nSubject: No body\n')
+        expected = [[('text/plain', None, 4), ('text/html', None, 11), ('application/pdf', u'\xc9loise.pdf', 10)],
+                    [('text/plain', None, 0)]]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            mbox_file = os.path.join(temp_dir, 'parts.mbox')
+            with open(mbox_file, 'wb') as f:
+                f.write(mbox_data)
+            with gzip.open(mbox_file + '.gz', 'wb') as f:
+                f.write(mbox_data)
+
+            self.assertEqual([record.parts for record in MboxReader(mbox_file)], expected)
+            for read_size in [5, 7, 64]:
+                reader = MboxReader(mbox_file + '.gz')
+                reader.read_size = read_size
+                self.assertEqual([record.parts for record in reader], expected, read_size)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_stored_headers(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            imported = self._temp_import(temp_dir, mbox_data, settings=['headers = To, x-gm-thrid'])
+            c = imported.conn.cursor()
+            c.execute('''SELECT DISTINCT n.header
+                FROM headers AS h
+                JOIN header_names AS n ON(n.header_id = h.header_id)
+                ORDER BY n.header;''')
+            self.assertEqual(c.fetchall(), [('To',), ('X-GM-THRID',)])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_reader_matches_mailbox(self):
+        mbox_file = self.m.config.get('mail', 'mbox_file')
+        records = list(MboxReader(mbox_file))
+        messages = mailbox.mbox(mbox_file, create=False).items()
+        self.assertEqual([r.key for r in records], [key for key, message in messages])
+        for record, (key, message) in zip(records, messages):
+            self.assertEqual(record.items(), message.items())
+            self.assertEqual(record.get_from(), message.get_from())
+
+    def test_compressed(self):
+        mbox_file = self.m.config.get('mail', 'mbox_file')
+        mbox_data = open(mbox_file, 'rb').read()
+        records = [(r.key, r.start, r.end, r.from_line, r.headers) for r in MboxReader(mbox_file)]
+        serial = self._dump_tables(self.m.conn)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(temp_dir, name) for name in ['test.mbox.gz', 'test.mbox.bz2', 'test.zip', 'test.tgz']]
+            with gzip.open(paths[0], 'wb') as f:
+                f.write(mbox_data)
+            with open(paths[1], 'wb') as f:
+                f.write(bz2.compress(mbox_data))
+            with zipfile.ZipFile(paths[2], 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr('Takeout/Calendar/other.mbox', 'From nobody\n')
+                archive.writestr('Takeout/Mail/All mail Including Spam and Trash.mbox', mbox_data)
+            with tarfile.open(paths[3], 'w:gz') as archive:
+                archive.add(paths[1], 'Takeout/Drive/test.mbox.bz2')
+                archive.add(mbox_file, 'Takeout/Mail/All mail Including Spam and Trash.mbox')
+
+            for path in paths:
+                reader = MboxReader(path)
+                reader.read_size = 7  # Makes boundaries and header blocks span reads.
+                self.assertEqual([(r.key, r.start, r.end, r.from_line, r.headers) for r in reader], records, path)
+
+                reader = MboxReader(path, start=records[2][1], first_key=2)
+                self.assertEqual([(r.key, r.start, r.end, r.from_line, r.headers) for r in reader], records[2:], path)
+
+            for jobs in [1, 2]:
+                db_file = os.path.join(temp_dir, 'test.db')
+                with open(os.path.join(temp_dir, 'test.cfg'), 'w') as f:
+                    f.write('\n'.join(['[mail]', 'anonymize = False', 'db_file = ' + db_file,
+                                       'mbox_file = ' + paths[2], 'owner = ' + self.m.config.get('mail', 'owner')]))
+                imported = mail.Import(settings_file=os.path.join(temp_dir, 'test.cfg'), jobs=jobs)
+                imported.batch_messages = 2
+                imported.import_messages()
+                self.assertEqual(self._dump_tables(imported.conn), serial)
+                imported.conn.close()
+                os.remove(db_file)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parallel_import(self):
+        serial = self._dump_tables(self.m.conn)
+        os.remove(self.m.config.get('mail', 'db_file'))
+
+        self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg', jobs=2)
+        self.m.chunk_size = 512
+        self.assertTrue(len(split_ranges(self.m.mbox_files[0], self.m.chunk_size)) > 2, 'Too few ranges to test.')
+        self.m.import_messages()
+        self.assertEqual(self._dump_tables(self.m.conn), serial)
+
+    def test_reimport(self):
+        self.m.import_messages()
+        c = self.m.conn.cursor()
+        c.execute('''SELECT COUNT(*) FROM messages;''')
+        self.assertEqual(c.fetchone()[0], 5, 'Messages were imported twice.')
+
+    def test_append(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        first_export = mbox_data[:mbox_data.index('From 1543300000000000002@xxx')]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._temp_import(temp_dir, first_export)
+            imported = self._temp_import(temp_dir, mbox_data)
+            self.assertEqual(self._dump_tables(imported.conn), self._dump_tables(self.m.conn))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_rollup(self):
+        rollup = self._dump_rollup(self.m.conn)
+        self.assertEqual(sum(row[-1] for row in rollup), 5)
+        self.assertIn(('2016-01-05', 2, 2, 1, 1, 1), rollup)  # A chat sent by the owner.
+        self.assertEqual(rollup, self.m.conn.execute('''SELECT date(epoch, 'unixepoch') AS day, hour, dow, is_chat,
+            from_owner, COUNT(*)
+            FROM messages
+            GROUP BY day, hour, is_chat, from_owner
+            ORDER BY day, hour, is_chat, from_owner;''').fetchall(), 'Rollup does not match message flags.')
+
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        first_export = mbox_data[:mbox_data.index('From 1543300000000000002@xxx')]
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._temp_import(temp_dir, first_export)
+            appended = self._temp_import(temp_dir, mbox_data)
+            self.assertEqual(self._dump_rollup(appended.conn), rollup, 'Rollup not updated incrementally.')
+        finally:
+            shutil.rmtree(temp_dir)
+
+        self.m.conn.execute('''DROP TABLE message_rollup;''')
+        self.m.conn.commit()
+        self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg')
+        self.assertEqual(self._dump_rollup(self.m.conn), rollup, 'Rollup not built for an existing database.')
+
+        self.m.conn.execute('''ALTER TABLE message_rollup RENAME COLUMN from_owner TO is_sent;''')
+        self.m.conn.commit()
+        self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg')
+        self.assertEqual(self._dump_rollup(self.m.conn), rollup, 'Rollup with an is_sent column not rebuilt.')
+
+    def test_flags(self):
+        flags_sql = '''SELECT message_key, is_chat, is_sent, from_owner FROM messages ORDER BY message_key;'''
+        flags = self.m.conn.execute(flags_sql).fetchall()
+        self.assertEqual(flags, self.m.conn.execute('''SELECT message_key,
+            gmail_labels LIKE '%Chat%', gmail_labels LIKE '%Sent%', from_id = 2
+            FROM messages ORDER BY message_key;''').fetchall())
+
+        self.m.conn.execute('''CREATE TABLE old_messages AS SELECT message_key, from_id, `from`, `to`, subject, `date`,
+            epoch, year_month, dow, hour, gmail_message_id, gmail_thread_id, gmail_labels, message_id, size
+            FROM messages;''')
+        self.m.conn.execute('''DROP TABLE messages;''')
+        self.m.conn.execute('''ALTER TABLE old_messages RENAME TO messages;''')
+        self.m.conn.commit()
+        self.m = mail.Import(settings_file='takeout_inspector/test/data/test.cfg')
+        self.assertEqual(self.m.conn.execute(flags_sql).fetchall(), flags, 'Flags not set for an existing database.')
+
+    def test_multiple_files(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        second = mbox_data.index('From 1543289712645770271@xxx')
+        fourth = mbox_data.index('From 1543300000000000002@xxx')
+        serial = self._dump_tables(self.m.conn)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            export_dir = os.path.join(temp_dir, 'export')
+            os.makedirs(os.path.join(export_dir, 'Sent'))
+            with open(os.path.join(export_dir, 'Inbox.mbox'), 'wb') as f:
+                f.write(mbox_data[:fourth])
+            with gzip.open(os.path.join(export_dir, 'Sent', 'Sent.mbox.gz'), 'wb') as f:
+                f.write(mbox_data[second:])
+            with open(os.path.join(export_dir, 'notes.txt'), 'wb') as f:
+                f.write(mbox_data)
+            with open(os.path.join(temp_dir, 'test.cfg'), 'w') as f:
+                f.write('\n'.join(['[mail]',
+                                   'anonymize = False',
+                                   'db_file = ' + os.path.join(temp_dir, 'test.db'),
+                                   'mbox_file = ' + os.path.join(temp_dir, 'later.mbox'),
+                                   'owner = ' + self.m.config.get('mail', 'owner')]))
+
+            skip = lambda from_line: from_line.startswith('15433')
+            expected = [(r.start, r.end, r.headers is None) for r in MboxReader(self.m.mbox_files[0], skip=skip)]
+            self.assertEqual([skipped for start, end, skipped in expected], [False, False, True, True, False])
+            reader = MboxReader(os.path.join(export_dir, 'Sent', 'Sent.mbox.gz'), skip=skip)
+            reader.read_size = 7
+            self.assertEqual([(r.start + second, r.end + second, r.headers is None) for r in reader], expected[1:])
+
+            for jobs in [1, 2]:
+                imported = mail.Import(os.path.join(temp_dir, 'test.cfg'), jobs=jobs, mbox_files=export_dir)
+                imported.chunk_size = 512
+                imported.import_messages()
+                self.assertEqual(len(imported.mbox_files), 2)
+                self.assertEqual((imported.stats.messages, imported.stats.duplicates), (7, 2))
+                self.assertEqual(self._dump_tables(imported.conn), serial)
+                imported.conn.close()
+                os.remove(os.path.join(temp_dir, 'test.db'))
+
+            # Merging a later export in to the database only parses the messages that are new.
+            with open(os.path.join(temp_dir, 'later.mbox'), 'wb') as f:
+                f.write(mbox_data)
+            mail.Import(os.path.join(temp_dir, 'test.cfg'),
+                        mbox_files=os.path.join(export_dir, 'Inbox.mbox')).import_messages()
+            parse_message, parsed = mail._parse_message, []
+            mail._parse_message = lambda message, *args: parsed.append(message.key) or parse_message(message, *args)
+            try:
+                merged = mail.Import(os.path.join(temp_dir, 'test.cfg'))
+                merged.import_messages()
+            finally:
+                mail._parse_message = parse_message
+            self.assertEqual((merged.stats.messages, merged.stats.duplicates, parsed), (5, 3, [3, 4]))
+            self.assertEqual(self._dump_tables(merged.conn), serial)
+
+            os.mkdir(os.path.join(temp_dir, 'empty'))
+            self.assertRaises(ValueError, mail.Import, os.path.join(temp_dir, 'test.cfg'),
+                              mbox_files=os.path.join(temp_dir, 'empty'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_message_id_duplicates(self):
+        mbox_data = ''.join(['From nobody Mon Jan 04 15:31:22 2016\nFrom: Jane Doe <jane.doe@example.com>\n'
+                             'Message-ID: <%d@example.com>\nSubject: Note %d\n\nText\n\n' % (n, n) for n in range(2)])
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._temp_import(temp_dir, mbox_data, run=False, settings=['anonymize = True']).conn.close()
+            with open(os.path.join(temp_dir, 'copy.mbox'), 'wb') as f:
+                f.write(mbox_data)
+
+            for mbox_file in ['test.mbox', 'copy.mbox']:  # Separate imports, each with the default (empty) secret.
+                imported = mail.Import(os.path.join(temp_dir, 'test.cfg'), mbox_files=os.path.join(temp_dir, mbox_file))
+                imported.import_messages()
+                imported.conn.close()
+            self.assertEqual((imported.stats.messages, imported.stats.duplicates), (2, 2))
+
+            conn = sqlite3.connect(os.path.join(temp_dir, 'test.db'))
+            self.assertEqual(conn.execute('''SELECT COUNT(*) FROM messages;''').fetchone()[0], 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_resume(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            interrupted = self._temp_import(temp_dir, mbox_data, run=False)
+            insert_headers = interrupted._insert_headers
+
+            def fail_at_fourth_message(message):
+                if message.key == 3:
+                    raise KeyboardInterrupt
+                insert_headers(message)
+
+            interrupted._insert_headers = fail_at_fourth_message
+            self.assertRaises(KeyboardInterrupt, interrupted.import_messages)
+            interrupted.conn.close()
+
+            resumed = self._temp_import(temp_dir, mbox_data)
+            self.assertEqual(self._dump_tables(resumed.conn), self._dump_tables(self.m.conn))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_quarantine(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        mbox_data = mbox_data.replace('Subject: Chat with Jane Doe\n', 'Subject: Chat with Jane Doe \xff\n', 1)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            imported = self._temp_import(temp_dir, mbox_data)
+            c = imported.conn.cursor()
+            c.execute('''SELECT message_key, error FROM quarantine;''')
+            quarantined = c.fetchall()
+            self.assertEqual(len(quarantined), 1)
+            self.assertEqual(quarantined[0][0], 2)
+            self.assertTrue(quarantined[0][1].startswith('UnicodeDecodeError'))
+            c.execute('''SELECT message_key FROM messages ORDER BY message_key;''')
+            self.assertEqual([row[0] for row in c.fetchall()], [0, 1, 3, 4])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_quarantine_address(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        mbox_data = mbox_data.replace('<eloise@example.fr>', '<elo\xefse@example.fr>', 1)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            imported = self._temp_import(temp_dir, mbox_data, settings=['headers = none'])
+            c = imported.conn.cursor()
+            c.execute('''SELECT message_key, error FROM quarantine;''')
+            quarantined = c.fetchall()
+            self.assertEqual(len(quarantined), 1)
+            self.assertEqual(quarantined[0][0], 4)
+            self.assertTrue(quarantined[0][1].startswith('UnicodeDecodeError'))
+            c.execute('''SELECT message_key FROM messages ORDER BY message_key;''')
+            self.assertEqual([row[0] for row in c.fetchall()], [0, 1, 2, 3])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_anonymize(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        first_export = mbox_data[:mbox_data.index('From 1543300000000000002@xxx')]
+        settings = ['anonymize = True', 'anonymize_secret = secret']
+
+        temp_dir = tempfile.mkdtemp()
+        appended_dir = tempfile.mkdtemp()
+        try:
+            imported = self._temp_import(temp_dir, mbox_data, settings=settings)
+            self._temp_import(appended_dir, first_export, settings=settings)
+            appended = self._temp_import(appended_dir, mbox_data, settings=settings)
+            self.assertEqual(self._dump_tables(appended.conn), self._dump_tables(imported.conn))
+
+            c = imported.conn.cursor()
+            c.execute('''SELECT `from` || `to` FROM messages;''')
+            for row in c.fetchall():
+                self.assertNotIn('example.com', row[0])
+        finally:
+            shutil.rmtree(temp_dir)
+            shutil.rmtree(appended_dir)
+
+    def test_anonymize_stored_secret(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        first_export = mbox_data[:mbox_data.index('From 1543300000000000002@xxx')]
+
+        temp_dir = tempfile.mkdtemp()
+        appended_dir = tempfile.mkdtemp()
+        try:
+            first = self._temp_import(appended_dir, first_export, settings=['anonymize = True'])
+            secret = first.conn.execute('''SELECT value FROM metadata WHERE name = 'anonymize_secret';''').fetchone()
+            self.assertEqual(len(secret[0]), 64)
+            first.conn.close()
+            appended = self._temp_import(appended_dir, mbox_data, settings=['anonymize = True'])
+            self.assertEqual(appended.anonymizer.secret, secret[0])
+
+            imported = self._temp_import(temp_dir, mbox_data, settings=['anonymize = True',
+                                                                        'anonymize_secret = ' + secret[0]])
+            self.assertEqual(self._dump_tables(appended.conn), self._dump_tables(imported.conn))
+        finally:
+            shutil.rmtree(temp_dir)
+            shutil.rmtree(appended_dir)
+
+    def test_anonymize_database(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+
+        temp_dir = tempfile.mkdtemp()
+        anonymized_dir = tempfile.mkdtemp()
+        try:
+            imported = self._temp_import(anonymized_dir, mbox_data, settings=['anonymize = True',
+                                                                              'anonymize_secret = secret'])
+            plain = self._temp_import(temp_dir, mbox_data)
+            plain.conn.close()
+            anonymize_database(os.path.join(temp_dir, 'test.db'), 'secret')
+
+            conn = sqlite3.connect(os.path.join(temp_dir, 'test.db'))
+            c = conn.cursor()
+            for query in ['''SELECT message_key, from_id, `from`, `to`, message_id FROM messages
+                            ORDER BY message_key;''',
+                          '''SELECT * FROM recipients ORDER BY message_key, address_id;''',
+                          '''SELECT * FROM address_key ORDER BY address_id;''',
+                          '''SELECT a.address_id, a.address, a.name, d.domain
+                            FROM addresses AS a JOIN domains AS d ON(d.domain_id = a.domain_id)
+                            ORDER BY a.address_id;''']:
+                self.assertEqual(c.execute(query).fetchall(), imported.conn.execute(query).fetchall())
+
+            c.execute('''SELECT n.header, h.value FROM headers AS h JOIN header_names AS n USING(header_id);''')
+            headers = c.fetchall()
+            self.assertNotIn('Received', [header for header, value in headers])
+            for header, value in headers:
+                self.assertNotIn('example.com', value)
+            self.assertIn('/Adium4A1B2C3D', [value[value.find('/'):] for header, value in headers if header == 'To'])
+            self.assertEqual(c.execute('''SELECT filename FROM parts WHERE filename IS NOT NULL;''').fetchall(),
+                             [('attachment.jpg',)])
+        finally:
+            shutil.rmtree(temp_dir)
+            shutil.rmtree(anonymized_dir)
+
+    def test_stage_in_memory(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+        first_export = mbox_data[:mbox_data.index('From 1543300000000000002@xxx')]
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._temp_import(temp_dir, first_export, settings=['stage_in_memory = True'])
+            self._temp_import(temp_dir, mbox_data, settings=['stage_in_memory = True'])
+            conn = sqlite3.connect(os.path.join(temp_dir, 'test.db'))
+            self.assertEqual(self._dump_tables(conn), self._dump_tables(self.m.conn))
+            self.assertEqual(conn.execute('''PRAGMA journal_mode;''').fetchone()[0], 'delete')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_stats(self):
+        mbox_data = open(self.m.config.get('mail', 'mbox_file'), 'rb').read()
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            stats_file = os.path.join(temp_dir, 'stats.json')
+            imported = self._temp_import(temp_dir, mbox_data, run=False, settings=['stats_file = ' + stats_file])
+            phases = []
+            imported.progress = lambda stats: phases.append(stats.phase)
+            imported.import_messages()
+
+            stats = json.load(open(stats_file), object_pairs_hook=OrderedDict)
+            self.assertEqual((stats['messages'], stats['quarantined'], stats['bytes']), (5, 0, len(mbox_data)))
+            self.assertEqual(stats['stages'].keys(), ['read', 'parse', 'decode', 'anonymize', 'insert', 'write',
+                                                      'search', 'commit', 'index', 'finish'])
+            self.assertEqual(stats['indexes'].keys(), [name for name, table, columns in mail.INDEX_PLAN])
+            self.assertGreater(stats['stages']['parse'], 0)
+            self.assertGreater(stats['peak_rss'], 0)
+            self.assertEqual(phases, ['index'] * len(mail.INDEX_PLAN) + ['done'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _temp_import(self, temp_dir, mbox_data, run=True, settings=()):
+        """Writes `mbox_data` to an mbox file in `temp_dir` and imports it in to a database (shared between calls)
+        in `temp_dir`, committing after every message. `settings` are added to the [mail] section.
+        """
+        with open(os.path.join(temp_dir, 'test.mbox'), 'wb') as f:
+            f.write(mbox_data)
+        with open(os.path.join(temp_dir, 'test.cfg'), 'w') as f:
+            f.write('\n'.join(['[mail]',
+                               'anonymize = False',
+                               'commit_size = 1',
+                               'db_file = ' + os.path.join(temp_dir, 'test.db'),
+                               'mbox_file = ' + os.path.join(temp_dir, 'test.mbox'),
+                               'owner = ' + self.m.config.get('mail', 'owner')] + list(settings)))
+
+        imported = mail.Import(settings_file=os.path.join(temp_dir, 'test.cfg'))
+        if run:
+            imported.import_messages()
+        return imported
+
+    def _dump_tables(self, conn):
+        c = conn.cursor()
+        return dict((table, c.execute('SELECT * FROM ' + table + ' ORDER BY message_key;').fetchall())
+                    for table in ['messages', 'recipients', 'headers', 'parts'])
+
+    def _dump_rollup(self, conn):
+        return conn.execute('''SELECT * FROM message_rollup ORDER BY day, hour, is_chat, from_owner;''').fetchall()
+
 if __name__ == '__main__':
     unittest.main()
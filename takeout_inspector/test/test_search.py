@@ -0,0 +1,112 @@
+"""takeout_inspector/test/search.py
+
+Defines unittest tests for full-text search.
+
+Copyright (c) 2016 Christopher Charbonneau Wells
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from takeout_inspector import mail
+from takeout_inspector.anonymize import anonymize_database
+from takeout_inspector.search import Search
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.search = self._import('takeout_inspector/test/data/test.mbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_search(self):
+        self.assertEqual([result.message_key for result in self.search.search('lunch')], [0, 1])
+        self.assertEqual(self.search.search('lunch')[0].subject, '[Lunch] on Friday?')
+        self.assertEqual(self.search.search('photos'),
+                         [(4, self.search.search('photos')[0].rank, u'Caf\xe9 [photos]',
+                           u'[Photos] from the trip attached.\n')])
+        self.assertEqual(self.search.search('AAQSkZJRgABAQEASABIAAD'), [])  # Attachments are not indexed.
+        self.assertEqual(self.search.search('subject:adding'), [])
+        self.assertEqual(self.search.search('lunch', limit=1, offset=1)[0].message_key, 1)
+        self.assertEqual(self.search.count('hey OR hi'), 2)
+        self.assertRaises(sqlite3.OperationalError, self.search.search, 'lunch AND')
+
+    def test_readers(self):
+        indexed = self._dump_index(self.search.conn)
+        with open('takeout_inspector/test/data/test.mbox', 'rb') as f:
+            with gzip.open(os.path.join(self.temp_dir, 'test.mbox.gz'), 'wb') as compressed:
+                compressed.write(f.read())
+
+        for path, jobs in [('takeout_inspector/test/data/test.mbox', 2),
+                           (os.path.join(self.temp_dir, 'test.mbox.gz'), 1),
+                           (os.path.join(self.temp_dir, 'test.mbox.gz'), 2)]:
+            os.remove(os.path.join(self.temp_dir, 'test.db'))
+            self.assertEqual(self._dump_index(self._import(path, jobs).conn), indexed, (path, jobs))
+
+    def test_anonymize_database(self):
+        anonymize_database(os.path.join(self.temp_dir, 'test.db'), 'secret')
+        self.assertEqual(self.search.search('free'), [])
+        self.assertEqual([result.message_key for result in self.search.search('lunch')], [0, 1])
+
+    def test_stage_in_memory(self):
+        indexed = self._dump_index(self.search.conn)
+        ranks = [result.rank for result in self.search.search('lunch OR photos')]
+        mbox_data = open('takeout_inspector/test/data/test.mbox', 'rb').read()
+        with open(os.path.join(self.temp_dir, 'first.mbox'), 'wb') as f:
+            f.write(mbox_data[:mbox_data.index('From 1543300000000000002@xxx')])
+
+        os.remove(os.path.join(self.temp_dir, 'test.db'))
+        self._import(os.path.join(self.temp_dir, 'first.mbox'), settings=['stage_in_memory = True'])
+        search = self._import('takeout_inspector/test/data/test.mbox', settings=['stage_in_memory = True'])
+        self.assertEqual(self._dump_index(search.conn), indexed)
+        self.assertEqual([result.rank for result in search.search('lunch OR photos')], ranks)
+
+    def test_no_index(self):
+        os.remove(os.path.join(self.temp_dir, 'test.db'))
+        self._import('takeout_inspector/test/data/test.mbox', search_index=False)
+        self.assertRaises(ValueError, Search, os.path.join(self.temp_dir, 'test.cfg'))
+
+    def _import(self, mbox_file, jobs=1, search_index=True, settings=()):
+        """Imports `mbox_file` in to a database in self.temp_dir and returns a Search of it. `settings` are added to
+        the [mail] section.
+        """
+        settings_file = os.path.join(self.temp_dir, 'test.cfg')
+        with open(settings_file, 'w') as f:
+            f.write('\n'.join(['[mail]',
+                               'anonymize = False',
+                               'db_file = ' + os.path.join(self.temp_dir, 'test.db'),
+                               'mbox_file = ' + mbox_file,
+                               'search_index = ' + str(search_index)] + list(settings)))
+        mail.Import(settings_file=settings_file, jobs=jobs).import_messages()
+        return Search(settings_file) if search_index else None
+
+    def _dump_index(self, conn):
+        return conn.execute('''SELECT rowid, subject, body FROM message_text ORDER BY rowid;''').fetchall()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,14 +24,62 @@ SOFTWARE.
 
 """
 import ConfigParser
+import json
 import plotly.offline as py
+import uuid
 
-__all__ = ['plotly_default_layout_options', 'plotly_output']
+from collections import namedtuple, OrderedDict
+from functools import wraps
+from plotly.tools import return_figure_from_figure_or_data
+from plotly.utils import PlotlyJSONEncoder
+
+__all__ = ['lru_cache', 'plotly_default_layout_options', 'plotly_output']
 
 config = ConfigParser.ConfigParser()
 config.readfp(open('settings.defaults.cfg'))
 config.read(['settings.cfg'])
 
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def lru_cache(maxsize=10000):
+    """Memoizes a function in a cache of up to `maxsize` results, discarding the least recently used result first (a
+    minimal stand-in for Python 3's functools.lru_cache). Arguments must be hashable, or lists of hashable values. As
+    with functools.lru_cache, the decorated function gains cache_info() (hit and miss counts) and cache_clear().
+
+    Cached results are shared between calls, so they must not be modified.
+    """
+    def decorator(function):
+        cache = OrderedDict()
+        counts = {'hits': 0, 'misses': 0}
+
+        @wraps(function)
+        def wrapper(*args):
+            key = tuple([tuple(arg) if type(arg) is list else arg for arg in args])
+            try:
+                result = cache.pop(key)  # Re-inserted below as the most recently used result.
+                counts['hits'] += 1
+            except KeyError:
+                result = function(*args)
+                counts['misses'] += 1
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            cache[key] = result
+            return result
+
+        def cache_info():
+            return CacheInfo(counts['hits'], counts['misses'], maxsize, len(cache))
+
+        def cache_clear():
+            cache.clear()
+            counts['hits'] = counts['misses'] = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
 
 def plotly_default_layout_options():
     """Prepares default layout options for all graphs.
@@ -61,7 +109,14 @@ def plotly_default_layout_options():
 
 def plotly_output(figure):
     """Plots a Plotly figure and returns a dict with html and javascript for the report.
+
+    If the `external_data` setting of the [report] section is enabled, the figure's data and layout are left out of the
+    javascript and returned as JSON under the "data" key, for the report to write to resources/data/ (see
+    Report._write_report()). The javascript then fetches that file when the graph scrolls in to view.
     """
+    if config.getboolean('report', 'external_data'):
+        return _plotly_external_output(figure)
+
     output = py.plot(figure, output_type='div', include_plotlyjs=False,)
     div, plotly_js = output.split('<script type="text/javascript">')
 
@@ -80,3 +135,34 @@ def plotly_output(figure):
     )
 
     return {'html': div, 'js': waypoints_js}
+
+
+def _plotly_external_output(figure):
+    """Returns a dict like plotly_output() for a Plotly figure whose data and layout are fetched from a separate file,
+    with the JSON of the file under the "data" key and its name (relative to resources/data/) under "data_file".
+    """
+    figure = return_figure_from_figure_or_data(figure, True)
+    div_id = str(uuid.uuid4())
+    data_file = div_id + '.json'
+    div = '<div id="' + div_id + '" style="height: 100%; width: 100%;" class="plotly-graph-div"></div>'
+
+    waypoints_js = '''
+    new Waypoint({{
+        element: document.getElementById('{div_id}'),
+        handler: function() {{
+            var request = new XMLHttpRequest();
+            request.onload = function() {{
+                var figure = JSON.parse(request.responseText);
+                Plotly.newPlot('{div_id}', figure.data, figure.layout,
+                               {{showLink: true, linkText: 'Export to plot.ly'}});
+            }};
+            request.open('GET', 'resources/data/{data_file}');
+            request.send();
+            this.destroy();
+        }},
+        offset: '100%'
+    }});
+    '''.format(div_id=div_id, data_file=data_file)
+
+    data = json.dumps({'data': figure.get('data', []), 'layout': figure.get('layout', {})}, cls=PlotlyJSONEncoder)
+    return {'html': div, 'js': waypoints_js, 'data': data, 'data_file': data_file}